@@ -3,8 +3,14 @@
 import base64
 import math
 import ast
+import collections
+import functools
 import re
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
+import torch.nn.functional as F
 from transformers import StoppingCriteria
 from llava.constants import IMAGE_TOKEN_INDEX
 
@@ -116,6 +122,40 @@ def process_highres_image(image, processor, grid_pinpoints):
     return torch.stack(image_patches, dim=0)
 
 
+@functools.lru_cache(maxsize=None)
+def _parse_grid_pinpoints(grid_pinpoints, patch_size):
+    if "x" in grid_pinpoints:
+        # Use regex to extract the range from the input string
+        matches = re.findall(r"\((\d+)x(\d+)\)", grid_pinpoints)
+        range_start = tuple(map(int, matches[0]))
+        range_end = tuple(map(int, matches[-1]))
+        # Generate a matrix of tuples from (range_start[0], range_start[1]) to (range_end[0], range_end[1])
+        grid_pinpoints = [(i, j) for i in range(range_start[0], range_end[0] + 1) for j in range(range_start[1], range_end[1] + 1)]
+        # Multiply all elements by patch_size
+        return tuple(tuple(dim * patch_size for dim in pair) for pair in grid_pinpoints)
+    return tuple(tuple(pair) for pair in ast.literal_eval(grid_pinpoints))
+
+
+def parse_grid_pinpoints(grid_pinpoints, patch_size=None):
+    """
+    Parse image_grid_pinpoints into the possible resolutions, once per distinct value.
+
+    Args:
+        grid_pinpoints (str or list): A "(1x1),...,(6x6)" range, a string representation of a list of possible
+            resolutions, or that list itself (as stored on the model config).
+        patch_size (int): The size of each image patch, the unit of the "(AxB)" ranges.
+
+    Returns:
+        tuple: The possible resolutions in the format ((width1, height1), (width2, height2), ...).
+    """
+    if isinstance(grid_pinpoints, str):
+        if "x" in grid_pinpoints:
+            assert patch_size in [224, 336, 384, 448, 512], "patch_size should be in [224, 336, 384, 448, 512]"
+            return _parse_grid_pinpoints(grid_pinpoints, patch_size)
+        return _parse_grid_pinpoints(grid_pinpoints, None)
+    return tuple(tuple(pair) for pair in grid_pinpoints)
+
+
 def select_best_resolution(original_size, possible_resolutions):
     """
     Selects the best resolution from a list of possible resolutions based on the original size.
@@ -127,26 +167,29 @@ def select_best_resolution(original_size, possible_resolutions):
     Returns:
         tuple: The best fit resolution in the format (width, height).
     """
-    original_width, original_height = original_size
-    best_fit = None
-    max_effective_resolution = 0
-    min_wasted_resolution = float("inf")
+    return _select_best_resolution(tuple(original_size), tuple(tuple(resolution) for resolution in possible_resolutions))
+
 
-    for width, height in possible_resolutions:
-        # Calculate the downscaled size to keep the aspect ratio
-        scale = min(width / original_width, height / original_height)
-        downscaled_width, downscaled_height = int(original_width * scale), int(original_height * scale)
+@functools.lru_cache(maxsize=65536)
+def _select_best_resolution(original_size, possible_resolutions):
+    # The best fit depends on the absolute size (the effective resolution is capped by the original area),
+    # so the results are memoized per exact size and candidate table.
+    original_width, original_height = original_size
+    resolutions = np.array(possible_resolutions, dtype=np.int64)
+    widths, heights = resolutions[:, 0], resolutions[:, 1]
 
-        # Calculate effective and wasted resolutions
-        effective_resolution = min(downscaled_width * downscaled_height, original_width * original_height)
-        wasted_resolution = (width * height) - effective_resolution
+    # Calculate the downscaled size to keep the aspect ratio, with the same float64 arithmetic as a scalar loop
+    scale = np.minimum(widths / original_width, heights / original_height)
+    downscaled_width, downscaled_height = (original_width * scale).astype(np.int64), (original_height * scale).astype(np.int64)
 
-        if effective_resolution > max_effective_resolution or (effective_resolution == max_effective_resolution and wasted_resolution < min_wasted_resolution):
-            max_effective_resolution = effective_resolution
-            min_wasted_resolution = wasted_resolution
-            best_fit = (width, height)
+    # Calculate effective and wasted resolutions
+    effective_resolution = np.minimum(downscaled_width * downscaled_height, original_width * original_height)
+    wasted_resolution = widths * heights - effective_resolution
 
-    return best_fit
+    # the first candidate with the largest effective and then the smallest wasted resolution
+    candidates = np.flatnonzero(effective_resolution == effective_resolution.max())
+    best_idx = candidates[np.argmin(wasted_resolution[candidates])]
+    return tuple(possible_resolutions[best_idx])
 
 
 def resize_and_pad_image(image, target_resolution):
@@ -222,24 +265,59 @@ def get_anyres_image_grid_shape(image_size, grid_pinpoints, patch_size):
     Returns:
         tuple: The shape of the image patch grid in the format (width, height).
     """
-    if isinstance(grid_pinpoints, str) and "x" in grid_pinpoints:
-        assert patch_size in [224, 336, 384, 448, 512], "patch_size should be in [224, 336, 384, 448, 512]"
-        # Use regex to extract the range from the input string
-        matches = re.findall(r"\((\d+)x(\d+)\)", grid_pinpoints)
-        range_start = tuple(map(int, matches[0]))
-        range_end = tuple(map(int, matches[-1]))
-        # Generate a matrix of tuples from (range_start[0], range_start[1]) to (range_end[0], range_end[1])
-        grid_pinpoints = [(i, j) for i in range(range_start[0], range_end[0] + 1) for j in range(range_start[1], range_end[1] + 1)]
-        # Multiply all elements by patch_size
-        grid_pinpoints = [[dim * patch_size for dim in pair] for pair in grid_pinpoints]
-    if type(grid_pinpoints) is list:
-        possible_resolutions = grid_pinpoints
-    else:
-        possible_resolutions = ast.literal_eval(grid_pinpoints)
+    possible_resolutions = parse_grid_pinpoints(grid_pinpoints, patch_size)
     width, height = select_best_resolution(image_size, possible_resolutions)
     return width // patch_size, height // patch_size
 
 
+def get_tile_normalization(processor, tile_size):
+    """
+    Check whether `processor.preprocess` of a tile_size x tile_size RGB image reduces to rescale + normalize.
+
+    This holds for the CLIP and SigLIP processors when their resize and center crop target the tile size, since
+    resizing an image to its own size and cropping it to its own size leave the pixels untouched.
+
+    Args:
+        processor: The image processor object.
+        tile_size (int): The size of the square tiles.
+
+    Returns:
+        tuple: (rescale_factor, image_mean, image_std), or None if the processor does anything else.
+    """
+    if not all(hasattr(processor, attr) for attr in ["image_mean", "image_std", "rescale_factor", "crop_size", "size"]):
+        return None
+    if not getattr(processor, "do_rescale", True) or not getattr(processor, "do_normalize", True):
+        return None
+    if getattr(processor, "do_center_crop", True) and (processor.crop_size.get("height") != tile_size or processor.crop_size.get("width") != tile_size):
+        return None
+    size = processor.size
+    if isinstance(size, dict):
+        resize_to_tile = size.get("shortest_edge") == tile_size or (size.get("height") == tile_size and size.get("width") == tile_size)
+    else:
+        resize_to_tile = tuple(size) == (tile_size, tile_size)
+    if getattr(processor, "do_resize", True) and not resize_to_tile:
+        return None
+    return processor.rescale_factor, processor.image_mean, processor.image_std
+
+
+def preprocess_tiles(tiles, rescale_factor, image_mean, image_std):
+    """
+    Rescale and normalize a batch of tiles in one pass, with the same arithmetic (and results) as the processors.
+
+    Args:
+        tiles (np.ndarray): uint8 array of shape (num_tiles, height, width, 3).
+        rescale_factor (float): The rescale factor of the processor.
+        image_mean (list): The per-channel mean of the processor.
+        image_std (list): The per-channel std of the processor.
+
+    Returns:
+        torch.Tensor: float32 tensor of shape (num_tiles, 3, height, width).
+    """
+    pixel_values = (tiles * rescale_factor).astype(np.float32)
+    pixel_values = (pixel_values - np.array(image_mean, dtype=np.float32)) / np.array(image_std, dtype=np.float32)
+    return torch.from_numpy(np.ascontiguousarray(pixel_values.transpose(0, 3, 1, 2)))
+
+
 def process_anyres_image(image, processor, grid_pinpoints):
     """
     Process an image with variable resolutions.
@@ -253,30 +331,16 @@ def process_anyres_image(image, processor, grid_pinpoints):
         torch.Tensor: A tensor containing the processed image patches.
     """
     # Convert grid_pinpoints from string to list
+    patch_size = None
     if isinstance(grid_pinpoints, str) and "x" in grid_pinpoints:
         try:
             patch_size = processor.size[0]
         except Exception as e:
             patch_size = processor.size["shortest_edge"]
-        assert patch_size in [224, 336, 384, 448, 512], "patch_size should be in [224, 336, 384, 448, 512]"
-        # Use regex to extract the range from the input string
-        matches = re.findall(r"\((\d+)x(\d+)\)", grid_pinpoints)
-        range_start = tuple(map(int, matches[0]))
-        range_end = tuple(map(int, matches[-1]))
-        # Generate a matrix of tuples from (range_start[0], range_start[1]) to (range_end[0], range_end[1])
-        grid_pinpoints = [(i, j) for i in range(range_start[0], range_end[0] + 1) for j in range(range_start[1], range_end[1] + 1)]
-        # Multiply all elements by patch_size
-        grid_pinpoints = [[dim * patch_size for dim in pair] for pair in grid_pinpoints]
-
-    if type(grid_pinpoints) is list:
-        possible_resolutions = grid_pinpoints
-    else:
-        possible_resolutions = ast.literal_eval(grid_pinpoints)
+    possible_resolutions = parse_grid_pinpoints(grid_pinpoints, patch_size)
     best_resolution = select_best_resolution(image.size, possible_resolutions)
     image_padded = resize_and_pad_image(image, best_resolution)
 
-    patches = divide_to_patches(image_padded, processor.crop_size["height"])
-
     # FIXME: this seems to be a bug that it resizes instead of pad.
     # but to keep it consistent with previous, i will keep it as it is
     # TODO: uncomment below to ablate with the padding
@@ -288,11 +352,131 @@ def process_anyres_image(image, processor, grid_pinpoints):
     # image_padded_square = expand2square(image, tuple(int(x*255) for x in processor.image_mean))
     # image_original_resize = image_padded_square.resize((processor.size['shortest_edge'], processor.size['shortest_edge']))
 
+    tile_size = processor.crop_size["height"]
+    tile_normalization = get_tile_normalization(processor, tile_size)
+    width, height = best_resolution
+    if tile_normalization is not None and image.mode == "RGB" and shortest_edge == tile_size and width % tile_size == 0 and height % tile_size == 0:
+        # carve the tiles out of one array in the same row-major order as divide_to_patches and preprocess them as one batch
+        tiles = np.asarray(image_padded).reshape(height // tile_size, tile_size, width // tile_size, tile_size, 3)
+        tiles = tiles.transpose(0, 2, 1, 3, 4).reshape(-1, tile_size, tile_size, 3)
+        tiles = np.concatenate([np.asarray(image_original_resize)[None], tiles], axis=0)
+        return preprocess_tiles(tiles, *tile_normalization)
+
+    patches = divide_to_patches(image_padded, tile_size)
+
     image_patches = [image_original_resize] + patches
     image_patches = [processor.preprocess(image_patch, return_tensors="pt")["pixel_values"][0] for image_patch in image_patches]
     return torch.stack(image_patches, dim=0)
 
 
+def get_unpad_shape(original_size, current_height, current_width):
+    """
+    Calculate the (height, width) that `unpad_image` leaves of a padded feature map, without touching the tensor.
+
+    Args:
+        original_size (tuple): The original size of the image in the format (width, height).
+        current_height (int): The height of the padded feature map.
+        current_width (int): The width of the padded feature map.
+
+    Returns:
+        tuple: The unpadded size in the format (height, width).
+    """
+    original_width, original_height = original_size
+    original_aspect_ratio = original_width / original_height
+    current_aspect_ratio = current_width / current_height
+
+    if original_aspect_ratio > current_aspect_ratio:
+        scale_factor = current_width / original_width
+        new_height = int(original_height * scale_factor)
+        padding = (current_height - new_height) // 2
+        return current_height - 2 * padding, current_width
+    else:
+        scale_factor = current_height / original_height
+        new_width = int(original_width * scale_factor)
+        padding = (current_width - new_width) // 2
+        return current_height, current_width - 2 * padding
+
+
+def get_num_visual_tokens(
+    image_size,
+    image_aspect_ratio,
+    image_grid_pinpoints,
+    mm_patch_merge_type,
+    num_patches_per_side,
+    vision_tower_image_size,
+    modality="image",
+    num_frames=1,
+    mm_newline_position="grid",
+    mm_spatial_pool_mode="bilinear",
+):
+    """
+    Count the visual tokens `prepare_inputs_labels_for_multimodal` splices into the sequence for one image or video.
+
+    Args:
+        image_size (tuple): The size of the input image in the format (width, height).
+        image_aspect_ratio (str): The image_aspect_ratio the image is processed with.
+        image_grid_pinpoints (list): The possible anyres resolutions, as set on the model config.
+        mm_patch_merge_type (str): The mm_patch_merge_type of the model.
+        num_patches_per_side (int): The number of patches per side of the vision tower.
+        vision_tower_image_size (int): The input resolution of the vision tower.
+        modality (str): "image" or "video".
+        num_frames (int): The number of sampled frames, for videos.
+        mm_newline_position (str): The mm_newline_position of the model, for videos.
+        mm_spatial_pool_mode (str): The mm_spatial_pool_mode of the model, for videos.
+
+    Returns:
+        int: The number of visual tokens.
+    """
+    height = width = num_patches_per_side
+    is_spatial = mm_patch_merge_type.startswith("spatial")
+
+    if modality == "video":
+        # videos are pooled with the default stride of get_2dPool
+        if mm_spatial_pool_mode == "bilinear":
+            pooled_side = math.ceil(height / 2)
+        else:
+            pooled_side = height // 2
+        frame_tokens = pooled_side * pooled_side
+        if not is_spatial or mm_newline_position == "no_token":
+            return num_frames * frame_tokens
+        elif mm_newline_position == "grid":
+            return num_frames * pooled_side * (pooled_side + 1)
+        elif mm_newline_position == "frame":
+            return num_frames * (frame_tokens + 1)
+        elif mm_newline_position == "one_token":
+            return num_frames * frame_tokens + (1 if "unpad" in mm_patch_merge_type else 0)
+        raise ValueError(f"Unexpected mm_newline_position: {mm_newline_position}")
+
+    if image_aspect_ratio == "anyres" or "anyres_max" in image_aspect_ratio:
+        num_patch_width, num_patch_height = get_anyres_image_grid_shape(image_size, image_grid_pinpoints, vision_tower_image_size)
+        num_tiles = 1 + num_patch_width * num_patch_height
+    elif image_aspect_ratio in ["highres", "crop_split"]:
+        # the model views these tiles as a 2x2 grid
+        num_patch_width = num_patch_height = 2
+        num_tiles = 5
+    else:
+        num_tiles = 1
+
+    if not is_spatial:
+        return num_tiles * height * width
+    if num_tiles == 1:
+        return height * width + (1 if "unpad" in mm_patch_merge_type else 0)
+
+    base_tokens = 0 if "nobase" in mm_patch_merge_type else height * width
+    if "maxpool2x2" in mm_patch_merge_type:
+        return base_tokens + (num_patch_height * height // 2) * (num_patch_width * width // 2)
+    elif "unpad" in mm_patch_merge_type:
+        unpad_height, unpad_width = get_unpad_shape(image_size, num_patch_height * height, num_patch_width * width)
+        matched_anyres_max_num_patches = re.match(r"anyres_max_(\d+)", image_aspect_ratio)
+        if matched_anyres_max_num_patches:
+            max_num_patches = int(matched_anyres_max_num_patches.group(1))
+            times = math.sqrt(unpad_height * unpad_width / (max_num_patches * height**2))
+            if times > 1.1:
+                unpad_height, unpad_width = int(unpad_height // times), int(unpad_width // times)
+        return base_tokens + unpad_height * (unpad_width + 1)
+    return base_tokens + num_patch_height * num_patch_width * height * width
+
+
 def load_image_from_base64(image):
     return Image.open(BytesIO(base64.b64decode(image)))
 
@@ -311,7 +495,123 @@ def expand2square(pil_img, background_color):
         return result
 
 
+class TensorImageProcessor:
+    """
+    Batched torch implementation of the resize / center crop / rescale / normalize pipeline of the CLIP and SigLIP
+    image processors.
+
+    Wraps an image processor and exposes the same preprocess(images, return_tensors="pt")["pixel_values"] interface
+    (every other attribute is forwarded to the wrapped processor). Images of the same size are stacked into one
+    uint8 NCHW batch and resized with antialiased bicubic interpolation, rescaled and normalized in a single pass.
+    The resize is not bit-exact with PIL, the difference is below one uint8 step for most pixels. With
+    num_threads > 0 the groups of a call are processed on a thread pool and preprocess_async returns a future.
+    """
+
+    def __init__(self, image_processor, num_threads=0):
+        self.image_processor = image_processor
+        size = image_processor.size
+        if isinstance(size, dict) and "shortest_edge" in size:
+            self.resize_shortest_edge, self.resize_size = size["shortest_edge"], None
+        elif isinstance(size, dict) and "height" in size and "width" in size:
+            self.resize_shortest_edge, self.resize_size = None, (size["height"], size["width"])
+        elif isinstance(size, (tuple, list)) and len(size) == 2:
+            self.resize_shortest_edge, self.resize_size = None, tuple(size)
+        else:
+            raise ValueError(f"Unsupported image processor size {size} for the torch preprocessing backend")
+        self.do_resize = getattr(image_processor, "do_resize", True)
+        self.do_center_crop = getattr(image_processor, "do_center_crop", False) and getattr(image_processor, "crop_size", None) is not None
+        self.tensor_rescale_factor = image_processor.rescale_factor if getattr(image_processor, "do_rescale", True) else 1.0
+        do_normalize = getattr(image_processor, "do_normalize", True)
+        self.tensor_mean = torch.tensor(image_processor.image_mean if do_normalize else [0.0, 0.0, 0.0], dtype=torch.float32).view(1, 3, 1, 1)
+        self.tensor_std = torch.tensor(image_processor.image_std if do_normalize else [1.0, 1.0, 1.0], dtype=torch.float32).view(1, 3, 1, 1)
+        self.num_threads = num_threads
+        self._executor = None
+        self._executor_pid = None
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set on the wrapper itself
+        if name.startswith("__") or name == "image_processor":
+            raise AttributeError(name)
+        return getattr(self.image_processor, name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_executor"] = state["_executor_pid"] = None
+        return state
+
+    def _get_executor(self):
+        # threads do not survive a fork, every dataloader worker creates its own pool
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _get_output_size(self, height, width):
+        if self.resize_size is not None:
+            return self.resize_size
+        # same as transformers get_resize_output_image_size with default_to_square=False
+        short, long = (width, height) if width <= height else (height, width)
+        new_short, new_long = self.resize_shortest_edge, int(self.resize_shortest_edge * long / short)
+        return (new_long, new_short) if width <= height else (new_short, new_long)
+
+    def _preprocess_batch(self, images):
+        """images: uint8 tensor of shape (N, 3, H, W)."""
+        pixel_values = images.float()
+        height, width = pixel_values.shape[-2:]
+        if self.do_resize:
+            output_size = self._get_output_size(height, width)
+            if tuple(output_size) != (height, width):
+                # round and clamp like the uint8 output of PIL
+                pixel_values = F.interpolate(pixel_values, size=output_size, mode="bicubic", align_corners=False, antialias=True).clamp_(0, 255).round_()
+        if self.do_center_crop:
+            crop_height, crop_width = self.image_processor.crop_size["height"], self.image_processor.crop_size["width"]
+            height, width = pixel_values.shape[-2:]
+            top, left = max((height - crop_height) // 2, 0), max((width - crop_width) // 2, 0)
+            pixel_values = pixel_values[:, :, top : top + crop_height, left : left + crop_width]
+        return (pixel_values * self.tensor_rescale_factor - self.tensor_mean) / self.tensor_std
+
+    @staticmethod
+    def _to_uint8_tensors(images):
+        if isinstance(images, np.ndarray) and images.ndim == 4:
+            # video frames, (N, H, W, 3)
+            return list(torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2))
+        if isinstance(images, (Image.Image, np.ndarray)):
+            images = [images]
+        tensors = []
+        for image in images:
+            if isinstance(image, Image.Image):
+                image = np.asarray(image.convert("RGB"))
+            tensors.append(torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1))
+        return tensors
+
+    def preprocess(self, images, return_tensors="pt"):
+        images = self._to_uint8_tensors(images)
+        # batch the images of the same size, keeping the input order
+        groups = collections.OrderedDict()
+        for image_idx, image in enumerate(images):
+            groups.setdefault(tuple(image.shape), []).append(image_idx)
+        batches = [torch.stack([images[image_idx] for image_idx in indices]) for indices in groups.values()]
+        if self.num_threads > 0 and len(batches) > 1:
+            outputs = list(self._get_executor().map(self._preprocess_batch, batches))
+        else:
+            outputs = [self._preprocess_batch(batch) for batch in batches]
+
+        pixel_values = [None] * len(images)
+        for indices, output in zip(groups.values(), outputs):
+            for image_idx, pixel_value in zip(indices, output):
+                pixel_values[image_idx] = pixel_value
+        if all(x.shape == pixel_values[0].shape for x in pixel_values):
+            pixel_values = torch.stack(pixel_values, dim=0)
+        return {"pixel_values": pixel_values}
+
+    def preprocess_async(self, images, return_tensors="pt"):
+        """Run preprocess on the thread pool, returning a concurrent.futures.Future."""
+        return self._get_executor().submit(self.preprocess, images, return_tensors)
+
+
 def process_images(images, image_processor, model_cfg):
+    if getattr(model_cfg, "image_preprocess_backend", "pil") == "torch" and not isinstance(image_processor, TensorImageProcessor):
+        image_processor = TensorImageProcessor(image_processor)
     image_aspect_ratio = getattr(model_cfg, "image_aspect_ratio", None)
     new_images = []
     if image_aspect_ratio == "highres":
@@ -327,10 +627,9 @@ def process_images(images, image_processor, model_cfg):
             image = process_highres_image_crop_split(image, model_cfg, image_processor)
             new_images.append(image)
     elif image_aspect_ratio == "pad":
-        for image in images:
-            image = expand2square(image, tuple(int(x * 255) for x in image_processor.image_mean))
-            image = image_processor.preprocess(image, return_tensors="pt")["pixel_values"][0]
-            new_images.append(image)
+        # the padded images are preprocessed as one batch
+        padded_images = [expand2square(image, tuple(int(x * 255) for x in image_processor.image_mean)) for image in images]
+        new_images = list(image_processor.preprocess(padded_images, return_tensors="pt")["pixel_values"])
     else:
         return image_processor.preprocess(images, return_tensors="pt")["pixel_values"]
     if all(x.shape == new_images[0].shape for x in new_images):
@@ -26,7 +26,7 @@
 
 from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 
-from llava.mm_utils import get_anyres_image_grid_shape
+from llava.mm_utils import get_anyres_image_grid_shape, get_unpad_shape
 from llava.utils import rank0_print, rank_print
 import random
 
@@ -51,6 +51,12 @@ def get_vision_tower(self):
             vision_tower = vision_tower[0]
         return vision_tower
 
+    def get_vision_resampler(self):
+        vision_resampler = getattr(self, "vision_resampler", None)
+        if type(vision_resampler) is list:
+            vision_resampler = vision_resampler[0]
+        return vision_resampler
+
     def initialize_vision_modules(self, model_args, fsdp=None):
         vision_tower = model_args.vision_tower
         mm_vision_select_layer = model_args.mm_vision_select_layer
@@ -124,6 +130,22 @@ def get_w(weights, keyword):
             rank0_print(f"Loaded vision resampler weights from {pretrain_mm_mlp_adapter}. Incompatible keys: {incompatible_keys}")
 
 
+def run_in_micro_batches(fn, images, micro_batch_size):
+    """
+    Run `fn` over `images` in micro batches of exactly `micro_batch_size` images, the last one padded with zeros, and
+    concatenate the outputs of the real images. Every call of `fn` sees the same shape and at most micro_batch_size
+    images, whatever the number of tiles and frames of the batch.
+    """
+    outputs = []
+    for start in range(0, images.shape[0], micro_batch_size):
+        micro_batch = images[start : start + micro_batch_size]
+        num_images = micro_batch.shape[0]
+        if num_images < micro_batch_size:
+            micro_batch = torch.cat((micro_batch, micro_batch.new_zeros((micro_batch_size - num_images, *micro_batch.shape[1:]))), dim=0)
+        outputs.append(fn(micro_batch)[:num_images])
+    return torch.cat(outputs, dim=0)
+
+
 def unpad_image(tensor, original_size):
     """
     Unpads a PyTorch tensor of a padded and resized image.
@@ -189,12 +211,70 @@ def get_2dPool(self, image_feature, stride=2):
         image_feature = image_feature.view(num_frames, -1, num_dim)
         return image_feature
 
+    def reduce_temporal_redundancy(self, video_feature):
+        """
+        Merge the runs of near-duplicate frames of the pooled `video_feature` (num_frames, num_tokens, dim) into their
+        mean frame. A run grows while the mean cosine similarity of the tokens of a frame with the same tokens of the
+        first frame of the run is at least mm_temporal_similarity_threshold. At least mm_temporal_min_frames frames
+        are kept, by also cutting the runs between the least similar consecutive frames. Whole frames are merged, so
+        every mm_newline_position layout stays valid.
+        """
+        num_frames = video_feature.shape[0]
+        threshold = getattr(self.config, "mm_temporal_similarity_threshold", 0.95)
+        min_frames = min(getattr(self.config, "mm_temporal_min_frames", 8), num_frames)
+        if num_frames <= min_frames:
+            return video_feature
+
+        normalized = nn.functional.normalize(video_feature.float(), dim=-1)
+        # similarity of every pair of frames, averaged over the token positions, moved to the CPU at once
+        similarity = (torch.einsum("itd,jtd->ij", normalized, normalized) / video_feature.shape[1]).tolist()
+
+        starts = [0]
+        for frame_idx in range(1, num_frames):
+            if similarity[starts[-1]][frame_idx] < threshold:
+                starts.append(frame_idx)
+        if len(starts) < min_frames:
+            cuts = sorted((frame_idx for frame_idx in range(1, num_frames) if frame_idx not in starts), key=lambda frame_idx: similarity[frame_idx - 1][frame_idx])
+            starts = sorted(starts + cuts[: min_frames - len(starts)])
+        if len(starts) == num_frames:
+            return video_feature
+
+        run_lengths = [end - start for start, end in zip(starts, starts[1:] + [num_frames])]
+        return torch.stack([run.mean(dim=0) for run in torch.split(video_feature, run_lengths)]).to(video_feature.dtype)
+
     def encode_images(self, images):
-        image_features = self.get_model().get_vision_tower()(images)
+        vision_tower = self.get_model().get_vision_tower()
+        micro_batch_size = getattr(self.config, "mm_vision_tower_micro_batch", 0)
+        if micro_batch_size and torch.is_tensor(images) and images.shape[0] > 0:
+            image_features = run_in_micro_batches(vision_tower, images, micro_batch_size)
+        else:
+            image_features = vision_tower(images)
         # image_features = self.get_model().vision_resampler(image_features, images=images)
         image_features = self.get_model().mm_projector(image_features)
         return image_features
-    
+
+    def encode_images_with_cached_features(self, images_list, feature_idx_in_batch):
+        """
+        Same as encode_images over the concatenation of images_list, except that the entries in feature_idx_in_batch
+        already hold vision tower features (from llava.train.feature_cache) and only go through the projector.
+        Returns one feature tensor per entry of images_list.
+        """
+        encoded_image_features = [None] * len(images_list)
+        pixel_idx_in_batch = [idx for idx in range(len(images_list)) if idx not in feature_idx_in_batch]
+        if len(pixel_idx_in_batch) > 0:
+            pixel_features = self.encode_images(torch.cat([images_list[idx] for idx in pixel_idx_in_batch], dim=0))
+            pixel_features = torch.split(pixel_features, [images_list[idx].shape[0] for idx in pixel_idx_in_batch])
+            for idx, feature in zip(pixel_idx_in_batch, pixel_features):
+                encoded_image_features[idx] = feature
+
+        mm_projector = self.get_model().mm_projector
+        projector_dtype = next(mm_projector.parameters()).dtype
+        cached_features = torch.cat([images_list[idx] for idx in feature_idx_in_batch], dim=0).to(device=self.device, dtype=projector_dtype)
+        cached_features = torch.split(mm_projector(cached_features), [images_list[idx].shape[0] for idx in feature_idx_in_batch])
+        for idx, feature in zip(feature_idx_in_batch, cached_features):
+            encoded_image_features[idx] = feature
+        return encoded_image_features
+
     def encode_multimodals(self, videos_or_images, video_idx_in_batch, split_sizes=None):
         videos_or_images_features = self.get_model().get_vision_tower()(videos_or_images)
         per_videos_or_images_features = torch.split(videos_or_images_features, split_sizes, dim=0)  # tuple, (dim_1, 576, 4096)
@@ -248,6 +328,74 @@ def add_token_per_frame(self, image_feature):
         image_feature = image_feature.permute(1, 2, 0).contiguous()
         return image_feature
 
+    def merge_unpad_features_grouped(self, image_features, image_idx_in_batch, image_sizes, image_aspect_ratio, mm_patch_merge_type):
+        """
+        The "unpad" merge of the multi patch `image_features` at `image_idx_in_batch`, for all images with the same grid,
+        crop and output size at once. The crops are computed on the CPU from `image_sizes`, with `get_unpad_shape`.
+
+        Returns:
+            dict: The merged feature of every image index, as the per image merge of prepare_inputs_labels_for_multimodal.
+        """
+        height = width = self.get_vision_tower().num_patches_per_side
+        matched_anyres_max_num_patches = re.match(r"anyres_max_(\d+)", image_aspect_ratio) if "anyres_max" in image_aspect_ratio else None
+        max_num_patches = int(matched_anyres_max_num_patches.group(1)) if matched_anyres_max_num_patches else None
+        if torch.is_tensor(image_sizes):
+            image_sizes = image_sizes.tolist()
+
+        groups = {}
+        for image_idx in image_idx_in_batch:
+            image_size = [int(x) for x in image_sizes[image_idx]]
+            if image_aspect_ratio == "anyres" or "anyres_max" in image_aspect_ratio:
+                if not hasattr(self.get_vision_tower(), "image_size"):
+                    raise ValueError("vision_tower_image_size is not found in the vision tower.")
+                try:
+                    num_patch_width, num_patch_height = get_anyres_image_grid_shape(image_size, self.config.image_grid_pinpoints, self.get_vision_tower().image_size)
+                except Exception as e:
+                    rank0_print(f"Error: {e}")
+                    num_patch_width, num_patch_height = 2, 2
+            else:
+                num_patch_width, num_patch_height = 2, 2
+            current_height, current_width = num_patch_height * height, num_patch_width * width
+            unpad_height, unpad_width = get_unpad_shape(image_size, current_height, current_width)
+            top, left = (current_height - unpad_height) // 2, (current_width - unpad_width) // 2
+            output_size = None
+            if max_num_patches is not None:
+                times = math.sqrt(unpad_height * unpad_width / (max_num_patches * height**2))
+                if times > 1.1:
+                    output_size = (int(unpad_height // times), int(unpad_width // times))
+            key = (num_patch_height, num_patch_width, top, top + unpad_height, left, left + unpad_width, output_size)
+            groups.setdefault(key, []).append(image_idx)
+
+        merged_features = {}
+        for (num_patch_height, num_patch_width, top, bottom, left, right, output_size), group in groups.items():
+            image_feature = torch.stack([image_features[image_idx] for image_idx in group])
+            base_image_feature = image_feature[:, 0]
+            image_feature = image_feature[:, 1:].view(len(group), num_patch_height, num_patch_width, height, width, -1)
+            image_feature = image_feature.permute(0, 5, 1, 3, 2, 4).contiguous()
+            image_feature = image_feature.flatten(2, 3).flatten(3, 4)[:, :, top:bottom, left:right]
+            if output_size is not None:
+                image_feature = nn.functional.interpolate(image_feature, list(output_size), mode="bilinear")
+            image_feature = torch.cat((image_feature, self.model.image_newline[None, :, None, None].expand(*image_feature.shape[:-1], 1).to(image_feature.device)), dim=-1)
+            image_feature = image_feature.flatten(2, 3).transpose(1, 2)
+            if "nobase" not in mm_patch_merge_type:
+                image_feature = torch.cat((base_image_feature, image_feature), dim=1)
+            for image_idx, merged_feature in zip(group, image_feature):
+                merged_features[image_idx] = merged_feature
+        return merged_features
+
+    def get_token_merge_segment_ids(self, image_feature, num_base_tokens):
+        """
+        Segments of a merged image or video feature for the token_merge resampler: the `num_base_tokens` leading tokens
+        of the base image (0), the other visual tokens (1), and the newline tokens that lay out the rows and frames (-1),
+        which are kept as they are.
+        """
+        segment_ids = torch.ones(image_feature.shape[0], dtype=torch.long, device=image_feature.device)
+        segment_ids[:num_base_tokens] = 0
+        for layout_token in [getattr(self.model, "image_newline", None), getattr(self.model, "faster_token", None)]:
+            if layout_token is not None:
+                segment_ids[(image_feature == layout_token.to(image_feature)).all(dim=-1)] = -1
+        return segment_ids
+
     def prepare_inputs_labels_for_multimodal(self, input_ids, position_ids, attention_mask, past_key_values, labels, images, modalities=["image"], image_sizes=None):
         vision_tower = self.get_vision_tower()
         # rank_print(modalities)
@@ -259,8 +407,11 @@ def prepare_inputs_labels_for_multimodal(self, input_ids, position_ids, attentio
 
         # import pdb; pdb.set_trace()
         if type(images) is list or images.ndim == 5:
+            # cached vision tower features are already (num_tiles, num_patches, dim)
+            feature_idx_in_batch = [idx for idx, modality in enumerate(modalities) if modality == "image_feature"]
+
             if type(images) is list:
-                images = [x.unsqueeze(0) if x.ndim == 3 else x for x in images]
+                images = [x.unsqueeze(0) if x.ndim == 3 and idx not in feature_idx_in_batch else x for idx, x in enumerate(images)]
 
             video_idx_in_batch = []
             for _ in range(len(modalities)):
@@ -268,24 +419,30 @@ def prepare_inputs_labels_for_multimodal(self, input_ids, position_ids, attentio
                     video_idx_in_batch.append(_)
 
             images_list = []
-            for image in images:
-                if image.ndim == 4:
+            for idx, image in enumerate(images):
+                if image.ndim == 4 or idx in feature_idx_in_batch:
                     images_list.append(image)
                 else:
                     images_list.append(image.unsqueeze(0))
 
-            concat_images = torch.cat([image for image in images_list], dim=0)
             split_sizes = [image.shape[0] for image in images_list]
-            encoded_image_features = self.encode_images(concat_images)
-            # image_features,all_faster_video_features = self.encode_multimodals(concat_images, video_idx_in_batch, split_sizes)
+            if len(feature_idx_in_batch) > 0:
+                encoded_image_features = self.encode_images_with_cached_features(images_list, feature_idx_in_batch)
+            else:
+                concat_images = torch.cat([image for image in images_list], dim=0)
+                encoded_image_features = self.encode_images(concat_images)
+                # image_features,all_faster_video_features = self.encode_multimodals(concat_images, video_idx_in_batch, split_sizes)
 
-            # This is a list, each element is [num_images, patch * patch, dim]
-            # rank_print(f"Concat images : {concat_images.shape}")
-            encoded_image_features = torch.split(encoded_image_features, split_sizes)
+                # This is a list, each element is [num_images, patch * patch, dim]
+                # rank_print(f"Concat images : {concat_images.shape}")
+                encoded_image_features = torch.split(encoded_image_features, split_sizes)
             image_features = []
             for idx, image_feat in enumerate(encoded_image_features):
                 if idx in video_idx_in_batch:
-                    image_features.append(self.get_2dPool(image_feat))
+                    image_feat = self.get_2dPool(image_feat)
+                    if getattr(self.config, "mm_temporal_reduction", False):
+                        image_feat = self.reduce_temporal_redundancy(image_feat)
+                    image_features.append(image_feat)
                 else:
                     image_features.append(image_feat)
             # image_features = self.encode_multimodals(concat_images, video_idx_in_batch, split_sizes)
@@ -294,12 +451,19 @@ def prepare_inputs_labels_for_multimodal(self, input_ids, position_ids, attentio
             mm_patch_merge_type = getattr(self.config, "mm_patch_merge_type", "flat")
             image_aspect_ratio = getattr(self.config, "image_aspect_ratio", "square")
             mm_newline_position = getattr(self.config, "mm_newline_position", "one_token")
+            # the spatial merges put the tokens of the base image first, before the patches and newlines
+            has_base = mm_patch_merge_type.startswith("spatial") and "nobase" not in mm_patch_merge_type
+            num_base_tokens = [x.shape[1] if has_base and idx not in video_idx_in_batch and x.shape[0] > 1 else 0 for idx, x in enumerate(image_features)]
 
             if mm_patch_merge_type == "flat":
                 image_features = [x.flatten(0, 1) for x in image_features]
 
             elif mm_patch_merge_type.startswith("spatial"):
                 new_image_features = []
+                grouped_image_features = {}
+                if getattr(self.config, "mm_grouped_unpad", False) and "unpad" in mm_patch_merge_type and "maxpool2x2" not in mm_patch_merge_type:
+                    unpad_idx_in_batch = [idx for idx, image_feature in enumerate(image_features) if idx not in video_idx_in_batch and image_feature.shape[0] > 1]
+                    grouped_image_features = self.merge_unpad_features_grouped(image_features, unpad_idx_in_batch, image_sizes, image_aspect_ratio, mm_patch_merge_type)
                 for image_idx, image_feature in enumerate(image_features):
                     # FIXME: now assume the image is square, and split to 2x2 patches
                     # num_patches = h * w, where h = w = sqrt(num_patches)
@@ -347,6 +511,8 @@ def prepare_inputs_labels_for_multimodal(self, input_ids, position_ids, attentio
                             new_image_features.append(image_feature.flatten(0, 1))
                         else:
                             raise ValueError(f"Unexpected mm_newline_position: {mm_newline_position}")
+                    elif image_idx in grouped_image_features:  # merged with the images of the same shape
+                        new_image_features.append(grouped_image_features[image_idx])
                     elif image_feature.shape[0] > 1:  # multi patches and multi images operations
                         # rank0_print("Single-images")
                         base_image_feature = image_feature[0]
@@ -415,6 +581,12 @@ def prepare_inputs_labels_for_multimodal(self, input_ids, position_ids, attentio
                 raise ValueError(f"Unexpected mm_patch_merge_type: {self.config.mm_patch_merge_type}")
         else:
             image_features = self.encode_images(images)
+            num_base_tokens = None
+
+        if getattr(self.config, "mm_resampler_type", None) == "token_merge":
+            # merges or prunes the projected tokens of every image and video, see multimodal_resampler/token_merge.py
+            segment_ids = [self.get_token_merge_segment_ids(x, num_base) for x, num_base in zip(image_features, num_base_tokens)] if num_base_tokens is not None else None
+            image_features = self.get_model().get_vision_resampler()(image_features, modalities=modalities, segment_ids=segment_ids)
 
         # TODO: image start / end is not implemented here to support pretraining.
         if getattr(self.config, "tune_mm_mlp_adapter", False) and getattr(self.config, "mm_use_im_start_end", False):
@@ -437,8 +609,57 @@ def prepare_inputs_labels_for_multimodal(self, input_ids, position_ids, attentio
         if labels is None:
             labels = torch.full_like(input_ids, IGNORE_INDEX)
 
+        # Truncate sequences to max length as image embeddings can make the sequence longer
+        tokenizer_model_max_length = getattr(self.config, "tokenizer_model_max_length", None)
+        packing = getattr(self.config, "packing", False) and self.training and _labels is not None
+
+        if getattr(self.config, "mm_batched_splice", False) and not packing:
+            # rows without a modality are dropped, like the zip with modalities below
+            num_rows = min(len(input_ids), len(modalities))
+            new_input_embeds, new_labels, attention_mask, position_ids = self.splice_multimodal_batched(input_ids[:num_rows], labels[:num_rows], attention_mask[:num_rows], position_ids, image_features, tokenizer_model_max_length)
+        else:
+            new_input_embeds, new_labels = self.splice_multimodal_features(input_ids, labels, attention_mask, image_features)
+            # rank_print("Finishing Inserting")
+
+            new_input_embeds = [x[:tokenizer_model_max_length] for x, modality in zip(new_input_embeds, modalities)]
+            new_labels = [x[:tokenizer_model_max_length] for x, modality in zip(new_labels, modalities)]
+            # TODO: Hard code for control loss spike
+            # if tokenizer_model_max_length is not None:
+            #     new_input_embeds = [x[:4096] if modality != "video" else x[:tokenizer_model_max_length] for x, modality in zip(new_input_embeds, modalities)]
+            #     new_labels = [x[:4096] if modality != "video" else x[:tokenizer_model_max_length] for x, modality in zip(new_labels, modalities)]
+
+            if packing:
+                return self.pack_multimodal_sequences(new_input_embeds, new_labels, tokenizer_model_max_length, past_key_values)
+
+            new_input_embeds, new_labels, attention_mask, position_ids = self.pad_multimodal_sequences(new_input_embeds, new_labels, attention_mask, position_ids)
+
+        if _labels is None:
+            new_labels = None
+
+        if _attention_mask is None:
+            attention_mask = None
+        else:
+            attention_mask = attention_mask.to(dtype=_attention_mask.dtype)
+
+        if _position_ids is None:
+            position_ids = None
+        if getattr(self.config, "use_pos_skipping", False) and self.training:
+            position_ids = torch.arange(new_input_embeds.size(1), device=new_input_embeds.device).unsqueeze(0).to(new_input_embeds.device)
+            split_position = random.randint(0, new_input_embeds.size(1))
+            left_add = random.randint(0, self.config.pos_skipping_range)
+            right_add = random.randint(left_add, self.config.pos_skipping_range)
+            position_ids[:, :split_position] += left_add
+            position_ids[:, split_position:] += right_add
+        # import pdb; pdb.set_trace()
+        # rank0_print("Finish preparing")
+        return None, position_ids, attention_mask, past_key_values, new_input_embeds, new_labels
+
+    def splice_multimodal_features(self, input_ids, labels, attention_mask, image_features):
+        """
+        Replace the image tokens of every row by the features of its images, row by row. Returns the unpadded embeddings
+        and labels of every row. `splice_multimodal_batched` does the same for the whole batch at once.
+        """
         # remove the padding using attention_mask -- FIXME
-        _input_ids = input_ids
         input_ids = [cur_input_ids[cur_attention_mask] for cur_input_ids, cur_attention_mask in zip(input_ids, attention_mask)]
         labels = [cur_labels[cur_attention_mask] for cur_labels, cur_attention_mask in zip(labels, attention_mask)]
 
@@ -492,17 +713,67 @@ def prepare_inputs_labels_for_multimodal(self, input_ids, position_ids, attentio
             new_input_embeds.append(cur_new_input_embeds)
             new_labels.append(cur_new_labels)
 
-        # Truncate sequences to max length as image embeddings can make the sequence longer
-        tokenizer_model_max_length = getattr(self.config, "tokenizer_model_max_length", None)
-        # rank_print("Finishing Inserting")
-
-        new_input_embeds = [x[:tokenizer_model_max_length] for x, modality in zip(new_input_embeds, modalities)]
-        new_labels = [x[:tokenizer_model_max_length] for x, modality in zip(new_labels, modalities)]
-        # TODO: Hard code for control loss spike
-        # if tokenizer_model_max_length is not None:
-        #     new_input_embeds = [x[:4096] if modality != "video" else x[:tokenizer_model_max_length] for x, modality in zip(new_input_embeds, modalities)]
-        #     new_labels = [x[:4096] if modality != "video" else x[:tokenizer_model_max_length] for x, modality in zip(new_labels, modalities)]
-
+        return new_input_embeds, new_labels
+
+    def splice_multimodal_batched(self, input_ids, labels, attention_mask, position_ids, image_features, max_length=None):
+        """
+        `splice_multimodal_features`, the truncation to `max_length` and `pad_multimodal_sequences` in one pass over the
+        batch. The destination of every token is the cumulative width of the tokens before it in its row (1 for a text
+        token, the number of visual tokens for an image token), the text and image embeddings are then scattered into
+        the preallocated padded batch.
+        """
+        batch_size = input_ids.shape[0]
+        is_image = (input_ids == IMAGE_TOKEN_INDEX) & attention_mask
+        is_text = attention_mask & ~is_image
+
+        # the image features are consumed in order, a row without image token consumes one without splicing it
+        feature_idx, cur_image_idx = [], 0
+        for num_images in is_image.sum(dim=1).tolist():
+            # past the last feature, the last one is repeated like the IndexError fallback of the loop
+            feature_idx.extend(min(idx, len(image_features) - 1) for idx in range(cur_image_idx, cur_image_idx + num_images))
+            cur_image_idx += max(num_images, 1)
+        feature_lens = torch.tensor([image_features[idx].shape[0] for idx in feature_idx], dtype=torch.long, device=input_ids.device)
+
+        widths = is_text.long()
+        widths[is_image] = feature_lens
+        ends = widths.cumsum(dim=1)
+        starts = ends - widths
+        seq_lens = ends[:, -1] if max_length is None else ends[:, -1].clamp(max=max_length)
+        max_len = int(seq_lens.max())
+        if getattr(self.config, "tokenizer_padding_side", "right") == "left":
+            shifts = max_len - seq_lens
+        else:
+            shifts = torch.zeros_like(seq_lens)
+
+        text_embeds = self.get_model().embed_tokens(input_ids[is_text])
+        dtype = text_embeds.dtype if len(image_features) == 0 else torch.promote_types(text_embeds.dtype, image_features[0].dtype)
+        new_input_embeds = torch.zeros((batch_size, max_len, text_embeds.shape[-1]), dtype=dtype, device=self.device)
+        new_labels = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=labels.dtype, device=labels.device)
+
+        text_rows = is_text.nonzero(as_tuple=True)[0]
+        text_dst = starts[is_text]
+        keep = text_dst < seq_lens[text_rows]
+        text_rows, text_dst = text_rows[keep], text_dst[keep] + shifts[text_rows[keep]]
+        new_input_embeds[text_rows, text_dst] = text_embeds[keep].to(device=self.device, dtype=dtype)
+        new_labels[text_rows, text_dst] = labels[is_text][keep]
+
+        if len(feature_idx) > 0:
+            image_rows = is_image.nonzero(as_tuple=True)[0].repeat_interleave(feature_lens)
+            feature_starts = (feature_lens.cumsum(dim=0) - feature_lens).repeat_interleave(feature_lens)
+            image_dst = starts[is_image].repeat_interleave(feature_lens) + torch.arange(len(image_rows), device=image_rows.device) - feature_starts
+            keep = image_dst < seq_lens[image_rows]
+            image_rows, image_dst = image_rows[keep], image_dst[keep] + shifts[image_rows[keep]]
+            features = torch.cat([image_features[idx] for idx in feature_idx]).to(self.device)
+            new_input_embeds[image_rows, image_dst] = features[keep.to(features.device)].to(dtype)
+
+        positions = torch.arange(max_len, device=seq_lens.device)[None] - shifts[:, None]
+        valid = (positions >= 0) & (positions < seq_lens[:, None])
+        attention_mask = valid.to(device=attention_mask.device, dtype=attention_mask.dtype)
+        position_ids = torch.where(valid, positions, 0).to(device=position_ids.device, dtype=position_ids.dtype)
+        return new_input_embeds, new_labels, attention_mask, position_ids
+
+    def pad_multimodal_sequences(self, new_input_embeds, new_labels, attention_mask, position_ids):
+        """Pad the spliced sequences of a batch to the longest one, on the side of tokenizer_padding_side."""
         # Combine them
         max_len = max(x.shape[0] for x in new_input_embeds)
         batch_size = len(new_input_embeds)
@@ -531,28 +802,52 @@ def prepare_inputs_labels_for_multimodal(self, input_ids, position_ids, attentio
         new_input_embeds = torch.stack(new_input_embeds_padded, dim=0)
         # rank0_print("tokenizer padding")
 
-        if _labels is None:
-            new_labels = None
-        else:
-            new_labels = new_labels_padded
-
-        if _attention_mask is None:
-            attention_mask = None
-        else:
-            attention_mask = attention_mask.to(dtype=_attention_mask.dtype)
-
-        if _position_ids is None:
-            position_ids = None
-        if getattr(self.config, "use_pos_skipping", False) and self.training:
-            position_ids = torch.arange(new_input_embeds.size(1), device=new_input_embeds.device).unsqueeze(0).to(new_input_embeds.device)
-            split_position = random.randint(0, new_input_embeds.size(1))
-            left_add = random.randint(0, self.config.pos_skipping_range)
-            right_add = random.randint(left_add, self.config.pos_skipping_range)
-            position_ids[:, :split_position] += left_add
-            position_ids[:, split_position:] += right_add
-        # import pdb; pdb.set_trace()
-        # rank0_print("Finish preparing")
-        return None, position_ids, attention_mask, past_key_values, new_input_embeds, new_labels
+        return new_input_embeds, new_labels_padded, attention_mask, position_ids
+
+    def pack_multimodal_sequences(self, new_input_embeds, new_labels, max_length, past_key_values):
+        """
+        Pack the spliced sequences of a batch into as few rows of at most max_length tokens as possible.
+
+        The returned attention mask holds the segment id of every token (0 for padding), which the patched
+        `_get_unpad_data` in llava/train/packing_flash_attn_monkey_patch.py turns into per-sample cu_seqlens
+        for the varlen flash-attention kernels. Position ids restart at 0 for every sample.
+        """
+        seq_lens = [x.shape[0] for x in new_input_embeds]
+        max_length = max_length or sum(seq_lens)
+
+        # first-fit decreasing
+        rows, row_lens = [], []
+        for idx in sorted(range(len(seq_lens)), key=lambda i: seq_lens[i], reverse=True):
+            for row_idx in range(len(rows)):
+                if row_lens[row_idx] + seq_lens[idx] <= max_length:
+                    rows[row_idx].append(idx)
+                    row_lens[row_idx] += seq_lens[idx]
+                    break
+            else:
+                rows.append([idx])
+                row_lens.append(seq_lens[idx])
+
+        # transformers only hands a 2D mask to flash-attention if it contains padding, so keep at least one pad token
+        max_len = max(row_lens) + 1 if len(set(row_lens)) == 1 else max(row_lens)
+        embed_dim = new_input_embeds[0].shape[1]
+        device = new_input_embeds[0].device
+
+        packed_embeds, packed_labels, segment_ids, position_ids = [], [], [], []
+        for row, row_len in zip(rows, row_lens):
+            cur_labels = []
+            for idx in row:
+                cur_sample_labels = new_labels[idx].clone()
+                if cur_sample_labels.shape[0] > 0:
+                    # the last token of the previous sample must not be trained to predict the first token of this one
+                    cur_sample_labels[0] = IGNORE_INDEX
+                cur_labels.append(cur_sample_labels)
+            num_pad = max_len - row_len
+            packed_embeds.append(torch.cat([new_input_embeds[idx] for idx in row] + [torch.zeros((num_pad, embed_dim), dtype=new_input_embeds[0].dtype, device=device)], dim=0))
+            packed_labels.append(torch.cat(cur_labels + [torch.full((num_pad,), IGNORE_INDEX, dtype=new_labels[0].dtype, device=device)], dim=0))
+            segment_ids.append(torch.cat([torch.full((seq_lens[idx],), segment_idx + 1, dtype=torch.int32, device=device) for segment_idx, idx in enumerate(row)] + [torch.zeros((num_pad,), dtype=torch.int32, device=device)], dim=0))
+            position_ids.append(torch.cat([torch.arange(seq_lens[idx], dtype=torch.long, device=device) for idx in row] + [torch.zeros((num_pad,), dtype=torch.long, device=device)], dim=0))
+
+        return None, torch.stack(position_ids, dim=0), torch.stack(segment_ids, dim=0), past_key_values, torch.stack(packed_embeds, dim=0), torch.stack(packed_labels, dim=0)
 
     def initialize_vision_tokenizer(self, model_args, tokenizer):
         if model_args.mm_use_im_patch_token:
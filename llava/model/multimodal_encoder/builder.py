@@ -16,7 +16,7 @@ def build_vision_tower(vision_tower_cfg, **kwargs):
     assert vision_tower is not None
     vision_tower_raw = vision_tower.split('/')[-1] if (is_absolute_path_exists := os.path.exists(vision_tower)) else vision_tower
     use_s2 = getattr(vision_tower_cfg, "s2", False)
-    iif "clip" in vision_tower_raw or (vision_tower_raw.startswith("openai") or vision_tower_raw.startswith("laion") or "ShareGPT4V" in vision_tower_raw):
+    if "clip" in vision_tower_raw or (vision_tower_raw.startswith("openai") or vision_tower_raw.startswith("laion") or "ShareGPT4V" in vision_tower_raw):
         if use_s2:
             return CLIPVisionTowerS2(vision_tower, args=vision_tower_cfg, **kwargs)
         else:
@@ -67,11 +67,16 @@ def feature_select(self, image_forward_outs):
 
     def forward(self, images):
         if type(images) is list:
-            image_features = []
-            for image in images:
-                image_forward_out = self.vision_tower(image.to(device=self.device, dtype=self.dtype).unsqueeze(0), output_hidden_states=True)
-                image_feature = self.feature_select(image_forward_out).to(image.dtype)
-                image_features.append(image_feature)
+            # one forward per resolution instead of one per image
+            image_features = [None] * len(images)
+            buckets = {}
+            for idx, image in enumerate(images):
+                buckets.setdefault(tuple(image.shape), []).append(idx)
+            for bucket in buckets.values():
+                image_forward_outs = self.vision_tower(torch.stack([images[idx] for idx in bucket]).to(device=self.device, dtype=self.dtype), output_hidden_states=True)
+                bucket_features = self.feature_select(image_forward_outs)
+                for idx, image_feature in zip(bucket, bucket_features):
+                    image_features[idx] = image_feature.unsqueeze(0).to(images[idx].dtype)
         else:
             image_forward_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
             image_features = self.feature_select(image_forward_outs).to(images.dtype)
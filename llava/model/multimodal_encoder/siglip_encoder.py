@@ -575,12 +575,17 @@ def load_model(self, device_map=None):
 
     def forward(self, images):
         if type(images) is list:
-            image_features = []
-            for image in images:
-                image_forward_out = self.vision_tower(image.to(device=self.device, dtype=self.dtype).unsqueeze(0), output_hidden_states=True)
-                image_feature = image_forward_out.hidden_states[-1].to(image.dtype)
-                assert image_features.shape[-2] == 729
-                image_features.append(image_feature)
+            # one forward per resolution instead of one per image
+            image_features = [None] * len(images)
+            buckets = {}
+            for idx, image in enumerate(images):
+                buckets.setdefault(tuple(image.shape), []).append(idx)
+            for bucket in buckets.values():
+                image_forward_outs = self.vision_tower(torch.stack([images[idx] for idx in bucket]).to(device=self.device, dtype=self.dtype), output_hidden_states=True)
+                bucket_features = image_forward_outs.hidden_states[-1]
+                assert bucket_features.shape[-2] == 729
+                for idx, image_feature in zip(bucket, bucket_features):
+                    image_features[idx] = image_feature.unsqueeze(0).to(images[idx].dtype)
         else:
             image_forward_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
             image_features = image_forward_outs.hidden_states[-1].to(images.dtype)
@@ -0,0 +1,120 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class TokenMerge(nn.Module):
+    """
+    Content-based reduction of the projected visual tokens of every image and video before they are spliced into the
+    language model input, so that prefill and KV cache scale with the kept tokens.
+
+    Modes:
+        merge: bipartite soft matching (ToMe). The tokens are split into alternating sets, every token of the first set
+            is matched with its most similar token (cosine) of the second set, and the most similar pairs are averaged,
+            weighted by the number of tokens they already hold. Repeated until the target ratio is reached.
+        prune: the tokens with the highest attention score of the mean token, softmax(mean . x / sqrt(d)), are kept.
+
+    The kept tokens stay in their original order. The ratios are the fraction of tokens kept per modality, 1.0 keeps
+    all of them.
+
+    `segment_ids` gives every token of a feature a segment: the tokens of a segment are only merged with, or ranked
+    against, each other, and tokens of segment -1 (the newline tokens that lay out the rows and frames) are kept as
+    they are.
+    """
+
+    def __init__(self, model_args, *args, **kwargs):
+        super().__init__()
+
+        self.mode = getattr(model_args, "mm_token_merge_mode", "merge")
+        self.image_ratio = getattr(model_args, "mm_token_merge_image_ratio", 1.0)
+        self.video_ratio = getattr(model_args, "mm_token_merge_video_ratio", 1.0)
+        if self.mode not in ["merge", "prune"]:
+            raise ValueError(f"Unexpected token merge mode: {self.mode}")
+        for ratio in [self.image_ratio, self.video_ratio]:
+            if not 0 < ratio <= 1:
+                raise ValueError(f"Token merge ratios must be in (0, 1], got {ratio}")
+
+    def forward(self, image_features, modalities=None, segment_ids=None, *args, **kwargs):
+        if modalities is None:
+            modalities = ["image"] * len(image_features)
+        reduced_features = []
+        for idx, image_feature in enumerate(image_features):
+            modality = modalities[idx] if idx < len(modalities) else modalities[-1]
+            ratio = self.video_ratio if modality == "video" else self.image_ratio
+            if segment_ids is None or segment_ids[idx] is None:
+                reduced_features.append(self.reduce_tokens(image_feature, ratio)[0])
+                continue
+
+            tokens, positions = [], []
+            for segment_id in segment_ids[idx].unique().tolist():
+                segment = (segment_ids[idx] == segment_id).nonzero().squeeze(1)
+                if segment_id < 0:
+                    tokens.append(image_feature[segment])
+                    positions.append(segment)
+                else:
+                    reduced, kept = self.reduce_tokens(image_feature[segment], ratio)
+                    tokens.append(reduced)
+                    positions.append(segment[kept])
+            reduced_features.append(torch.cat(tokens)[torch.cat(positions).argsort()])
+        return reduced_features
+
+    def reduce_tokens(self, x, ratio):
+        """The tokens of x (N, D) reduced to `ratio` of them, and the position in x of every reduced token."""
+        num_keep = max(int(round(x.shape[0] * ratio)), 1)
+        if num_keep >= x.shape[0]:
+            return x, torch.arange(x.shape[0], device=x.device)
+        if self.mode == "merge":
+            return self.merge_tokens(x, num_keep)
+        return self.prune_tokens(x, num_keep)
+
+    @staticmethod
+    def prune_tokens(x, num_keep):
+        """Keep the `num_keep` tokens of x (N, D) the mean token attends to the most, returns them and their positions."""
+        scores = (x.mean(dim=0, keepdim=True) @ x.transpose(0, 1)).squeeze(0) / math.sqrt(x.shape[-1])
+        keep = scores.float().softmax(dim=-1).topk(num_keep).indices.sort().values
+        return x[keep], keep
+
+    @staticmethod
+    def merge_tokens(x, num_keep):
+        """
+        Merge the tokens of x (N, D) down to `num_keep` tokens with repeated bipartite soft matching, returns them and
+        their positions (a merged token takes the position of the token of the second set it was merged into).
+        """
+        positions = torch.arange(x.shape[0], device=x.device)
+        sizes = torch.ones(x.shape[0], 1, device=x.device, dtype=torch.float32)
+        merged = x.float()
+        while merged.shape[0] > num_keep:
+            src, dst = merged[::2], merged[1::2]
+            src_sizes, dst_sizes = sizes[::2], sizes[1::2]
+            src_positions, dst_positions = positions[::2], positions[1::2]
+            # at most the whole first set is merged in one round
+            num_merge = min(merged.shape[0] - num_keep, src.shape[0])
+
+            similarity = F.normalize(src, dim=-1) @ F.normalize(dst, dim=-1).transpose(0, 1)
+            best_similarity, best_dst = similarity.max(dim=-1)
+            order = best_similarity.argsort(descending=True)
+            merged_src, kept_src = order[:num_merge], order[num_merge:]
+
+            # size weighted average of every dst token with the src tokens merged into it
+            dst = dst * dst_sizes
+            dst = dst.index_add(0, best_dst[merged_src], src[merged_src] * src_sizes[merged_src])
+            dst_sizes = dst_sizes.index_add(0, best_dst[merged_src], src_sizes[merged_src])
+            dst = dst / dst_sizes
+
+            merged = torch.cat((src[kept_src], dst), dim=0)
+            sizes = torch.cat((src_sizes[kept_src], dst_sizes), dim=0)
+            positions = torch.cat((src_positions[kept_src], dst_positions), dim=0)
+            order = positions.argsort()
+            merged, sizes, positions = merged[order], sizes[order], positions[order]
+        return merged.to(x.dtype), positions
+
+    @property
+    def config(self):
+        return {
+            "mm_resampler_type": "token_merge",
+            "mm_token_merge_mode": self.mode,
+            "mm_token_merge_image_ratio": self.image_ratio,
+            "mm_token_merge_video_ratio": self.video_ratio,
+        }
@@ -0,0 +1,229 @@
+import array
+import collections
+import json
+import math
+import os
+import random
+import re
+
+import yaml
+
+from llava.utils import rank0_print
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def parse_sampling_strategy(sampling_strategy):
+    """Split a yaml ``sampling_strategy`` such as ``first:1000``, ``random:10%`` or ``all`` into (strategy, number, is_percent)."""
+    if ":" not in sampling_strategy:
+        return sampling_strategy, None, False
+    sampling_strategy, sampling_number = sampling_strategy.split(":")
+    if "%" in sampling_number:
+        return sampling_strategy, int(sampling_number.split("%")[0]), True
+    return sampling_strategy, int(sampling_number), False
+
+
+def _iter_jsonl_lines(json_path):
+    with open(json_path, "rb") as json_file:
+        for line in json_file:
+            if line.strip():
+                yield line
+
+
+def _count_jsonl_lines(json_path):
+    return sum(1 for _ in _iter_jsonl_lines(json_path))
+
+
+def _index_jsonl_lines(json_path):
+    """Return the byte offsets of the non-empty lines of ``json_path`` in one sequential read."""
+    offsets = array.array("q")
+    position = 0
+    with open(json_path, "rb") as json_file:
+        for line in json_file:
+            if line.strip():
+                offsets.append(position)
+            position += len(line)
+    return offsets
+
+
+def _sample_jsonl_lines(json_path, sampling_number, is_percent):
+    """``random`` sampling of a .jsonl file: index the line offsets in one pass, then seek to and parse only the drawn lines."""
+    offsets = _index_jsonl_lines(json_path)
+    if is_percent:
+        sampling_number = math.ceil(sampling_number * len(offsets) / 100)
+    selected = random.sample(range(len(offsets)), min(sampling_number, len(offsets)))
+    samples = []
+    with open(json_path, "rb") as json_file:
+        for line_idx in sorted(selected):
+            json_file.seek(offsets[line_idx])
+            samples.append(json.loads(json_file.readline()))
+    random.shuffle(samples)
+    return samples
+
+
+def _read_last_jsonl_lines(json_path, num_lines, block_size=1 << 20):
+    """Return the last ``num_lines`` non-empty lines of ``json_path`` by reading it backwards from the end."""
+    blocks = []
+    num_found = 0
+    remainder = b""
+    with open(json_path, "rb") as json_file:
+        json_file.seek(0, os.SEEK_END)
+        position = json_file.tell()
+        while position > 0 and num_found < num_lines:
+            read_size = min(block_size, position)
+            position -= read_size
+            json_file.seek(position)
+            parts = (json_file.read(read_size) + remainder).split(b"\n")
+            # the first part may be the tail of a line that starts in the previous block
+            remainder = parts[0]
+            lines = [line for line in parts[1:] if line.strip()]
+            blocks.append(lines)
+            num_found += len(lines)
+    if remainder.strip():
+        blocks.append([remainder])
+    lines = [line for block in reversed(blocks) for line in block]
+    return lines[-num_lines:] if num_lines > 0 else []
+
+
+def _load_jsonl_samples(json_path, sampling_strategy, sampling_number):
+    if sampling_strategy == "first" and sampling_number is not None:
+        samples = []
+        for line in _iter_jsonl_lines(json_path):
+            if len(samples) >= sampling_number:
+                break
+            samples.append(json.loads(line))
+        return samples
+    elif sampling_strategy == "end" and sampling_number is not None:
+        return [json.loads(line) for line in _read_last_jsonl_lines(json_path, sampling_number)]
+    elif sampling_strategy == "random" and sampling_number is not None:
+        return _sample_jsonl_lines(json_path, sampling_number, False)
+    return [json.loads(line) for line in _iter_jsonl_lines(json_path)]
+
+
+def _load_json_array_samples(json_path, sampling_strategy, sampling_number):
+    if ijson is None:
+        if sampling_strategy in ("first", "end", "random") and sampling_number is not None:
+            rank0_print(f"Warning: ijson is not installed, loading the whole json array {json_path} to sample it. Install the train extras (pip install -e \".[train]\") to stream it")
+        with open(json_path, "r") as json_file:
+            samples = json.load(json_file)
+        if sampling_strategy == "first" and sampling_number is not None:
+            return samples[:sampling_number]
+        elif sampling_strategy == "end" and sampling_number is not None:
+            return samples[-sampling_number:] if sampling_number > 0 else []
+        elif sampling_strategy == "random" and sampling_number is not None:
+            random.shuffle(samples)
+            return samples[:sampling_number]
+        return samples
+
+    # a json array can not be seeked into, but ijson parses it incrementally so only the kept items stay in memory
+    with open(json_path, "rb") as json_file:
+        items = ijson.items(json_file, "item", use_float=True)
+        if sampling_strategy == "first" and sampling_number is not None:
+            samples = []
+            for item in items:
+                if len(samples) >= sampling_number:
+                    break
+                samples.append(item)
+            return samples
+        elif sampling_strategy == "end" and sampling_number is not None:
+            samples = collections.deque(maxlen=sampling_number)
+            samples.extend(items)
+            return list(samples) if sampling_number > 0 else []
+        elif sampling_strategy == "random" and sampling_number is not None:
+            # reservoir sampling
+            samples = []
+            for item_idx, item in enumerate(items):
+                if len(samples) < sampling_number:
+                    samples.append(item)
+                else:
+                    replace_idx = random.randint(0, item_idx)
+                    if replace_idx < sampling_number:
+                        samples[replace_idx] = item
+            random.shuffle(samples)
+            return samples
+        return list(items)
+
+
+def _count_json_array_items(json_path):
+    if ijson is None:
+        with open(json_path, "r") as json_file:
+            return len(json.load(json_file))
+    with open(json_path, "rb") as json_file:
+        return sum(1 for _ in ijson.items(json_file, "item"))
+
+
+def load_json_samples(json_path, sampling_strategy="all"):
+    """Load the samples of a .jsonl or json array manifest, applying a yaml ``sampling_strategy`` while streaming.
+
+    For .jsonl files ``first`` stops reading after the kept rows, ``end`` reads the file backwards from the end
+    and ``random`` indexes the line offsets in a single pass and seeks to the drawn lines, so only the kept rows
+    are ever parsed. The other percentages need the number of rows, which is counted without parsing.
+    """
+    sampling_strategy, sampling_number, is_percent = parse_sampling_strategy(sampling_strategy)
+    if json_path.endswith(".jsonl"):
+        if sampling_strategy == "random" and sampling_number is not None:
+            return _sample_jsonl_lines(json_path, sampling_number, is_percent)
+        if is_percent:
+            sampling_number = math.ceil(sampling_number * _count_jsonl_lines(json_path) / 100)
+        return _load_jsonl_samples(json_path, sampling_strategy, sampling_number)
+    if is_percent:
+        sampling_number = math.ceil(sampling_number * _count_json_array_items(json_path) / 100)
+    return _load_json_array_samples(json_path, sampling_strategy, sampling_number)
+
+
+def load_data_dicts(data_path):
+    """Load the training manifest(s) referenced by ``data_path``.
+
+    ``data_path`` can be a single json/jsonl file, a ``/path/to/{a,b,c}.json`` pattern or a yaml file listing
+    ``json_path`` / ``sampling_strategy`` entries. Returns the list of samples and the list of manifest paths.
+    """
+    list_data_dict = []
+
+    # Handle multiple JSON files specified in the data_path
+    if "{" in data_path and "}" in data_path:
+        base_path, file_pattern = re.match(r"^(.*)\{(.*)\}\.json$", data_path).groups()
+        file_names = file_pattern.split(",")
+        rank0_print(f"Loading {file_names} from {base_path}")
+        dataset_paths = []
+        for file_name in file_names:
+            dataset_paths.append(f"{base_path}{file_name}.json")
+            full_path = f"{base_path}{file_name}.json"
+            rank0_print(f"Loading {full_path}")
+            cur_data_dict = load_json_samples(full_path)
+            rank0_print(f"Loaded {len(cur_data_dict)} samples from {full_path}")
+            list_data_dict.extend(cur_data_dict)
+    elif data_path.endswith(".yaml"):
+        with open(data_path, "r") as file:
+            yaml_data = yaml.safe_load(file)
+            datasets = yaml_data.get("datasets")
+            # file should be in the format of:
+            # datasets:
+            #   - json_path: xxxx1.json
+            #     sampling_strategy: first:1000
+            #   - json_path: xxxx2.json
+            #     sampling_strategy: end:3000
+            #   - json_path: xxxx3.json
+            #     sampling_strategy: random:999
+            dataset_paths = [dataset.get("json_path") for dataset in datasets]
+            for dataset in datasets:
+                json_path = dataset.get("json_path")
+                sampling_strategy = dataset.get("sampling_strategy", "all")
+
+                if not json_path.endswith((".json", ".jsonl")):
+                    raise ValueError(f"Unsupported file type: {json_path}")
+
+                rank0_print(f"Loading {json_path} with {sampling_strategy} sampling strategy")
+                cur_data_dict = load_json_samples(json_path, sampling_strategy)
+                rank0_print(f"Loaded {len(cur_data_dict)} samples from {json_path}")
+                list_data_dict.extend(cur_data_dict)
+    else:
+        dataset_paths = [data_path]
+        rank0_print(f"Loading {data_path}")
+        cur_data_dict = load_json_samples(data_path)
+        rank0_print(f"Loaded {len(cur_data_dict)} samples from {data_path}")
+        list_data_dict.extend(cur_data_dict)
+
+    return list_data_dict, dataset_paths
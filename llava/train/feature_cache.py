@@ -0,0 +1,272 @@
+"""Offline cache of vision tower features for stages that keep the vision tower frozen.
+
+When only the projector (and possibly the language model) is trained, the vision tower produces exactly the same
+features for an image in every epoch. ``build_feature_cache`` runs the frozen tower once over every image of a
+manifest and stores the patch features of every tile in sharded flat files:
+
+    meta.json               vision tower, feature shape and storage dtype
+    index_<part>.json       image key -> [shard, first row, number of tiles, width, height]
+    <part>_<shard>.bin      features, one row of ``hidden_size`` values per patch token
+    <part>_<shard>.scale    float16 per-row scales, only for the int8 storage dtype
+
+``VisualFeatureCache`` memory-maps the shards. ``LazySupervisedDataset`` returns the cached features instead of
+pixels on a cache hit (with the "image_feature" modality), and ``prepare_inputs_labels_for_multimodal`` sends those
+straight to the projector, skipping both the image decode and the vision tower.
+
+Usage (one process per GPU, each writing its own part):
+    python -m llava.train.feature_cache --data_path data.yaml --image_folder /path/to/images \
+        --vision_tower google/siglip-so400m-patch14-384 --image_aspect_ratio anyres_max_9 \
+        --image_grid_pinpoints "(1x1),...,(6x6)" --output_dir /path/to/feature_cache --num_chunks 8 --chunk_idx 0
+"""
+
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+from PIL import Image, ImageFile
+
+from llava.mm_utils import expand2square, process_anyres_image
+from llava.train.data_utils import load_data_dicts
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+FEATURE_CACHE_VERSION = 1
+FEATURE_CACHE_DTYPES = ["float16", "bfloat16", "int8"]
+
+
+def get_feature_cache_key(image_file, image_aspect_ratio):
+    return f"{image_aspect_ratio}/{image_file}"
+
+
+class FeatureCacheWriter:
+    def __init__(self, cache_dir, num_patches, hidden_size, dtype="float16", part="0", shard_size=4 << 30, meta=None):
+        assert dtype in FEATURE_CACHE_DTYPES, f"dtype should be one of {FEATURE_CACHE_DTYPES}"
+        self.cache_dir = cache_dir
+        self.num_patches = num_patches
+        self.hidden_size = hidden_size
+        self.dtype = dtype
+        self.part = part
+        self.shard_size = shard_size
+        self.meta = dict(meta or {}, version=FEATURE_CACHE_VERSION, num_patches=num_patches, hidden_size=hidden_size, dtype=dtype)
+        self.index = {}
+        self.shard_idx = -1
+        self.shard_rows = 0
+        self.shard_file = None
+        self.scale_file = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _next_shard(self):
+        self.close_shard()
+        self.shard_idx += 1
+        self.shard_rows = 0
+        shard_name = f"{self.part}_{self.shard_idx:05d}"
+        self.shard_file = open(os.path.join(self.cache_dir, f"{shard_name}.bin"), "wb")
+        if self.dtype == "int8":
+            self.scale_file = open(os.path.join(self.cache_dir, f"{shard_name}.scale"), "wb")
+
+    def close_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+        if self.scale_file is not None:
+            self.scale_file.close()
+            self.scale_file = None
+
+    def add(self, key, features, image_size):
+        """Store ``features`` of shape (num_tiles, num_patches, hidden_size) for ``key``."""
+        num_tiles, num_patches, hidden_size = features.shape
+        assert num_patches == self.num_patches and hidden_size == self.hidden_size, f"Unexpected feature shape {tuple(features.shape)}"
+        features = features.detach().reshape(-1, hidden_size).cpu()
+
+        row_bytes = hidden_size * (1 if self.dtype == "int8" else 2)
+        if self.shard_file is None or (self.shard_rows + features.shape[0]) * row_bytes > self.shard_size:
+            self._next_shard()
+
+        if self.dtype == "float16":
+            self.shard_file.write(features.to(torch.float16).numpy().tobytes())
+        elif self.dtype == "bfloat16":
+            # numpy has no bfloat16, store the raw bits
+            self.shard_file.write(features.to(torch.bfloat16).view(torch.int16).numpy().tobytes())
+        else:
+            # symmetric per-token quantization
+            features = features.float()
+            scales = (features.abs().amax(dim=-1, keepdim=True) / 127.0).clamp(min=1e-8)
+            quantized = torch.round(features / scales).clamp(-127, 127).to(torch.int8)
+            self.shard_file.write(quantized.numpy().tobytes())
+            self.scale_file.write(scales.to(torch.float16).numpy().tobytes())
+
+        self.index[key] = [f"{self.part}_{self.shard_idx:05d}", self.shard_rows, num_tiles, image_size[0], image_size[1]]
+        self.shard_rows += features.shape[0]
+
+    def close(self):
+        self.close_shard()
+        with open(os.path.join(self.cache_dir, f"index_{self.part}.json"), "w") as f:
+            json.dump(self.index, f)
+        with open(os.path.join(self.cache_dir, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+
+class VisualFeatureCache:
+    """Read-only access to a feature cache written by ``FeatureCacheWriter``."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != FEATURE_CACHE_VERSION:
+            raise ValueError(f"Unsupported feature cache version {self.meta.get('version')} in {cache_dir}, please rebuild it.")
+        self.num_patches = self.meta["num_patches"]
+        self.hidden_size = self.meta["hidden_size"]
+        self.dtype = self.meta["dtype"]
+        self.index = {}
+        for index_file in sorted(glob.glob(os.path.join(cache_dir, "index_*.json"))):
+            with open(index_file, "r") as f:
+                self.index.update(json.load(f))
+        self._shards = {}
+
+    def __getstate__(self):
+        # memory maps are re-opened lazily in the receiving process
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def _get_shard(self, shard_name):
+        if shard_name not in self._shards:
+            np_dtype = {"float16": np.float16, "bfloat16": np.int16, "int8": np.int8}[self.dtype]
+            features = np.memmap(os.path.join(self.cache_dir, f"{shard_name}.bin"), dtype=np_dtype, mode="r").reshape(-1, self.hidden_size)
+            scales = None
+            if self.dtype == "int8":
+                scales = np.memmap(os.path.join(self.cache_dir, f"{shard_name}.scale"), dtype=np.float16, mode="r").reshape(-1, 1)
+            self._shards[shard_name] = (features, scales)
+        return self._shards[shard_name]
+
+    def get(self, key):
+        """Return (features of shape (num_tiles, num_patches, hidden_size), image size) for ``key``, or None on a miss."""
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        shard_name, start, num_tiles, width, height = entry
+        end = start + num_tiles * self.num_patches
+        features, scales = self._get_shard(shard_name)
+        if self.dtype == "float16":
+            tensor = torch.from_numpy(np.array(features[start:end]))
+        elif self.dtype == "bfloat16":
+            tensor = torch.from_numpy(np.array(features[start:end])).view(torch.bfloat16)
+        else:
+            tensor = (torch.from_numpy(np.array(features[start:end])).float() * torch.from_numpy(np.array(scales[start:end])).float()).to(torch.float16)
+        return tensor.view(num_tiles, self.num_patches, self.hidden_size), (width, height)
+
+    def dummy_feature(self):
+        return torch.zeros(1, self.num_patches, self.hidden_size, dtype=torch.bfloat16 if self.dtype == "bfloat16" else torch.float16)
+
+
+class _FeatureCacheImageDataset(torch.utils.data.Dataset):
+    def __init__(self, items, image_folder, image_processor, image_grid_pinpoints):
+        self.items = items
+        self.image_folder = image_folder
+        self.image_processor = image_processor
+        self.image_grid_pinpoints = image_grid_pinpoints
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        image_aspect_ratio, image_file = self.items[i]
+        processor = self.image_processor
+        try:
+            image = Image.open(os.path.join(self.image_folder, image_file)).convert("RGB")
+        except Exception as e:
+            print(f"Failed to open image {image_file}. Exception:", e)
+            return None
+        image_size = image.size
+        if image_aspect_ratio == "anyres" or "anyres_max" in image_aspect_ratio:
+            pixel_values = process_anyres_image(image, processor, self.image_grid_pinpoints)
+        elif image_aspect_ratio == "pad":
+            image = expand2square(image, tuple(int(x * 255) for x in processor.image_mean))
+            pixel_values = processor.preprocess(image, return_tensors="pt")["pixel_values"]
+        else:
+            pixel_values = processor.preprocess(image, return_tensors="pt")["pixel_values"]
+        return get_feature_cache_key(image_file, image_aspect_ratio), pixel_values, image_size
+
+
+def collect_feature_cache_items(list_data_dict, image_aspect_ratio):
+    """Unique (image_aspect_ratio, image_file) pairs of a manifest, processed the same way as LazySupervisedDataset."""
+    items = set()
+    for sample in list_data_dict:
+        if "image" not in sample:
+            continue
+        image_files = sample["image"] if type(sample["image"]) is list else [sample["image"]]
+        # multi images are processed with simple pad
+        cur_aspect_ratio = "pad" if len(image_files) > 1 else image_aspect_ratio
+        for image_file in image_files:
+            items.add((cur_aspect_ratio, image_file))
+    return sorted(items)
+
+
+@torch.no_grad()
+def build_feature_cache(args):
+    from llava.model.multimodal_encoder.builder import build_vision_tower
+
+    if args.image_aspect_ratio in ["highres", "crop_split"]:
+        raise ValueError(f"image_aspect_ratio {args.image_aspect_ratio} is not supported by the feature cache")
+
+    list_data_dict, _ = load_data_dicts(args.data_path)
+    items = collect_feature_cache_items(list_data_dict, args.image_aspect_ratio)[args.chunk_idx :: args.num_chunks]
+    print(f"Caching features of {len(items)} images into {args.output_dir}")
+
+    vision_tower = build_vision_tower(args)
+    vision_tower.to(device=args.device, dtype=torch.bfloat16 if args.dtype == "bfloat16" else torch.float16)
+    vision_tower.eval()
+
+    dataset = _FeatureCacheImageDataset(items, args.image_folder, vision_tower.image_processor, args.image_grid_pinpoints)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=lambda batch: [x for x in batch if x is not None])
+
+    meta = dict(vision_tower=args.vision_tower, mm_vision_select_layer=args.mm_vision_select_layer, mm_vision_select_feature=args.mm_vision_select_feature, image_grid_pinpoints=args.image_grid_pinpoints)
+    writer = FeatureCacheWriter(args.output_dir, vision_tower.num_patches, vision_tower.hidden_size, dtype=args.dtype, part=str(args.chunk_idx), shard_size=int(args.shard_size_gb * (1 << 30)), meta=meta)
+    for batch_idx, batch in enumerate(loader):
+        if len(batch) == 0:
+            continue
+        pixel_values = torch.cat([x[1] for x in batch], dim=0)
+        features = vision_tower(pixel_values.to(device=args.device, dtype=vision_tower.dtype))
+        features = torch.split(features, [x[1].shape[0] for x in batch])
+        for (key, _, image_size), feature in zip(batch, features):
+            writer.add(key, feature, image_size)
+        if batch_idx % 100 == 0:
+            print(f"Cached {len(writer.index)}/{len(items)} images")
+    writer.close()
+    print(f"Cached {len(writer.index)} images into {args.output_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a frozen vision tower once over a manifest and cache the image features.")
+    parser.add_argument("--data_path", type=str, required=True, help="Same as --data_path of train.py")
+    parser.add_argument("--image_folder", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--vision_tower", type=str, required=True)
+    parser.add_argument("--mm_vision_select_layer", type=int, default=-2)
+    parser.add_argument("--mm_vision_select_feature", type=str, default="patch")
+    parser.add_argument("--image_aspect_ratio", type=str, default="square")
+    parser.add_argument("--image_grid_pinpoints", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default="float16", choices=FEATURE_CACHE_DTYPES)
+    parser.add_argument("--batch_size", type=int, default=16, help="Number of images per forward pass")
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--shard_size_gb", type=float, default=4.0)
+    parser.add_argument("--num_chunks", type=int, default=1)
+    parser.add_argument("--chunk_idx", type=int, default=0)
+    parser.add_argument("--device", type=str, default="cuda")
+    args = parser.parse_args()
+
+    build_feature_cache(args)
+
+
+if __name__ == "__main__":
+    main()
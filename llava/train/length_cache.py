@@ -0,0 +1,113 @@
+"""Persistent cache of exact per-sample token lengths.
+
+The length-grouped samplers only need one integer per sample, but the exact value (text tokens after the
+conversation template plus the visual tokens spliced in by the model) is expensive: it tokenizes every
+conversation and reads every image header. The lengths are computed once in a process pool, stored next to
+the modality of every sample under a key that covers the manifests, the tokenizer and every setting that
+changes the visual token count, and reloaded by all later runs.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from llava.utils import build_on_main_process, rank0_print
+
+LENGTH_CACHE_VERSION = 1
+
+_length_fn = None
+
+
+def _file_fingerprint(path):
+    if path is None or not os.path.exists(path):
+        return [path]
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def get_dataset_key(data_path, dataset_paths, list_data_dict):
+    """Hash the manifests and the selected samples into a key that identifies what every sample index refers to."""
+    key = hashlib.sha1()
+    for path in [data_path] + list(dataset_paths or []):
+        key.update(json.dumps(_file_fingerprint(path)).encode())
+    key.update(str(len(list_data_dict)).encode())
+    if isinstance(list_data_dict, list):
+        # yaml sampling selects a different subset on every load, so the selected samples are part of the key. Their
+        # content is hashed, ids are missing or repeated in many manifests
+        for sample in list_data_dict:
+            key.update(json.dumps(sample, sort_keys=True, default=str).encode())
+            key.update(b"\n")
+    return key.hexdigest()
+
+
+def get_length_cache_key(dataset_key, tokenizer, settings):
+    """Hash the ``get_dataset_key`` of the samples, the tokenizer and the length relevant ``settings`` into a cache key."""
+    key = hashlib.sha1()
+    key.update(str(LENGTH_CACHE_VERSION).encode())
+    key.update(dataset_key.encode())
+    key.update(json.dumps([type(tokenizer).__name__, tokenizer.name_or_path, len(tokenizer), tokenizer.model_max_length]).encode())
+    key.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return key.hexdigest()
+
+
+def _compute_length_chunk(chunk):
+    start, end = chunk
+    return [_length_fn(i) for i in range(start, end)]
+
+
+def compute_lengths_parallel(length_fn, num_samples, num_proc=None, chunk_size=1000):
+    """Evaluate ``length_fn(i) -> (length, modality)`` for every sample with a forked process pool."""
+    global _length_fn
+    _length_fn = length_fn
+    num_proc = num_proc or os.cpu_count()
+    chunks = [(start, min(start + chunk_size, num_samples)) for start in range(0, num_samples, chunk_size)]
+
+    lengths = np.zeros(num_samples, dtype=np.int32)
+    modality = np.zeros(num_samples, dtype=np.uint8)
+    start_time = time.time()
+
+    def _collect(results):
+        for chunk_idx, ((start, end), chunk_results) in enumerate(zip(chunks, results)):
+            for i, (length, sample_modality) in zip(range(start, end), chunk_results):
+                lengths[i] = length
+                modality[i] = sample_modality
+            if (chunk_idx + 1) % max(len(chunks) // 10, 1) == 0:
+                rank0_print(f"Computed token lengths for {end}/{num_samples} samples in {time.time() - start_time:.1f}s")
+
+    if num_proc <= 1 or len(chunks) <= 1:
+        _collect(map(_compute_length_chunk, chunks))
+    else:
+        # fork so that the workers inherit the dataset and the tokenizer instead of pickling them
+        with multiprocessing.get_context("fork").Pool(num_proc) as pool:
+            _collect(pool.imap(_compute_length_chunk, chunks))
+    _length_fn = None
+    return lengths, modality
+
+
+def load_or_compute_lengths(cache_dir, cache_key, length_fn, num_samples, num_proc=None, poll_interval=10):
+    """Load the cached lengths for ``cache_key``, computing them on the main process if they are missing.
+
+    The other processes wait for the cache file instead of computing it again, see ``build_on_main_process``.
+    """
+    cache_path = os.path.join(cache_dir, f"token_lengths_{cache_key}.npz")
+
+    def _compute():
+        rank0_print(f"Token length cache {cache_path} not found, computing it with {num_proc or os.cpu_count()} processes")
+        lengths, modality = compute_lengths_parallel(length_fn, num_samples, num_proc=num_proc)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, lengths=lengths, modality=modality)
+        os.replace(tmp_path, cache_path)
+
+    build_on_main_process(_compute, cache_path, poll_interval=poll_interval)
+
+    cache = np.load(cache_path)
+    lengths, modality = cache["lengths"], cache["modality"]
+    if len(lengths) != num_samples:
+        raise ValueError(f"Token length cache {cache_path} has {len(lengths)} entries, expected {num_samples}")
+    rank0_print(f"Loaded token lengths of {num_samples} samples from {cache_path}")
+    return lengths, modality
@@ -1,4 +1,7 @@
+import heapq
+import json
 import os
+import numpy as np
 import torch
 import torch.nn as nn
 import datetime
@@ -12,8 +15,7 @@
 
 from transformers import Trainer
 from transformers.trainer import is_sagemaker_mp_enabled, get_parameter_names, has_length, ALL_LAYERNORM_LAYERS, logger, is_accelerate_available, is_datasets_available, GradientAccumulationPlugin
-from transformers.trainer_utils import seed_worker
-from transformers.trainer_pt_utils import get_length_grouped_indices as get_length_grouped_indices_hf
+from transformers.trainer_utils import seed_worker, get_last_checkpoint, PREFIX_CHECKPOINT_DIR
 from transformers.trainer_pt_utils import AcceleratorConfig
 from typing import List, Optional
 from datetime import timedelta
@@ -25,6 +27,11 @@
     import datasets
 
 from llava.utils import rank0_print
+from llava.train.quarantine import QuarantineSampler
+from llava.train.streaming import ShardedStreamDataset, StreamDataLoader
+
+STREAM_STATE_NAME = "stream_state.json"
+SAMPLER_STATE_NAME = "sampler_state.json"
 
 
 def maybe_zero_3(param, ignore_status=False, name=None):
@@ -59,31 +66,97 @@ def split_to_even_chunks(indices, lengths, num_chunks):
     num_indices_per_chunk = len(indices) // num_chunks
 
     chunks = [[] for _ in range(num_chunks)]
-    chunks_lengths = [0 for _ in range(num_chunks)]
+    # (chunk length, chunk) pairs, ties go to the first chunk and full chunks leave the heap
+    heap = [(0, chunk) for chunk in range(num_chunks)]
     for index in indices:
-        shortest_chunk = chunks_lengths.index(min(chunks_lengths))
+        chunk_length, shortest_chunk = heapq.heappop(heap)
         chunks[shortest_chunk].append(index)
-        chunks_lengths[shortest_chunk] += lengths[index]
-        if len(chunks[shortest_chunk]) == num_indices_per_chunk:
-            chunks_lengths[shortest_chunk] = float("inf")
+        if len(chunks[shortest_chunk]) < num_indices_per_chunk:
+            heapq.heappush(heap, (chunk_length + lengths[index], shortest_chunk))
 
     return chunks
 
 
+def split_megabatches_to_even_chunks(megabatches, lengths, num_chunks):
+    """
+    `split_to_even_chunks` of every row of the (num_megabatches, megabatch_size) array `megabatches` at once, the chunks
+    of every row are concatenated.
+    """
+    num_megabatches, megabatch_size = megabatches.shape
+    if megabatch_size % num_chunks != 0:
+        return megabatches[:, np.concatenate([np.arange(i, megabatch_size, num_chunks) for i in range(num_chunks)])]
+
+    num_indices_per_chunk = megabatch_size // num_chunks
+    rows = np.arange(num_megabatches)
+    megabatch_lengths = np.asarray(lengths, dtype=np.float64)[megabatches]
+    chunks_lengths = np.zeros((num_megabatches, num_chunks), dtype=np.float64)
+    chunks_sizes = np.zeros((num_megabatches, num_chunks), dtype=np.int64)
+    positions = np.empty_like(megabatches)
+    # the greedy assignment is sequential along a megabatch, but independent between megabatches
+    for i in range(megabatch_size):
+        shortest_chunk = np.argmin(chunks_lengths, axis=1)
+        positions[:, i] = shortest_chunk * num_indices_per_chunk + chunks_sizes[rows, shortest_chunk]
+        chunks_sizes[rows, shortest_chunk] += 1
+        chunks_lengths[rows, shortest_chunk] += megabatch_lengths[:, i]
+        full = chunks_sizes[rows, shortest_chunk] == num_indices_per_chunk
+        chunks_lengths[rows[full], shortest_chunk[full]] = np.inf
+
+    chunked = np.empty_like(megabatches)
+    np.put_along_axis(chunked, positions, megabatches, axis=1)
+    return chunked
+
+
+def _split_blocks(array, block_size):
+    return np.split(array, np.arange(block_size, len(array), block_size))
+
+
+def _sort_blocks_by_length(indices, lengths, block_size):
+    """Sort every block of `block_size` indices by descending length, ties keep their order like `sorted(reverse=True)`."""
+    blocks = np.arange(len(indices)) // block_size
+    return indices[np.lexsort((-lengths[indices], blocks))]
+
+
+def _group_megabatches(indices, lengths, megabatch_size, world_size):
+    """Sort the megabatches of `indices` by length and split each of them into `world_size` chunks of even length."""
+    indices = _sort_blocks_by_length(indices, lengths, megabatch_size)
+    num_full = len(indices) // megabatch_size
+    grouped = [split_megabatches_to_even_chunks(indices[: num_full * megabatch_size].reshape(num_full, megabatch_size), lengths, world_size).reshape(-1)]
+    rest = indices[num_full * megabatch_size :]
+    if len(rest) > 0:
+        grouped.append(np.asarray([i for chunk in split_to_even_chunks(rest.tolist(), lengths, world_size) for i in chunk], dtype=np.int64))
+    return np.concatenate(grouped)
+
+
+def _shuffle_blocks(indices, block_size, generator=None):
+    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
+    blocks = _split_blocks(indices, block_size)
+    block_indices = torch.randperm(len(blocks), generator=generator).numpy()
+    return np.concatenate([blocks[i] for i in block_indices]) if len(blocks) > 0 else indices
+
+
 def get_variable_length_grouped_indices(lengths, batch_size, world_size, megabatch_mult=8, generator=None):
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    indices = torch.randperm(len(lengths), generator=generator)
-    sorted_indices = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    indices = torch.randperm(len(lengths), generator=generator).numpy()
+    lengths = np.asarray(lengths)
+    sorted_indices = np.argsort(-lengths, kind="stable")
     megabatch_size = world_size * batch_size * megabatch_mult
-    megabatches = [sorted_indices[i : i + megabatch_size] for i in range(0, len(lengths), megabatch_size)]
-    megabatches = [sorted(megabatch, key=lambda i: indices[i], reverse=True) for megabatch in megabatches]
-    shuffled_indices = [i for megabatch in megabatches for i in megabatch]
+    # every megabatch of similar lengths is reordered by the random permutation
+    megabatches = np.arange(len(lengths)) // megabatch_size
+    shuffled_indices = sorted_indices[np.lexsort((-indices[sorted_indices], megabatches))]
     world_batch_size = world_size * batch_size
-    batches = [shuffled_indices[i : i + world_batch_size] for i in range(0, len(lengths), world_batch_size)]
-    batch_indices = torch.randperm(len(batches), generator=generator)
-    batches = [batches[i] for i in batch_indices]
+    return _shuffle_blocks(shuffled_indices, world_batch_size, generator=generator).tolist()
+
 
-    return [i for batch in batches for i in batch]
+def _split_modalities(lengths, batch_size, world_size, group_fn):
+    """Group the positive (multimodal) and negative (language) lengths separately into megabatches of one modality."""
+    mm_indices = np.nonzero(lengths > 0)[0]
+    lang_indices = np.nonzero(lengths < 0)[0]
+    mm_shuffle = mm_indices[group_fn(lengths[mm_indices], batch_size, world_size, generator=None)]
+    lang_shuffle = lang_indices[group_fn(-lengths[lang_indices], batch_size, world_size, generator=None)]
+    megabatch_size = world_size * batch_size
+    mm_megabatches = _split_blocks(mm_shuffle, megabatch_size)
+    lang_megabatches = _split_blocks(lang_shuffle, megabatch_size)
+    return mm_megabatches, lang_megabatches
 
 
 def get_modality_length_grouped_indices(lengths, batch_size, world_size, generator=None):
@@ -100,30 +173,22 @@ def get_modality_length_grouped_indices(lengths, batch_size, world_size, generat
     """
 
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    assert all(l != 0 for l in lengths), "Should not have zero length."
-    if all(l > 0 for l in lengths) or all(l < 0 for l in lengths):
+    lengths = np.asarray(lengths)
+    assert (lengths != 0).all(), "Should not have zero length."
+    if (lengths > 0).all() or (lengths < 0).all():
         # all samples are in the same modality
         return get_length_grouped_indices(lengths, batch_size, world_size, generator=generator)
-    mm_indices, mm_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
-    lang_indices, lang_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+    mm_megabatches, lang_megabatches = _split_modalities(lengths, batch_size, world_size, get_length_grouped_indices)
 
-    mm_shuffle = [mm_indices[i] for i in get_length_grouped_indices(mm_lengths, batch_size, world_size, generator=None)]
-    lang_shuffle = [lang_indices[i] for i in get_length_grouped_indices(lang_lengths, batch_size, world_size, generator=None)]
-    megabatch_size = world_size * batch_size
-    mm_megabatches = [mm_shuffle[i : i + megabatch_size] for i in range(0, len(mm_shuffle), megabatch_size)]
-    lang_megabatches = [lang_shuffle[i : i + megabatch_size] for i in range(0, len(lang_shuffle), megabatch_size)]
-
-    last_mm = mm_megabatches[-1]
-    last_lang = lang_megabatches[-1]
-    additional_batch = last_mm + last_lang
+    additional_batch = np.concatenate([mm_megabatches[-1], lang_megabatches[-1]])
     megabatches = mm_megabatches[:-1] + lang_megabatches[:-1]
-    megabatch_indices = torch.randperm(len(megabatches), generator=generator)
+    megabatch_indices = torch.randperm(len(megabatches), generator=generator).numpy()
     megabatches = [megabatches[i] for i in megabatch_indices]
 
     if len(additional_batch) > 0:
-        megabatches.append(sorted(additional_batch))
+        megabatches.append(np.sort(additional_batch))
 
-    return [i for megabatch in megabatches for i in megabatch]
+    return np.concatenate(megabatches).tolist()
 
 
 def get_length_grouped_indices(lengths, batch_size, world_size, generator=None, merge=True):
@@ -140,63 +205,117 @@ def get_length_grouped_indices(lengths, batch_size, world_size, generator=None,
     """
 
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    indices = torch.randperm(len(lengths), generator=generator)
-    megabatch_size = world_size * batch_size
-    megabatches = [indices[i : i + megabatch_size].tolist() for i in range(0, len(lengths), megabatch_size)]
-    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
-    megabatches = [split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
+    indices = torch.randperm(len(lengths), generator=generator).numpy()
+    lengths = np.asarray(lengths)
+    return _group_megabatches(indices, lengths, world_size * batch_size, world_size).tolist()
+
+
+def get_length_grouped_indices_hf(lengths, batch_size, mega_batch_mult=None, generator=None):
+    """`transformers.trainer_pt_utils.get_length_grouped_indices` on numpy arrays, with the same output for the same seed."""
+    lengths = np.asarray(lengths)
+    if mega_batch_mult is None:
+        mega_batch_mult = max(min(len(lengths) // (batch_size * 4), 50), 1)
 
-    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
+    indices = torch.randperm(len(lengths), generator=generator).numpy()
+    megabatch_size = mega_batch_mult * batch_size
+    indices = _sort_blocks_by_length(indices, lengths, megabatch_size)
+
+    # put the longest element, the first one of some megabatch, in the first position
+    megabatch_starts = np.arange(0, len(indices), megabatch_size)
+    max_start = megabatch_starts[np.argmax(lengths[indices[megabatch_starts]])]
+    indices[0], indices[max_start] = indices[max_start], indices[0]
+    return indices
 
 
 def get_length_grouped_indices_auto_single(lengths, batch_size, world_size, generator=None):
+    lengths = np.asarray(lengths)
     indices = get_length_grouped_indices_hf(lengths, batch_size * world_size, generator=generator)
 
     megabatch_size = world_size * batch_size
-    megabatches = [indices[i : i + megabatch_size] for i in range(0, len(lengths), megabatch_size)]
-    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
-    megabatches = [split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
+    indices = _group_megabatches(indices, lengths, megabatch_size, world_size)
 
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    batch_indices = torch.randperm(len(megabatches), generator=generator)
-    megabatches = [megabatches[i] for i in batch_indices]
-
-    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+    return _shuffle_blocks(indices, megabatch_size, generator=generator).tolist()
 
 
 def get_modality_length_grouped_indices_auto(lengths, batch_size, world_size, generator=None):
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    assert all(l != 0 for l in lengths), "Should not have zero length."
-    if all(l > 0 for l in lengths) or all(l < 0 for l in lengths):
+    lengths = np.asarray(lengths)
+    assert (lengths != 0).all(), "Should not have zero length."
+    if (lengths > 0).all() or (lengths < 0).all():
         # all samples are in the same modality
         return get_length_grouped_indices_auto_single(lengths, batch_size, world_size, generator=generator)
-    mm_indices, mm_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
-    lang_indices, lang_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+    mm_megabatches, lang_megabatches = _split_modalities(lengths, batch_size, world_size, get_length_grouped_indices_auto_single)
 
-    mm_shuffle = [mm_indices[i] for i in get_length_grouped_indices_auto_single(mm_lengths, batch_size, world_size, generator=None)]
-    lang_shuffle = [lang_indices[i] for i in get_length_grouped_indices_auto_single(lang_lengths, batch_size, world_size, generator=None)]
-    megabatch_size = world_size * batch_size
-    mm_megabatches = [mm_shuffle[i : i + megabatch_size] for i in range(0, len(mm_shuffle), megabatch_size)]
-    lang_megabatches = [lang_shuffle[i : i + megabatch_size] for i in range(0, len(lang_shuffle), megabatch_size)]
-
-    last_mm = mm_megabatches[-1]
-    last_lang = lang_megabatches[-1]
-    additional_batch = last_mm + last_lang
     megabatches = mm_megabatches[:-1] + lang_megabatches[:-1]
-    megabatch_indices = torch.randperm(len(megabatches), generator=generator)
+    megabatch_indices = torch.randperm(len(megabatches), generator=generator).numpy()
     megabatches = [megabatches[i] for i in megabatch_indices]
 
     # FIXME: Hard code to avoid last batch mixed with different modalities
     # if len(additional_batch) > 0:
     #     megabatches.append(sorted(additional_batch))
 
-    return [i for megabatch in megabatches for i in megabatch]
+    return np.concatenate(megabatches).tolist() if len(megabatches) > 0 else []
+
+
+def pack_token_budget_batches(indices, lengths, max_tokens):
+    """
+    Cut `indices`, sorted by descending length, into consecutive batches whose padded size (number of samples times the
+    longest of them, the first one) stays within `max_tokens`. A sample longer than the budget gets a batch of its own.
+    """
+    batches = []
+    start = 0
+    while start < len(indices):
+        batch_size = max(max_tokens // max(int(lengths[indices[start]]), 1), 1)
+        batches.append(indices[start : start + batch_size])
+        start += batch_size
+    return batches
+
+
+def get_token_budget_batches(lengths, max_tokens, world_size, megabatch_size, generator=None):
+    """
+    Batches of at most `max_tokens` padded tokens, grouped into steps of `world_size` batches of similar cost.
+
+    The samples are shuffled, sorted by length within megabatches of `megabatch_size` and packed. The batches are sorted
+    by cost so that the batches of a step, one per rank, are balanced, and the steps are shuffled. The cheapest batches
+    that do not fill a step are repacked and split until they do, every rank runs the same number of steps.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    indices = torch.randperm(len(lengths), generator=generator).numpy()
+    indices = _sort_blocks_by_length(indices, lengths, megabatch_size)
+    batches = [batch for block in _split_blocks(indices, megabatch_size) for batch in pack_token_budget_batches(block, lengths, max_tokens)]
+    costs = np.asarray([len(batch) * lengths[batch[0]] for batch in batches], dtype=np.int64)
+    batches = [batches[i] for i in np.argsort(-costs, kind="stable")]
+
+    num_full = len(batches) // world_size * world_size
+    rest = batches[num_full:]
+    if len(rest) > 0:
+        rest = np.concatenate(rest)
+        rest = pack_token_budget_batches(rest[np.argsort(-lengths[rest], kind="stable")], lengths, max_tokens)
+        while len(rest) % world_size != 0:
+            largest = max(range(len(rest)), key=lambda i: len(rest[i]))
+            if len(rest[largest]) > 1:
+                batch = rest.pop(largest)
+                rest.extend([batch[: len(batch) // 2], batch[len(batch) // 2 :]])
+            else:
+                # pad with repeated samples like DistributedSampler
+                rest.append(rest[0])
+        rest_costs = np.asarray([len(batch) * lengths[batch].max() for batch in rest], dtype=np.int64)
+        batches = batches[:num_full] + [rest[i] for i in np.argsort(-rest_costs, kind="stable")]
+    steps = [batches[i : i + world_size] for i in range(0, len(batches), world_size)]
+
+    step_indices = torch.randperm(len(steps), generator=generator).numpy()
+    return [[batch.tolist() for batch in steps[i]] for i in step_indices]
 
 
 class LengthGroupedSampler(Sampler):
     r"""
     Sampler that samples indices in a way that groups together features of the dataset of roughly the same length while
     keeping a bit of randomness.
+
+    With a `seed`, the order of every epoch only depends on the seed and the epoch, so the sampler position is fully
+    described by its `state_dict` and an iteration can start at any `start_index` without replaying the skipped ones.
     """
 
     def __init__(
@@ -208,6 +327,7 @@ def __init__(
         variable_length: bool = False,
         group_by_modality: bool = False,
         group_by_modality_auto: bool = False,
+        seed: Optional[int] = None,
     ):
         if lengths is None:
             raise ValueError("Lengths must be provided.")
@@ -219,11 +339,51 @@ def __init__(
         self.variable_length = variable_length
         self.group_by_modality = group_by_modality
         self.group_by_modality_auto = group_by_modality_auto
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+        self._resume_state = None
+        # whether the next iteration is positioned by set_epoch/load_state_dict, it moves to the next epoch otherwise
+        self._positioned = True
 
     def __len__(self):
         return len(self.lengths)
 
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start_index = 0
+        self._positioned = True
+        if self._resume_state is not None and self._resume_state["epoch"] == epoch:
+            self.start_index = self._resume_state["start_index"]
+        self._resume_state = None
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch, "start_index": self.start_index}
+
+    def load_state_dict(self, state):
+        """Start at ``state["start_index"]`` once the trainer sets the epoch to ``state["epoch"]``."""
+        if state["seed"] != self.seed:
+            raise ValueError(f"The sampler state was saved with seed {state['seed']}, the sampler uses seed {self.seed}")
+        self.epoch, self.start_index = state["epoch"], state["start_index"]
+        # kept until the trainer sets the epoch, which would otherwise reset the position
+        self._resume_state = state
+        self._positioned = True
+
     def __iter__(self):
+        if not self._positioned:
+            self.epoch += 1
+        self._positioned = False
+        if self.seed is None:
+            indices = self._get_indices()
+        else:
+            # the grouping functions draw from the global torch generator, seed a private copy of it for this epoch
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(self.seed + self.epoch)
+                indices = self._get_indices()
+        start_index, self.start_index = self.start_index, 0
+        return iter(indices[start_index:])
+
+    def _get_indices(self):
         if self.variable_length:
             assert not self.group_by_modality, "Variable length grouping is not supported with modality grouping."
             indices = get_variable_length_grouped_indices(self.lengths, self.batch_size, self.world_size, generator=self.generator)
@@ -234,10 +394,159 @@ def __iter__(self):
                 indices = get_modality_length_grouped_indices_auto(self.lengths, self.batch_size, self.world_size, generator=self.generator)
             else:
                 indices = get_length_grouped_indices_auto_single(self.lengths, self.batch_size, self.world_size, generator=self.generator)
-        return iter(indices)
+        return indices
+
 
+class TokenBudgetBatchSampler(Sampler):
+    r"""
+    Batch sampler yielding the batches of one rank, each of at most `max_tokens` padded tokens: many short samples or a
+    few long ones. The steps of all ranks are drawn from the same order, built from `seed` and the epoch, so every rank
+    runs the same number of steps on batches of similar cost.
+
+    Like `LengthGroupedSampler`, the position is described by `state_dict`, with `start_index` counted in batches.
+    """
+
+    def __init__(self, lengths: List[int], max_tokens: int, world_size: int, rank: int, seed: int = 0, megabatch_size: Optional[int] = None):
+        if lengths is None:
+            raise ValueError("Lengths must be provided.")
+        if max_tokens <= 0:
+            raise ValueError(f"max_tokens must be positive, got {max_tokens}")
+
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.world_size = world_size
+        self.rank = rank
+        self.seed = seed
+        self.megabatch_size = megabatch_size or 256 * world_size
+        self.epoch = 0
+        self.start_index = 0
+        self._resume_state = None
+        self._positioned = True
+        self._steps = None
+
+    def _get_steps(self):
+        if self._steps is None or self._steps[0] != self.epoch:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            self._steps = (self.epoch, get_token_budget_batches(self.lengths, self.max_tokens, self.world_size, self.megabatch_size, generator=generator))
+        return self._steps[1]
+
+    def __len__(self):
+        # the number of batches depends on the order of the epoch, which is built once and reused by __iter__
+        return len(self._get_steps())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start_index = 0
+        self._positioned = True
+        if self._resume_state is not None and self._resume_state["epoch"] == epoch:
+            self.start_index = self._resume_state["start_index"]
+        self._resume_state = None
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch, "start_index": self.start_index}
+
+    def load_state_dict(self, state):
+        """Start at batch ``state["start_index"]`` once the trainer sets the epoch to ``state["epoch"]``."""
+        if state["seed"] != self.seed:
+            raise ValueError(f"The sampler state was saved with seed {state['seed']}, the sampler uses seed {self.seed}")
+        self.epoch, self.start_index = state["epoch"], state["start_index"]
+        self._resume_state = state
+        self._positioned = True
+
+    def __iter__(self):
+        if not self._positioned:
+            self.epoch += 1
+        self._positioned = False
+        steps = self._get_steps()
+        start_index, self.start_index = self.start_index, 0
+        for step in steps[start_index:]:
+            yield step[self.rank]
+
+
+class TokenBudgetDataLoader(DataLoader):
+    """
+    DataLoader of a `TokenBudgetBatchSampler`, passing the epochs set by the trainer to the batch sampler.
+
+    The number of batches changes from epoch to epoch, so the position can not be derived from the global step and
+    the length of the first epoch. Like ``StreamDataLoader``, the dataloader counts the batches it yields, and its
+    `state_dict` is the (epoch, batches consumed) of the batch sampler. A run resumed from it continues at the saved
+    epoch, even if the trainer, which counts its epochs with the length of the first one, numbers it differently.
+    """
 
-class LLaVATrainer(Trainer):
+    def __init__(self, dataset, token_budget_sampler, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.token_budget_sampler = token_budget_sampler
+        self.resume_state = None
+        self.epoch_offset = 0
+        self.epoch = 0
+        self.num_batches_consumed = 0
+
+    def set_epoch(self, epoch):
+        if self.resume_state is not None:
+            self.epoch_offset = self.resume_state["epoch"] - epoch
+        self.resume_state = None
+        self.epoch = epoch + self.epoch_offset
+        # the batch sampler starts at its saved start_index when this is the saved epoch
+        self.batch_sampler.set_epoch(self.epoch)
+        self.num_batches_consumed = self.token_budget_sampler.start_index
+
+    def __iter__(self):
+        for batch in super().__iter__():
+            self.num_batches_consumed += 1
+            yield batch
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "num_batches": self.num_batches_consumed}
+
+
+class StreamingTrainerMixin:
+    """Dataloader, checkpointing and resume of a ShardedStreamDataset for the LLaVA trainers."""
+
+    def train(self, resume_from_checkpoint=None, trial=None, ignore_keys_for_eval=None, **kwargs):
+        self._stream_resume_state = None
+        if isinstance(self.train_dataset, ShardedStreamDataset):
+            # the stream skips the consumed batches itself, instead of the trainer loading and dropping them
+            self.args.ignore_data_skip = True
+            if isinstance(resume_from_checkpoint, bool) and resume_from_checkpoint:
+                resume_from_checkpoint = get_last_checkpoint(self.args.output_dir)
+            if resume_from_checkpoint:
+                state_file = os.path.join(resume_from_checkpoint, STREAM_STATE_NAME)
+                if os.path.exists(state_file):
+                    with open(state_file, "r") as f:
+                        self._stream_resume_state = json.load(f)
+                else:
+                    rank0_print(f"No {STREAM_STATE_NAME} in {resume_from_checkpoint}, the data stream restarts at the beginning of the epoch")
+        return super().train(resume_from_checkpoint=resume_from_checkpoint, trial=trial, ignore_keys_for_eval=ignore_keys_for_eval, **kwargs)
+
+    def _get_stream_dataloader(self) -> DataLoader:
+        train_dataset = self.train_dataset
+        train_dataset.configure(self._train_batch_size, self.args.dataloader_num_workers, self.args.process_index, self.args.world_size, seed=self.args.seed)
+        dataloader = StreamDataLoader(
+            train_dataset,
+            batch_size=self._train_batch_size,
+            collate_fn=self._get_collator_with_removed_columns(self.data_collator, description="training"),
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            # the workers take a new copy of the dataset, and so of its epoch and position, on every epoch
+            persistent_workers=False,
+        )
+        dataloader.resume_state = getattr(self, "_stream_resume_state", None)
+        self._stream_dataloader = dataloader
+        # not prepared by accelerate, which would shard the already sharded stream over the ranks again
+        return dataloader
+
+    def _save_stream_state(self, trial):
+        dataloader = getattr(self, "_stream_dataloader", None)
+        if dataloader is None or not self.args.should_save:
+            return
+        output_dir = os.path.join(self._get_output_dir(trial=trial), f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, STREAM_STATE_NAME), "w") as f:
+            json.dump(dataloader.state_dict(), f)
+
+
+class LLaVATrainer(StreamingTrainerMixin, Trainer):
 
     def create_accelerator_and_postprocess(self):
         grad_acc_kwargs = {"num_steps": self.args.gradient_accumulation_steps}
@@ -270,7 +579,32 @@ def create_accelerator_and_postprocess(self):
         if self.is_deepspeed_enabled and getattr(self.args, "hf_deepspeed_config", None) is None:
             self.propagate_args_to_deepspeed()
 
+    def train(self, resume_from_checkpoint=None, trial=None, ignore_keys_for_eval=None, **kwargs):
+        self._sampler_resume_state = None
+        if isinstance(resume_from_checkpoint, bool) and resume_from_checkpoint:
+            resume_from_checkpoint = get_last_checkpoint(self.args.output_dir)
+        if resume_from_checkpoint and os.path.exists(os.path.join(resume_from_checkpoint, SAMPLER_STATE_NAME)):
+            with open(os.path.join(resume_from_checkpoint, SAMPLER_STATE_NAME), "r") as f:
+                self._sampler_resume_state = json.load(f)
+        return super().train(resume_from_checkpoint=resume_from_checkpoint, trial=trial, ignore_keys_for_eval=ignore_keys_for_eval, **kwargs)
+
     def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
+        return self._wrap_train_sampler(self._get_base_train_sampler())
+
+    def _wrap_train_sampler(self, sampler):
+        if isinstance(sampler, (LengthGroupedSampler, TokenBudgetBatchSampler)) and getattr(self, "_sampler_resume_state", None) is not None:
+            # the sampler jumps to the saved position, instead of the trainer loading and dropping the consumed batches
+            sampler.load_state_dict(self._sampler_resume_state)
+            self.args.ignore_data_skip = True
+            rank0_print(f"Resuming the sampler at epoch {sampler.epoch}, index {sampler.start_index}")
+        self._resumable_sampler = sampler if isinstance(sampler, (LengthGroupedSampler, TokenBudgetBatchSampler)) else None
+        quarantine = getattr(self.train_dataset, "quarantine", None)
+        if sampler is not None and quarantine is not None:
+            # quarantined samples are replaced before they reach the dataloader workers
+            sampler = QuarantineSampler(sampler, quarantine, len(self.train_dataset))
+        return sampler
+
+    def _get_base_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
         if self.train_dataset is None or not has_length(self.train_dataset):
             return None
 
@@ -282,6 +616,7 @@ def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
                 # world_size=self.args.world_size,
                 world_size=self.args.world_size * self.args.gradient_accumulation_steps,  # TODO: seems that this may work?
                 lengths=lengths,
+                seed=self.args.seed,
             )
         elif self.args.group_by_modality_length:
             lengths = self.train_dataset.modality_lengths
@@ -291,6 +626,7 @@ def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
                 # world_size=self.args.world_size,
                 world_size=self.args.world_size * self.args.gradient_accumulation_steps,  # TODO: seems that this may work?
                 lengths=lengths,
+                seed=self.args.seed,
                 group_by_modality=True,
             )
         elif self.args.group_by_modality_length_auto:
@@ -301,6 +637,7 @@ def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
                 # world_size=self.args.world_size,
                 world_size=self.args.world_size * self.args.gradient_accumulation_steps,  # TODO: seems that this may work?
                 lengths=lengths,
+                seed=self.args.seed,
                 group_by_modality_auto=True,
             )
         elif self.args.group_by_varlen:
@@ -311,6 +648,7 @@ def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
                 # world_size=self.args.world_size,
                 world_size=self.args.world_size * self.args.gradient_accumulation_steps,  # TODO: seems that this may work?
                 lengths=lengths,
+                seed=self.args.seed,
                 variable_length=True,
             )
         else:
@@ -327,6 +665,10 @@ def get_train_dataloader(self) -> DataLoader:
         """
         if self.train_dataset is None:
             raise ValueError("Trainer: training requires a train_dataset.")
+        if isinstance(self.train_dataset, ShardedStreamDataset):
+            return self._get_stream_dataloader()
+        if getattr(self.args, "max_tokens_per_batch", None):
+            return self._get_token_budget_dataloader()
 
         train_dataset = self.train_dataset
         data_collator = self.data_collator
@@ -350,7 +692,34 @@ def get_train_dataloader(self) -> DataLoader:
             dataloader_params["prefetch_factor"] = self.args.dataloader_num_workers * 2 if self.args.dataloader_num_workers != 0 else None
 
         dataloader = self.accelerator.prepare(DataLoader(train_dataset, **dataloader_params))
+        self._train_dataloader_len = len(dataloader) if has_length(dataloader) else None
+
+        return dataloader
 
+    def _get_token_budget_dataloader(self) -> DataLoader:
+        sampler = TokenBudgetBatchSampler(
+            self.train_dataset.token_budget_lengths,
+            self.args.max_tokens_per_batch,
+            world_size=self.args.world_size,
+            rank=self.args.process_index,
+            seed=self.args.seed,
+        )
+        rank0_print(f"Token budget batches of at most {self.args.max_tokens_per_batch} tokens: {len(sampler)} steps per rank in the first epoch")
+        dataloader = TokenBudgetDataLoader(
+            self.train_dataset,
+            sampler,
+            batch_sampler=self._wrap_train_sampler(sampler),
+            collate_fn=self._get_collator_with_removed_columns(self.data_collator, description="training"),
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers,
+            worker_init_fn=seed_worker,
+            prefetch_factor=self.args.dataloader_num_workers * 2 if self.args.dataloader_num_workers != 0 else None,
+        )
+        dataloader.resume_state = getattr(self, "_sampler_resume_state", None)
+        self._token_budget_dataloader = dataloader
+        self._train_dataloader_len = len(dataloader)
+        # not prepared by accelerate, which would split the batches of every rank over the ranks again
         return dataloader
 
     def create_optimizer(self):
@@ -455,6 +824,28 @@ def _save_checkpoint(self, model, trial, metrics=None):
                 torch.save(weight_to_save, os.path.join(output_dir, f"mm_projector.bin"))
         else:
             super(LLaVATrainer, self)._save_checkpoint(model, trial, metrics)
+        self._save_stream_state(trial)
+        self._save_sampler_state(trial)
+
+    def _save_sampler_state(self, trial):
+        sampler = getattr(self, "_resumable_sampler", None)
+        if sampler is None or sampler.seed is None or not self.args.should_save:
+            return
+        if isinstance(sampler, TokenBudgetBatchSampler):
+            # the epochs differ in length, the dataloader counts the batches of the current one (whole optimizer steps)
+            state = self._token_budget_dataloader.state_dict()
+            epoch, start_index = state["epoch"], state["num_batches"] // self.args.gradient_accumulation_steps * self.args.gradient_accumulation_steps
+        elif getattr(self, "_train_dataloader_len", None):
+            # the same position the trainer would skip to: whole optimizer steps of the current epoch
+            steps_per_epoch = max(self._train_dataloader_len // self.args.gradient_accumulation_steps, 1)
+            epoch, steps_in_epoch = divmod(self.state.global_step, steps_per_epoch)
+            start_index = steps_in_epoch * self.args.gradient_accumulation_steps * self._train_batch_size * self.args.world_size
+        else:
+            return
+        output_dir = os.path.join(self._get_output_dir(trial=trial), f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, SAMPLER_STATE_NAME), "w") as f:
+            json.dump({"seed": sampler.seed, "epoch": epoch, "start_index": start_index}, f)
 
     def _save(self, output_dir: Optional[str] = None, state_dict=None):
         if getattr(self.args, "tune_mm_mlp_adapter", False):
@@ -463,7 +854,12 @@ def _save(self, output_dir: Optional[str] = None, state_dict=None):
             super(LLaVATrainer, self)._save(output_dir, state_dict)
 
 
-class LLaVADPOTrainer(DPOTrainer):
+class LLaVADPOTrainer(StreamingTrainerMixin, DPOTrainer):
+    def get_train_dataloader(self) -> DataLoader:
+        if isinstance(self.train_dataset, ShardedStreamDataset):
+            return self._get_stream_dataloader()
+        return super().get_train_dataloader()
+
     def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
         if self.train_dataset is None or not has_length(self.train_dataset):
             return None
@@ -519,6 +915,7 @@ def _save_checkpoint(self, model, trial, metrics=None):
                 self.save_my_lora_ckpt(output_dir, self.args, unwrapped_model)
             else:
                 super(LLaVADPOTrainer, self)._save_checkpoint(model, trial, metrics)
+        self._save_stream_state(trial)
 
     def _save(self, output_dir: Optional[str] = None, state_dict=None):
         if getattr(self.args, "tune_mm_mlp_adapter", False):
@@ -0,0 +1,43 @@
+import importlib
+
+import torch
+import torch.nn.functional as F
+
+
+def get_unpad_data_packed(attention_mask):
+    """
+    Drop-in replacement of `_get_unpad_data` in the transformers flash-attention models that understands packed rows.
+
+    In packed mode the attention mask holds the segment id (1, 2, ...) of the sample every token belongs to and 0 for
+    padding. Every segment becomes its own sequence in `cu_seqlens`, so the varlen flash-attention kernels never let
+    two packed samples attend to each other. A regular 0/1 mask yields exactly the original result.
+    """
+    batch_size = attention_mask.shape[0]
+    attention_mask = attention_mask.long()
+    num_segments = int(attention_mask.max()) + 1
+    row_offsets = torch.arange(batch_size, device=attention_mask.device)[:, None] * num_segments
+    seqlens = torch.bincount((row_offsets + attention_mask).flatten(), minlength=batch_size * num_segments)
+    # drop the padding (segment 0) of every row and the unused segment ids
+    seqlens_in_batch = seqlens.view(batch_size, num_segments)[:, 1:].flatten()
+    seqlens_in_batch = seqlens_in_batch[seqlens_in_batch > 0].to(torch.int32)
+    indices = torch.nonzero(attention_mask.flatten(), as_tuple=False).flatten()
+    max_seqlen_in_batch = seqlens_in_batch.max().item()
+    cu_seqlens = F.pad(torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.int32), (1, 0))
+    return indices, cu_seqlens, max_seqlen_in_batch
+
+
+def replace_flash_attn_unpad_for_packing():
+    for model_type in ["llama", "mistral", "mixtral", "qwen2", "qwen2_moe", "gemma"]:
+        try:
+            module = importlib.import_module(f"transformers.models.{model_type}.modeling_{model_type}")
+        except ImportError:
+            continue
+        if hasattr(module, "_get_unpad_data"):
+            module._get_unpad_data = get_unpad_data_packed
+
+    try:
+        # newer transformers versions share a single implementation
+        module = importlib.import_module("transformers.modeling_flash_attention_utils")
+        module._get_unpad_data = get_unpad_data_packed
+    except ImportError:
+        pass
@@ -0,0 +1,184 @@
+"""Random access to training samples stored in parquet shards.
+
+``scripts/train/data_parq.py`` packs the images and the conversations into parquet shards (``idx``, ``image``
+bytes, ``conversations`` json, ``source``). ``ParquetSamples`` reads them in place instead of exploding them back
+to loose files: the footers of all shards give the number of rows of every row group, a sample index is mapped to
+its row group, and the few most recently read row groups are kept per process. The image bytes are handed to the
+dataset as they are in the column, so an image costs no file on the filesystem.
+
+Row groups are the unit of every read, so shards meant for random access should be written with small row groups
+(``ROW_GROUP_SIZE`` of data_parq.py). The shards of the Hugging Face ``datasets`` layout (``id``, ``image`` struct
+with ``bytes``, list of conversations) are read as well.
+"""
+
+import glob
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from llava.train.sample_index import MODALITY_IMAGE, MODALITY_TEXT
+
+try:
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pc = None
+    pq = None
+
+
+def get_parquet_files(data_path):
+    """The parquet shards at ``data_path``: a .parquet file, a directory of them or a glob pattern."""
+    if data_path is None:
+        return []
+    if os.path.isdir(data_path):
+        return sorted(os.path.join(data_path, f) for f in os.listdir(data_path) if f.endswith(".parquet"))
+    return sorted(f for f in glob.glob(data_path) if f.endswith(".parquet"))
+
+
+def is_parquet_data(data_path):
+    return len(get_parquet_files(data_path)) > 0
+
+
+def get_parquet_image_column(parquet_file):
+    """Index of the leaf column whose nulls are the rows without an image: ``image`` or the bytes of a datasets.Image struct."""
+    schema = parquet_file.metadata.schema
+    for column_idx in range(len(schema)):
+        if schema.column(column_idx).path in ["image", "image.bytes"]:
+            return column_idx
+    return None
+
+
+def get_parquet_image_mask(parquet_file, rg_idx, image_column):
+    """
+    Whether each row of row group ``rg_idx`` holds an image, the same test as parquet_row_to_sample.
+
+    The null count in the column chunk statistics decides it without reading any image when the row group is all image
+    or all text rows. Only row groups that mix both, or have no statistics, read their image column.
+    """
+    row_group = parquet_file.metadata.row_group(rg_idx)
+    if image_column is not None:
+        statistics = row_group.column(image_column).statistics
+        if statistics is not None and statistics.has_null_count:
+            if statistics.null_count == 0:
+                return np.ones(row_group.num_rows, dtype=bool)
+            if statistics.null_count == row_group.num_rows:
+                return np.zeros(row_group.num_rows, dtype=bool)
+    image = parquet_file.read_row_group(rg_idx, columns=["image"]).column("image")
+    has_image = pc.is_valid(image)
+    if image.type.num_fields > 0 and image.type.get_field_index("bytes") >= 0:
+        # datasets.Image struct
+        has_image = pc.and_(has_image, pc.is_valid(pc.struct_field(image, "bytes")))
+    return has_image.to_numpy(zero_copy_only=False)
+
+
+def parquet_row_to_sample(row, default_id=None):
+    """Convert a parquet row to a training sample, the image stays encoded."""
+    conversations = row["conversations"]
+    sample = {"id": row.get("id", row.get("idx", default_id)), "conversations": json.loads(conversations) if isinstance(conversations, str) else conversations}
+    image = row.get("image")
+    if isinstance(image, dict):
+        # datasets.Image struct
+        image = image.get("bytes")
+    if image is not None:
+        sample["image"] = image
+    if row.get("source") is not None:
+        sample["source"] = row["source"]
+    return sample
+
+
+class ParquetSamples:
+    """Read-only, list-like view over the rows of parquet shards, with an LRU cache of decoded row groups."""
+
+    def __init__(self, data_path, row_group_cache_size=4):
+        if pq is None:
+            raise ImportError("Please install pyarrow to read parquet training data.")
+        self.dataset_paths = get_parquet_files(data_path)
+        if len(self.dataset_paths) == 0:
+            raise ValueError(f"No parquet files found at {data_path}")
+        self.row_group_cache_size = max(row_group_cache_size, 1)
+
+        row_groups = []
+        text_lengths = []
+        modality = []
+        for file_idx, path in enumerate(self.dataset_paths):
+            parquet_file = pq.ParquetFile(path)
+            names = parquet_file.schema_arrow.names
+            # shards written by scripts/train/data_parq.py carry the modality in has_image, older ones only the images
+            image_column = get_parquet_image_column(parquet_file) if "image" in names and "has_image" not in names else None
+            for rg_idx in range(parquet_file.metadata.num_row_groups):
+                row_groups.append((file_idx, rg_idx, parquet_file.metadata.row_group(rg_idx).num_rows))
+                # the sampler needs the lengths and modalities before any image is read
+                table = parquet_file.read_row_group(rg_idx, columns=["conversations", "has_image"] if "has_image" in names else ["conversations"])
+                for conversations in table.column("conversations").to_pylist():
+                    conversations = json.loads(conversations) if isinstance(conversations, str) else conversations
+                    text_lengths.append(sum(len(conv["value"].split()) for conv in conversations))
+                if "has_image" in names:
+                    has_image = table.column("has_image").fill_null(False).to_numpy(zero_copy_only=False)
+                elif "image" in names:
+                    has_image = get_parquet_image_mask(parquet_file, rg_idx, image_column)
+                else:
+                    has_image = np.zeros(table.num_rows, dtype=bool)
+                modality.extend(np.where(has_image, MODALITY_IMAGE, MODALITY_TEXT))
+
+        self._row_groups = row_groups
+        self._row_group_offsets = np.cumsum([0] + [num_rows for _, _, num_rows in row_groups])
+        self._num_samples = int(self._row_group_offsets[-1])
+        self._text_lengths = np.asarray(text_lengths, dtype=np.int32)
+        self._modality = np.asarray(modality, dtype=np.uint8)
+        self._pid = None
+        self._files = {}
+        self._cache = OrderedDict()
+
+    def __getstate__(self):
+        # files and row groups are re-opened lazily in the receiving process
+        state = self.__dict__.copy()
+        state["_pid"] = None
+        state["_files"] = {}
+        state["_cache"] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return self._num_samples
+
+    def _get_row_group(self, group_idx):
+        if self._pid != os.getpid():
+            # file handles are not shared with forked dataloader workers
+            self._pid = os.getpid()
+            self._files = {}
+            self._cache = OrderedDict()
+        if group_idx in self._cache:
+            self._cache.move_to_end(group_idx)
+            return self._cache[group_idx]
+
+        file_idx, rg_idx, _ = self._row_groups[group_idx]
+        if file_idx not in self._files:
+            self._files[file_idx] = pq.ParquetFile(self.dataset_paths[file_idx], memory_map=True)
+        table = self._files[file_idx].read_row_group(rg_idx)
+        self._cache[group_idx] = table
+        if len(self._cache) > self.row_group_cache_size:
+            self._cache.popitem(last=False)
+        return table
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._num_samples
+        if i < 0 or i >= self._num_samples:
+            raise IndexError(f"Sample index {i} out of range for {self._num_samples} samples")
+        group_idx = int(np.searchsorted(self._row_group_offsets, i, side="right")) - 1
+        table = self._get_row_group(group_idx)
+        row = table.slice(i - int(self._row_group_offsets[group_idx]), 1).to_pylist()[0]
+        return parquet_row_to_sample(row, i)
+
+    def __iter__(self):
+        for i in range(self._num_samples):
+            yield self[i]
+
+    @property
+    def text_lengths(self):
+        return self._text_lengths
+
+    @property
+    def modality(self):
+        return self._modality
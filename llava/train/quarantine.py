@@ -0,0 +1,164 @@
+"""Persistent quarantine of samples that fail to load.
+
+A sample whose media is missing or corrupted fails on every epoch, on every rank. Instead of sleeping and
+retrying it, the first failure is appended to a quarantine file shared by all dataloader workers and ranks
+(one json line per sample index), and the sample is never fetched again:
+
+- ``QuarantineSampler`` replaces quarantined indices by healthy ones before they reach the dataloader workers,
+- ``LazySupervisedDataset`` substitutes a sample that fails for the first time,
+- ``precheck_media`` scans the media of every sample in a process pool before training and fills the file up front.
+
+Substitutes are drawn deterministically from the failing index, so every rank makes the same choice and the
+number of samples per epoch never changes.
+"""
+
+import fcntl
+import json
+import multiprocessing
+import os
+import random
+import time
+
+from torch.utils.data import Sampler
+
+from llava.utils import build_on_main_process, rank0_print
+
+_check_fn = None
+
+
+class SampleQuarantine:
+    def __init__(self, path, refresh_interval=5.0):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.indices = set()
+        self._offset = 0
+        self._last_refresh = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # create the file, so every process can read it from the start
+        open(path, "a").close()
+        self.refresh()
+
+    def refresh(self):
+        """Pick up the entries appended by other processes since the last refresh."""
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        # a line that is still being written is read on the next refresh
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                self.indices.add(json.loads(line)["index"])
+        self._offset += end
+        self._last_refresh = time.time()
+
+    def __contains__(self, i):
+        if time.time() - self._last_refresh > self.refresh_interval:
+            self.refresh()
+        return i in self.indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def add(self, i, sample_id=None, error=None):
+        if i in self.indices:
+            return
+        line = json.dumps({"index": i, "id": sample_id, "error": error, "pid": os.getpid(), "time": time.time()}) + "\n"
+        with open(self.path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.indices.add(i)
+
+    def get_substitute(self, i, num_samples, max_tries=100):
+        """A healthy index to use instead of quarantined index i, the same in every process."""
+        rng = random.Random(i)
+        candidate = i
+        for _ in range(max_tries):
+            candidate = rng.randrange(num_samples)
+            if candidate not in self.indices:
+                break
+        return candidate
+
+
+class QuarantineSampler(Sampler):
+    """Wraps a sampler, or a batch sampler, and replaces the quarantined indices it yields, keeping its length."""
+
+    def __init__(self, sampler, quarantine, num_samples):
+        self.sampler = sampler
+        self.quarantine = quarantine
+        self.num_samples = num_samples
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        self.quarantine.refresh()
+        for i in self.sampler:
+            if isinstance(i, list):
+                yield [self._substitute(j) for j in i]
+            else:
+                yield self._substitute(i)
+
+    def _substitute(self, i):
+        return self.quarantine.get_substitute(i, self.num_samples) if i in self.quarantine else i
+
+
+def _check_chunk(chunk):
+    start, end = chunk
+    return [(i, _check_fn(i)) for i in range(start, end)]
+
+
+def precheck_media(check_fn, num_samples, quarantine, num_proc=None, chunk_size=1000):
+    """Quarantine every sample for which ``check_fn(i)`` returns an error message, checking in a forked process pool."""
+    global _check_fn
+    _check_fn = check_fn
+    num_proc = num_proc or os.cpu_count()
+    chunks = [(start, min(start + chunk_size, num_samples)) for start in range(0, num_samples, chunk_size)]
+
+    start_time = time.time()
+    num_failed = 0
+    if num_proc <= 1 or len(chunks) <= 1:
+        results = map(_check_chunk, chunks)
+    else:
+        # fork so that the workers inherit the dataset instead of pickling it
+        pool = multiprocessing.get_context("fork").Pool(num_proc)
+        results = pool.imap(_check_chunk, chunks)
+    for chunk_idx, chunk_results in enumerate(results):
+        for i, error in chunk_results:
+            if error is not None:
+                quarantine.add(i, error=error)
+                num_failed += 1
+        if (chunk_idx + 1) % max(len(chunks) // 10, 1) == 0:
+            rank0_print(f"Checked the media of {chunks[chunk_idx][1]}/{num_samples} samples in {time.time() - start_time:.1f}s, {num_failed} failed")
+    if num_proc > 1 and len(chunks) > 1:
+        pool.close()
+        pool.join()
+    _check_fn = None
+    return num_failed
+
+
+def load_quarantine(quarantine_dir, dataset_key, check_fn=None, num_samples=None, num_proc=None, poll_interval=10):
+    """Open the quarantine of a dataset. With ``check_fn``, the main process prechecks all media once first."""
+    path = os.path.join(quarantine_dir, f"quarantine_{dataset_key}.jsonl")
+    done_file = os.path.join(quarantine_dir, f"precheck_{dataset_key}.done")
+
+    def _precheck():
+        rank0_print(f"Prechecking the media of {num_samples} samples with {num_proc or os.cpu_count()} processes")
+        num_failed = precheck_media(check_fn, num_samples, SampleQuarantine(path), num_proc=num_proc)
+        with open(done_file, "w") as f:
+            json.dump({"num_samples": num_samples, "num_failed": num_failed}, f)
+
+    if check_fn is not None:
+        # the other processes wait for the precheck, see build_on_main_process
+        build_on_main_process(_precheck, done_file, poll_interval=poll_interval)
+
+    quarantine = SampleQuarantine(path)
+    rank0_print(f"Loaded the sample quarantine {path} with {len(quarantine)} samples")
+    return quarantine
@@ -0,0 +1,149 @@
+"""Memory-mapped columnar index over the training manifests.
+
+Loading a large json/jsonl/yaml manifest into every rank and every dataloader worker costs tens of GB of
+Python objects and minutes of json parsing. ``compile_sample_index`` converts the manifest once into a
+directory of flat arrays:
+
+    meta.json           number of samples, source manifests
+    offsets.npy         int64 [N + 1], byte offsets of every sample inside samples.bin
+    samples.bin         utf-8 json blobs of the samples, concatenated
+    text_lengths.npy    int32 [N], whitespace word count of the conversations
+    modality.npy        uint8 [N], 0 = text, 1 = image, 2 = video
+
+``SampleIndex`` opens these files read-only with ``np.memmap``, so the pages are shared by all processes on
+a node and a sample is only parsed when it is accessed.
+
+Usage:
+    python -m llava.train.sample_index --data_path /path/to/data.yaml --output_dir /path/to/data_index
+"""
+
+import argparse
+import json
+import os
+from array import array
+
+import numpy as np
+
+from llava.train.data_utils import load_data_dicts
+
+INDEX_META_FILE = "meta.json"
+INDEX_VERSION = 1
+
+MODALITY_TEXT = 0
+MODALITY_IMAGE = 1
+MODALITY_VIDEO = 2
+
+
+def is_sample_index(path):
+    return path is not None and os.path.isdir(path) and os.path.isfile(os.path.join(path, INDEX_META_FILE))
+
+
+def get_sample_modality(sample):
+    if "image" in sample:
+        return MODALITY_IMAGE
+    elif "video" in sample:
+        return MODALITY_VIDEO
+    return MODALITY_TEXT
+
+
+def compile_sample_index(data_path, output_dir):
+    """Compile the manifest(s) at ``data_path`` into a ``SampleIndex`` directory at ``output_dir``."""
+    list_data_dict, dataset_paths = load_data_dicts(data_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    offsets = array("q", [0])
+    text_lengths = array("i")
+    modality = array("B")
+    with open(os.path.join(output_dir, "samples.bin"), "wb") as blob_file:
+        for sample in list_data_dict:
+            blob = json.dumps(sample, ensure_ascii=False).encode("utf-8")
+            blob_file.write(blob)
+            offsets.append(offsets[-1] + len(blob))
+            text_lengths.append(sum(len(conv["value"].split()) for conv in sample["conversations"]))
+            modality.append(get_sample_modality(sample))
+
+    np.save(os.path.join(output_dir, "offsets.npy"), np.frombuffer(offsets, dtype=np.int64))
+    np.save(os.path.join(output_dir, "text_lengths.npy"), np.frombuffer(text_lengths, dtype=np.int32))
+    np.save(os.path.join(output_dir, "modality.npy"), np.frombuffer(modality, dtype=np.uint8))
+
+    # meta.json is written last, so a partially compiled directory is never picked up as an index
+    meta = {"version": INDEX_VERSION, "num_samples": len(text_lengths), "data_path": data_path, "dataset_paths": dataset_paths}
+    with open(os.path.join(output_dir, INDEX_META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class SampleIndex:
+    """Read-only, list-like view over a compiled sample index."""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, INDEX_META_FILE), "r") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported sample index version {self.meta.get('version')} in {index_dir}, please recompile it.")
+        self.dataset_paths = self.meta["dataset_paths"]
+        self._num_samples = self.meta["num_samples"]
+        self._offsets = None
+        self._blob = None
+        self._text_lengths = None
+        self._modality = None
+
+    def _open(self):
+        if self._offsets is not None:
+            return
+        self._offsets = np.load(os.path.join(self.index_dir, "offsets.npy"), mmap_mode="r")
+        self._text_lengths = np.load(os.path.join(self.index_dir, "text_lengths.npy"), mmap_mode="r")
+        self._modality = np.load(os.path.join(self.index_dir, "modality.npy"), mmap_mode="r")
+        blob_path = os.path.join(self.index_dir, "samples.bin")
+        # np.memmap refuses to map empty files
+        if os.path.getsize(blob_path) > 0:
+            self._blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self._blob = np.zeros(0, dtype=np.uint8)
+
+    def __getstate__(self):
+        # memory maps are re-opened lazily in the receiving process
+        state = self.__dict__.copy()
+        state["_offsets"] = state["_blob"] = state["_text_lengths"] = state["_modality"] = None
+        return state
+
+    def __len__(self):
+        return self._num_samples
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._num_samples
+        if i < 0 or i >= self._num_samples:
+            raise IndexError(f"Sample index {i} out of range for {self._num_samples} samples")
+        self._open()
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        return json.loads(self._blob[start:end].tobytes())
+
+    def __iter__(self):
+        for i in range(self._num_samples):
+            yield self[i]
+
+    @property
+    def text_lengths(self):
+        self._open()
+        return self._text_lengths
+
+    @property
+    def modality(self):
+        self._open()
+        return self._modality
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile a training manifest into a memory-mapped sample index.")
+    parser.add_argument("--data_path", type=str, required=True, help="Same as --data_path of train.py: a json file, a yaml file or a /path/to/{a,b,c}.json pattern")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory to write the index to")
+    args = parser.parse_args()
+
+    meta = compile_sample_index(args.data_path, args.output_dir)
+    print(f"Compiled {meta['num_samples']} samples from {args.data_path} into {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""Streaming training data from sequential tar or parquet shards.
+
+The map-style datasets read every sample at a random offset, which collapses on object storage and network
+filesystems. ``ShardedStreamDataset`` reads whole shards sequentially instead:
+
+- tar shards follow the WebDataset layout, the members of a sample share a key (``<key>.json`` with the sample,
+  ``<key>.jpg`` or ``<key>.0.jpg``, ``<key>.1.jpg``, ... with its images). Videos stay referenced by path,
+- parquet shards are the ones written by ``scripts/train/data_parq.py``.
+
+Every epoch the shards are permuted with the seed and dealt to the ``world_size * num_workers`` dataloader
+workers (every worker strides over all shards if there are fewer shards than workers). Each worker shuffles its
+records in a buffer and yields a fixed number of samples, so all ranks run the same number of steps.
+
+The buffer draws only depend on the seed, the epoch and the worker, so the position of a run is the number of
+batches it consumed in the current epoch. On resume, the buffer content at that position is simulated without
+reading any data, the records still in the buffer are read back and whole shards before them are skipped.
+
+The number of records of every tar shard is counted from the tar headers at startup, or read from the
+``shard_counts.json`` written next to the shards by
+    python -m llava.train.streaming --data_path /path/to/shards
+"""
+
+import argparse
+import bisect
+import glob
+import json
+import os
+import random
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+from llava.train.parquet_data import parquet_row_to_sample
+from llava.utils import rank0_print
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+SHARD_EXTENSIONS = (".tar", ".parquet")
+SHARD_COUNTS_FILE = "shard_counts.json"
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "webp", "bmp", "gif")
+
+
+def get_stream_shards(data_path):
+    """The tar/parquet shards at ``data_path``: a shard, a directory of shards or a glob pattern."""
+    if data_path is None:
+        return []
+    if os.path.isdir(data_path):
+        return sorted(os.path.join(data_path, f) for f in os.listdir(data_path) if f.endswith(SHARD_EXTENSIONS))
+    return sorted(f for f in glob.glob(data_path) if f.endswith(SHARD_EXTENSIONS))
+
+
+def _split_tar_name(name):
+    # WebDataset convention: the key ends at the first dot of the file name
+    dirname, basename = os.path.split(name)
+    key, _, ext = basename.partition(".")
+    return os.path.join(dirname, key), ext.lower()
+
+
+def count_shard_records(path):
+    if path.endswith(".parquet"):
+        return pq.ParquetFile(path).metadata.num_rows
+    num_records = 0
+    last_key = None
+    with tarfile.open(path, "r:") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, _ = _split_tar_name(member.name)
+            if key != last_key:
+                num_records += 1
+                last_key = key
+    return num_records
+
+
+def get_shard_counts(shards, num_threads=16):
+    """Number of records of every shard, from shard_counts.json if it lists them, counted otherwise."""
+    counts = {}
+    for shard_dir in sorted(set(os.path.dirname(shard) for shard in shards)):
+        counts_file = os.path.join(shard_dir, SHARD_COUNTS_FILE)
+        if os.path.exists(counts_file):
+            with open(counts_file, "r") as f:
+                counts.update({os.path.join(shard_dir, name): count for name, count in json.load(f).items()})
+    missing = [shard for shard in shards if shard not in counts]
+    if len(missing) > 0:
+        rank0_print(f"Counting the records of {len(missing)} shards, write {SHARD_COUNTS_FILE} with llava.train.streaming to skip this")
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            counts.update(zip(missing, executor.map(count_shard_records, missing)))
+    return [counts[shard] for shard in shards]
+
+
+def _tar_record_to_sample(members):
+    sample = json.loads(members["json"])
+    # <key>.0.jpg, <key>.1.jpg, ... in numeric order
+    images = [members[ext] for ext in sorted(members, key=lambda ext: (len(ext), ext)) if ext.rpartition(".")[2] in IMAGE_EXTENSIONS]
+    if len(images) == 1:
+        sample["image"] = images[0]
+    elif len(images) > 1:
+        sample["image"] = images
+    return sample
+
+
+def iter_shard_records(path, start=0, keep=None):
+    """Yield (offset, sample) for the records of a shard from ``start`` on.
+
+    The sample is None for the offsets ``keep(offset)`` rejects, their data is not read.
+    """
+    if path.endswith(".parquet"):
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        group_start = 0
+        for rg_idx in range(parquet_file.metadata.num_row_groups):
+            num_rows = parquet_file.metadata.row_group(rg_idx).num_rows
+            group_end = group_start + num_rows
+            if group_end > start:
+                offsets = range(max(start, group_start), group_end)
+                kept = [offset for offset in offsets if keep is None or keep(offset)]
+                rows = {}
+                if len(kept) > 0:
+                    table = parquet_file.read_row_group(rg_idx)
+                    rows = {offset: table.slice(offset - group_start, 1).to_pylist()[0] for offset in kept}
+                for offset in offsets:
+                    yield offset, parquet_row_to_sample(rows[offset], offset) if offset in rows else None
+            group_start = group_end
+        return
+
+    with tarfile.open(path, "r:") as tar:
+        offset = -1
+        last_key = None
+        members = None
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, ext = _split_tar_name(member.name)
+            if key != last_key:
+                if members is not None:
+                    yield offset, _tar_record_to_sample(members)
+                elif offset >= start:
+                    yield offset, None
+                offset += 1
+                last_key = key
+                members = {} if offset >= start and (keep is None or keep(offset)) else None
+            if members is not None:
+                # members of skipped records are never extracted, tarfile seeks over their data
+                members[ext] = tar.extractfile(member).read()
+        if members is not None:
+            yield offset, _tar_record_to_sample(members)
+        elif offset >= start:
+            yield offset, None
+
+
+class ShardedStreamDataset(IterableDataset):
+    """Streams the samples of tar/parquet shards, converted to training inputs by ``process_fn(sample, position)``."""
+
+    def __init__(self, data_path, process_fn, shuffle_buffer_size=1000, seed=0):
+        self.shards = get_stream_shards(data_path)
+        if len(self.shards) == 0:
+            raise ValueError(f"No tar or parquet shards found at {data_path}")
+        if pq is None and any(shard.endswith(".parquet") for shard in self.shards):
+            raise ImportError("Please install pyarrow to stream parquet shards.")
+        self.shard_counts = get_shard_counts(self.shards)
+        self.num_records = sum(self.shard_counts)
+        self.process_fn = process_fn
+        self.shuffle_buffer_size = max(shuffle_buffer_size, 1)
+        self.seed = seed
+        self.batch_size = 1
+        self.num_workers = 0
+        self.rank = 0
+        self.world_size = 1
+        self.epoch = 0
+        self.start_batch = 0
+        rank0_print(f"Streaming {self.num_records} samples from {len(self.shards)} shards at {data_path}")
+
+    def configure(self, batch_size, num_workers, rank, world_size, seed=None):
+        """Set the dataloader layout the samples are dealt for, done by the trainer."""
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.rank = rank
+        self.world_size = world_size
+        if seed is not None:
+            self.seed = seed
+
+    def set_epoch(self, epoch, start_batch=0):
+        """Start the next iteration at ``epoch``, after the first ``start_batch`` batches of this rank."""
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    @property
+    def num_batches(self):
+        """Batches per rank and epoch, the remainder of the records is dropped."""
+        return self.num_records // (self.world_size * self.batch_size)
+
+    def __len__(self):
+        return self.num_batches * self.batch_size
+
+    def _get_worker_quota(self, worker_id, num_workers, num_batches):
+        # the dataloader takes the batches from its workers in turn
+        return len(range(worker_id, num_batches, num_workers)) * self.batch_size
+
+    def _get_worker_stream(self, global_worker_id, total_workers):
+        """Shards, record counts and (stride, phase) over their concatenation of a worker in this epoch."""
+        order = list(range(len(self.shards)))
+        random.Random(f"{self.seed}-{self.epoch}").shuffle(order)
+        if len(order) >= total_workers:
+            shard_ids = order[global_worker_id::total_workers]
+            stride, phase = 1, 0
+        else:
+            shard_ids = order
+            stride, phase = total_workers, global_worker_id
+        return [self.shards[i] for i in shard_ids], [self.shard_counts[i] for i in shard_ids], stride, phase
+
+    def _iter_stream(self, shards, counts, stride, phase, start, keep=None):
+        """Yield (position, sample) of the worker stream from ``start`` on, cycling over its shards."""
+        cum_counts = [0]
+        for count in counts:
+            cum_counts.append(cum_counts[-1] + count)
+        records_per_cycle = len(range(phase, cum_counts[-1], stride))
+        if records_per_cycle == 0:
+            raise ValueError(f"No records for the dataloader worker with phase {phase} in {shards}")
+
+        cycle, first = divmod(start, records_per_cycle)
+        while True:
+            first_record = first * stride + phase
+            first_shard = bisect.bisect_right(cum_counts, first_record) - 1
+            for shard_idx in range(first_shard, len(shards)):
+                base = cycle * records_per_cycle
+
+                def to_position(offset, shard_idx=shard_idx, base=base):
+                    record = cum_counts[shard_idx] + offset - phase
+                    return base + record // stride if record % stride == 0 else None
+
+                def keep_offset(offset):
+                    position = to_position(offset)
+                    return position is not None and position >= start and (keep is None or keep(position))
+
+                shard_start = max(first_record - cum_counts[shard_idx], 0)
+                for offset, sample in iter_shard_records(shards[shard_idx], shard_start, keep_offset):
+                    position = to_position(offset)
+                    if position is not None and position >= start:
+                        yield position, sample
+            cycle, first = cycle + 1, 0
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        quota = self._get_worker_quota(worker_id, num_workers, self.num_batches)
+        skip = self._get_worker_quota(worker_id, num_workers, min(self.start_batch, self.num_batches))
+        shards, counts, stride, phase = self._get_worker_stream(self.rank * num_workers + worker_id, self.world_size * num_workers)
+        # a buffer larger than the records of the worker would hold some of them twice
+        buffer_size = max(min(self.shuffle_buffer_size, len(range(phase, sum(counts), stride))), 1)
+
+        # replay the draws of the skipped samples on positions only, no record is read
+        rng = random.Random(f"{self.seed}-{self.epoch}-{self.rank}-{worker_id}")
+        buffer_positions = list(range(buffer_size))
+        next_position = buffer_size
+        for _ in range(skip):
+            buffer_positions[rng.randrange(buffer_size)] = next_position
+            next_position += 1
+
+        wanted = set(buffer_positions)
+        stream = self._iter_stream(shards, counts, stride, phase, min(buffer_positions), keep=lambda position: position in wanted or position >= next_position)
+        buffered = {}
+        for position, sample in stream:
+            if position in wanted:
+                buffered[position] = sample
+            if position == next_position - 1:
+                break
+        buffer = [buffered[position] for position in buffer_positions]
+        del buffered
+
+        last_good = None
+        for sample_idx in range(skip, quota):
+            slot = rng.randrange(buffer_size)
+            sample = buffer[slot]
+            buffer[slot] = next(stream)[1]
+            try:
+                last_good = self.process_fn(sample, sample_idx)
+            except Exception as e:
+                # the broken sample is replaced by the previous one, so the stream positions stay exact
+                print(f"Failed to process streamed sample {sample.get('id') if isinstance(sample, dict) else None}. Exception:", e)
+                if last_good is None:
+                    raise e
+            yield last_good
+
+
+class StreamDataLoader(DataLoader):
+    """DataLoader of a ``ShardedStreamDataset``, moving the dataset to the epochs set by the trainer."""
+
+    def __init__(self, dataset, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.resume_state = None
+        self.epoch = 0
+        self.num_batches_consumed = 0
+
+    def set_epoch(self, epoch):
+        start_batch = 0
+        if self.resume_state is not None and self.resume_state["epoch"] == epoch:
+            start_batch = self.resume_state["num_batches"]
+            rank0_print(f"Resuming the data stream at epoch {epoch} after {start_batch} batches")
+        self.resume_state = None
+        self.epoch = epoch
+        self.num_batches_consumed = start_batch
+        self.dataset.set_epoch(epoch, start_batch)
+
+    def __iter__(self):
+        for batch in super().__iter__():
+            self.num_batches_consumed += 1
+            yield batch
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "num_batches": self.num_batches_consumed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count the records of tar/parquet shards into shard_counts.json next to them.")
+    parser.add_argument("--data_path", type=str, required=True, help="A shard, a directory of shards or a glob pattern")
+    parser.add_argument("--num_threads", type=int, default=16)
+    args = parser.parse_args()
+
+    shards = get_stream_shards(args.data_path)
+    with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+        counts = list(executor.map(count_shard_records, shards))
+    by_dir = {}
+    for shard, count in zip(shards, counts):
+        by_dir.setdefault(os.path.dirname(shard), {})[os.path.basename(shard)] = count
+    for shard_dir, dir_counts in by_dir.items():
+        with open(os.path.join(shard_dir, SHARD_COUNTS_FILE), "w") as f:
+            json.dump(dir_counts, f, indent=2)
+    print(f"Counted {sum(counts)} records in {len(shards)} shards")
+
+
+if __name__ == "__main__":
+    main()
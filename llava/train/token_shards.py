@@ -0,0 +1,154 @@
+"""Pretokenized conversation shards.
+
+``preprocess`` tokenizes every conversation turn by turn in the dataloader workers on every epoch. The
+conversations are tokenized once instead, in a forked process pool, and the ``input_ids`` / ``labels`` of every
+sample (int32, with ``IMAGE_TOKEN_INDEX`` placeholders) are written to compact shards:
+
+    <pretokenized_dir>/<key>/meta.json              number of samples, shard size, template
+    <pretokenized_dir>/<key>/offsets_<shard>.npy    int64 [samples in shard + 1], token offsets of every sample
+    <pretokenized_dir>/<key>/input_ids_<shard>.bin  int32, concatenated input_ids
+    <pretokenized_dir>/<key>/labels_<shard>.bin     int32, concatenated labels
+
+``key`` covers the manifests, the selected samples, the tokenizer and the conversation template, so changing
+any of them builds new shards. Samples whose text depends on the decoded media (videos with a time instruction)
+are stored empty and tokenized online.
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+
+from llava.utils import build_on_main_process, rank0_print
+
+TOKEN_SHARDS_VERSION = 1
+
+_pretokenize_fn = None
+
+
+def _write_shard(args):
+    shard_dir, shard_idx, start, end = args
+    input_ids_list, labels_list = [], []
+    offsets = np.zeros(end - start + 1, dtype=np.int64)
+    num_online = 0
+    for i in range(start, end):
+        result = _pretokenize_fn(i)
+        if result is None:
+            num_online += 1
+            length = 0
+        else:
+            input_ids, labels = result
+            input_ids_list.append(np.asarray(input_ids, dtype=np.int32))
+            labels_list.append(np.asarray(labels, dtype=np.int32))
+            length = len(input_ids)
+        offsets[i - start + 1] = offsets[i - start] + length
+
+    np.save(os.path.join(shard_dir, f"offsets_{shard_idx:05d}.npy"), offsets)
+    for name, arrays in [("input_ids", input_ids_list), ("labels", labels_list)]:
+        data = np.concatenate(arrays) if len(arrays) > 0 else np.zeros(0, dtype=np.int32)
+        data.tofile(os.path.join(shard_dir, f"{name}_{shard_idx:05d}.bin"))
+    return num_online
+
+
+def build_token_shards(output_dir, pretokenize_fn, num_samples, num_proc=None, shard_size=100000, meta=None):
+    """Write the shards of ``pretokenize_fn(i) -> (input_ids, labels) or None`` for every sample to ``output_dir``."""
+    global _pretokenize_fn
+    _pretokenize_fn = pretokenize_fn
+    num_proc = num_proc or os.cpu_count()
+    tmp_dir = f"{output_dir.rstrip(os.sep)}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    shards = [(tmp_dir, shard_idx, start, min(start + shard_size, num_samples)) for shard_idx, start in enumerate(range(0, num_samples, shard_size))]
+
+    start_time = time.time()
+    if num_proc <= 1 or len(shards) <= 1:
+        results = map(_write_shard, shards)
+    else:
+        # fork so that the workers inherit the dataset and the tokenizer instead of pickling them
+        pool = multiprocessing.get_context("fork").Pool(min(num_proc, len(shards)))
+        results = pool.imap(_write_shard, shards)
+    num_online = 0
+    for shard, shard_online in zip(shards, results):
+        num_online += shard_online
+        rank0_print(f"Pretokenized {shard[3]}/{num_samples} samples in {time.time() - start_time:.1f}s")
+    if num_proc > 1 and len(shards) > 1:
+        pool.close()
+        pool.join()
+    _pretokenize_fn = None
+
+    meta = dict(meta or {}, version=TOKEN_SHARDS_VERSION, num_samples=num_samples, shard_size=shard_size, num_online=num_online)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    # the complete directory appears at once, so a partial build is never picked up
+    if os.path.exists(output_dir):
+        shutil.rmtree(tmp_dir)
+    else:
+        os.replace(tmp_dir, output_dir)
+    return meta
+
+
+class TokenShards:
+    """Read-only access to shards written by ``build_token_shards``."""
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != TOKEN_SHARDS_VERSION:
+            raise ValueError(f"Unsupported token shards version {self.meta.get('version')} in {shard_dir}, please rebuild them.")
+        self.num_samples = self.meta["num_samples"]
+        self.shard_size = self.meta["shard_size"]
+        self._shards = {}
+
+    def __getstate__(self):
+        # memory maps are re-opened lazily in the receiving process
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def __len__(self):
+        return self.num_samples
+
+    def _get_shard(self, shard_idx):
+        if shard_idx not in self._shards:
+            offsets = np.load(os.path.join(self.shard_dir, f"offsets_{shard_idx:05d}.npy"))
+            arrays = []
+            for name in ["input_ids", "labels"]:
+                path = os.path.join(self.shard_dir, f"{name}_{shard_idx:05d}.bin")
+                # np.memmap refuses to map empty files
+                arrays.append(np.memmap(path, dtype=np.int32, mode="r") if os.path.getsize(path) > 0 else np.zeros(0, dtype=np.int32))
+            self._shards[shard_idx] = (offsets, *arrays)
+        return self._shards[shard_idx]
+
+    def get(self, i):
+        """Return the (input_ids, labels) long tensors of sample ``i``, or None if it has to be tokenized online."""
+        offsets, input_ids, labels = self._get_shard(i // self.shard_size)
+        start, end = int(offsets[i % self.shard_size]), int(offsets[i % self.shard_size + 1])
+        if start == end:
+            return None
+        return torch.from_numpy(input_ids[start:end].astype(np.int64)), torch.from_numpy(labels[start:end].astype(np.int64))
+
+
+def load_or_build_token_shards(pretokenized_dir, cache_key, pretokenize_fn, num_samples, num_proc=None, meta=None, poll_interval=10):
+    """Open the shards for ``cache_key``, building them on the main process if they are missing.
+
+    The other processes wait for the shards instead of building them again, see ``build_on_main_process``.
+    """
+    shard_dir = os.path.join(pretokenized_dir, f"tokens_{cache_key}")
+
+    def _build():
+        rank0_print(f"Pretokenized shards {shard_dir} not found, building them with {num_proc or os.cpu_count()} processes")
+        os.makedirs(pretokenized_dir, exist_ok=True)
+        build_token_shards(shard_dir, pretokenize_fn, num_samples, num_proc=num_proc, meta=meta)
+
+    # the shards are built in a temporary directory renamed to shard_dir once complete
+    build_on_main_process(_build, shard_dir, poll_interval=poll_interval)
+
+    token_shards = TokenShards(shard_dir)
+    if len(token_shards) != num_samples:
+        raise ValueError(f"Pretokenized shards {shard_dir} have {len(token_shards)} samples, expected {num_samples}")
+    rank0_print(f"Loaded pretokenized conversations of {num_samples} samples from {shard_dir}, {token_shards.meta['num_online']} are tokenized online")
+    return token_shards
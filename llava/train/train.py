@@ -15,8 +15,10 @@
 #    limitations under the License.
 
 import ast
+import io
 import os
 import copy
+import weakref
 from dataclasses import dataclass, field
 import json
 import logging
@@ -41,11 +43,21 @@
 from torch.utils.data import Dataset
 from llava.constants import IGNORE_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN, IMAGE_TOKEN_INDEX
 from llava.train.llava_trainer import LLaVATrainer
+from llava.train.packing_flash_attn_monkey_patch import replace_flash_attn_unpad_for_packing
 
 from llava import conversation as conversation_lib
 from llava.model import *
 from llava.mm_utils import process_highres_image, process_anyres_image, process_highres_image_crop_split, tokenizer_image_token
-from llava.utils import rank0_print, process_video_with_pyav, process_video_with_decord
+from llava.mm_utils import get_num_visual_tokens, parse_grid_pinpoints, TensorImageProcessor
+from llava.utils import rank0_print, process_video_with_pyav, process_video_with_decord, process_video_with_frame_cache, probe_video_with_decord, decode_many
+from llava.train.data_utils import load_data_dicts
+from llava.train.sample_index import SampleIndex, is_sample_index, get_sample_modality, MODALITY_IMAGE, MODALITY_TEXT, MODALITY_VIDEO
+from llava.train.parquet_data import ParquetSamples, is_parquet_data
+from llava.train.streaming import ShardedStreamDataset, get_stream_shards
+from llava.train.length_cache import get_dataset_key, get_length_cache_key, load_or_compute_lengths
+from llava.train.quarantine import load_quarantine
+from llava.train.feature_cache import VisualFeatureCache, get_feature_cache_key
+from llava.train.token_shards import load_or_build_token_shards
 
 torch.multiprocessing.set_sharing_strategy("file_system")
 
@@ -97,6 +109,9 @@ class ModelArguments:
     mm_qformer_depth: Optional[int] = field(default=3)
     mm_qformer_latents: Optional[int] = field(default=32)
     mm_qformer_pretrained: Optional[str] = field(default=None)
+    mm_token_merge_mode: str = field(default="merge", metadata={"help": "merge (bipartite soft matching of similar tokens) or prune (attention score of the mean token), for mm_resampler_type=token_merge."})
+    mm_token_merge_image_ratio: float = field(default=1.0, metadata={"help": "Fraction of the visual tokens of every image kept by mm_resampler_type=token_merge."})
+    mm_token_merge_video_ratio: float = field(default=1.0, metadata={"help": "Fraction of the visual tokens of every video kept by mm_resampler_type=token_merge."})
 
     rope_scaling_factor: Optional[float] = field(default=None)
     rope_scaling_type: Optional[str] = field(default=None)
@@ -112,12 +127,18 @@ class ModelArguments:
     delay_load: Optional[bool] = field(default=True)
     add_faster_video: Optional[bool] = field(default=False)
     faster_token_stride: Optional[int] = field(default=10)
+    mm_temporal_reduction: bool = field(default=False, metadata={"help": "Merge the runs of near-duplicate video frames after the spatial pooling, see reduce_temporal_redundancy in llava_arch.py."})
+    mm_temporal_similarity_threshold: float = field(default=0.95, metadata={"help": "Mean token cosine similarity from which a video frame is merged into the run of frames before it."})
+    mm_temporal_min_frames: int = field(default=8, metadata={"help": "Minimum number of frames of every video kept by mm_temporal_reduction."})
+    mm_vision_tower_micro_batch: int = field(default=0, metadata={"help": "Run the vision tower over the tiles and frames of a batch in micro batches of exactly this many images, the last one zero padded. Caps the activations of a frozen tower. Disabled if 0."})
+    mm_grouped_unpad: bool = field(default=False, metadata={"help": "Run the spatial_unpad merge of the anyres images once per group of images of the same grid and crop, see merge_unpad_features_grouped in llava_arch.py."})
+    mm_batched_splice: bool = field(default=False, metadata={"help": "Splice the image features into the text embeddings of the whole batch at once, see splice_multimodal_batched in llava_arch.py."})
 
 
 
 @dataclass
 class DataArguments:
-    data_path: str = field(default=None, metadata={"help": "Path to the training data, in llava's instruction.json format. Supporting multiple json files via /path/to/{a,b,c}.json"})
+    data_path: str = field(default=None, metadata={"help": "Path to the training data, in llava's instruction.json format. Supporting multiple json files via /path/to/{a,b,c}.json, a sample index compiled with llava.train.sample_index, or parquet shards written by scripts/train/data_parq.py (a .parquet file, a directory or a glob)"})
     lazy_preprocess: bool = False
     is_multimodal: bool = False
     early_mix_text: bool = False
@@ -125,6 +146,8 @@ class DataArguments:
     image_aspect_ratio: str = "square"
     image_grid_pinpoints: Optional[str] = field(default=None)
     image_crop_resolution: Optional[int] = field(default=None)
+    image_preprocess_backend: str = field(default="pil", metadata={"help": "pil (the image processor of the vision tower) or torch (batched tensor resize/normalize, see TensorImageProcessor)."})
+    image_preprocess_threads: int = field(default=0, metadata={"help": "Size of the thread pool of the torch preprocessing backend in every dataloader worker. No pool if 0."})
     image_split_resolution: Optional[int] = field(default=None)
 
     video_folder: Optional[str] = field(default=None)
@@ -132,6 +155,24 @@ class DataArguments:
     frames_upbound: Optional[int] = field(default=0)
     add_time_instruction: Optional[bool] = field(default=False)
     force_sample: Optional[bool] = field(default=False)
+    video_decode_backend: str = field(default="auto", metadata={"help": "decord, pyav (sparse, seek-based decoding) or auto (pyav for long videos and containers without a frame count)."})
+    video_sparse_min_duration: float = field(default=600.0, metadata={"help": "Minimum length in seconds of the videos decoded with pyav by video_decode_backend=auto."})
+    video_decode_threads: int = field(default=1, metadata={"help": "Number of decord decode threads per dataloader worker."})
+    video_reader_pool_size: int = field(default=0, metadata={"help": "Number of recently decoded videos whose decord readers stay open in every dataloader worker. Disabled if 0."})
+    video_decode_log_interval: int = field(default=0, metadata={"help": "Print the per-stage decode timings of the reader pool every N videos. Disabled if 0."})
+    video_batch_decode_workers: int = field(default=0, metadata={"help": "Number of threads decoding the videos of a batch concurrently in every dataloader worker. Videos are decoded one by one if 0."})
+    video_frame_cache_dir: Optional[str] = field(default=None, metadata={"help": "Directory caching the sampled frames of every video after its first decode. Disabled if None."})
+    video_frame_cache_max_gb: float = field(default=0, metadata={"help": "Size of the video frame cache above which its least recently used entries are deleted. Unbounded if 0."})
+
+    length_cache_dir: Optional[str] = field(default=None, metadata={"help": "Directory of the exact token length cache used by the length-grouped samplers. Disabled if None."})
+    length_cache_num_proc: Optional[int] = field(default=None, metadata={"help": "Number of processes computing the token length cache and the pretokenized shards, defaults to the number of CPUs."})
+    quarantine_dir: Optional[str] = field(default=None, metadata={"help": "Directory of the persistent quarantine of samples that failed to load. Failing samples are retried with sleeps if None."})
+    precheck_media: bool = field(default=False, metadata={"help": "Check the media of every sample in parallel before training and quarantine the broken ones, requires quarantine_dir."})
+    pretokenized_dir: Optional[str] = field(default=None, metadata={"help": "Directory of the pretokenized conversation shards, built on the first run. Conversations are tokenized online if None."})
+    feature_cache_dir: Optional[str] = field(default=None, metadata={"help": "Vision tower feature cache built with llava.train.feature_cache. Cached images skip decoding and the vision tower, only valid while the vision tower is frozen."})
+    parquet_row_group_cache_size: int = field(default=4, metadata={"help": "Number of recently read parquet row groups kept in every dataloader worker when data_path points to parquet shards."})
+    streaming: bool = field(default=False, metadata={"help": "Stream the tar or parquet shards at data_path sequentially instead of reading samples at random, see llava.train.streaming."})
+    stream_shuffle_buffer_size: int = field(default=1000, metadata={"help": "Number of samples every dataloader worker shuffles in streaming mode."})
 
 
 @dataclass
@@ -164,6 +205,8 @@ class TrainingArguments(transformers.TrainingArguments):
     gradient_checkpointing: bool = field(default=True)
     verbose_logging: bool = field(default=False)
     attn_implementation: str = field(default="flash_attention_2", metadata={"help": "Use transformers attention implementation."})
+    packing: bool = field(default=False, metadata={"help": "Pack the samples of a batch into rows of up to model_max_length tokens and attend within each sample only. Requires flash_attention_2."})
+    max_tokens_per_batch: Optional[int] = field(default=None, metadata={"help": "Batch the samples of every rank by an estimate of their padded tokens, text plus visual, instead of per_device_train_batch_size. Exact with length_cache_dir."})
 
 
 # @dataclass
@@ -557,32 +600,61 @@ def preprocess_gemma(sources: List[List[Dict[str, str]]], tokenizer: transformer
     )
 
 
-def preprocess_qwen(sources, tokenizer: transformers.PreTrainedTokenizer, has_image: bool = False, max_len=2048, system_message: str = "You are a helpful assistant.") -> Dict:
-    # roles = {"human": "<|im_start|>user", "gpt": "<|im_start|>assistant"}
-    roles = {"human": "user", "gpt": "assistant"}
+# the compiled templates of a tokenizer are dropped with it
+_compiled_templates = weakref.WeakKeyDictionary()
+
+
+def get_compiled_template(name, tokenizer, has_image, system_message, compile_fn):
+    """
+    Fixed token id fragments of a chat template, compiled once per tokenizer.
+
+    The templates used to deepcopy the tokenizer and re-tokenize the system prompt and role headers for every
+    sample. The compiled template keeps the tokenizer copy (with the template's special tokens added) and those
+    fragments, so only the free text of a conversation is tokenized per sample.
+    """
+    templates = _compiled_templates.setdefault(tokenizer, {})
+    key = (name, len(tokenizer), has_image, system_message)
+    if key not in templates:
+        templates[key] = compile_fn(tokenizer, has_image, system_message)
+    return templates[key]
 
+
+def compile_qwen_template(tokenizer, has_image, system_message):
     # Add image tokens to tokenizer as a special tokens
     # Use a deepcopy of tokenizer so that we don't modify on the tokenizer
     tokenizer = copy.deepcopy(tokenizer)
     # im_start, im_end = tokenizer.additional_special_tokens_ids
-    tokenizer.add_tokens(['<|im_start|>', '<|im_end|>'], special_tokens=True)
-    im_start, im_end = tokenizer.convert_tokens_to_ids(['<|im_start|>', '<|im_end|>'])
+    tokenizer.add_tokens(["<|im_start|>", "<|im_end|>"], special_tokens=True)
+    im_start, im_end = tokenizer.convert_tokens_to_ids(["<|im_start|>", "<|im_end|>"])
     # When there is actually an image, we add the image tokens as a special token
     if has_image:
         tokenizer.add_tokens(["<image>"], special_tokens=True)
 
-    image_token_index = tokenizer.convert_tokens_to_ids("<image>")
-    # unmask_tokens = ["<|im_start|>", "<|im_start|>", "\n"]
-    unmask_tokens_idx =  [198, im_start, im_end]
-    nl_tokens = tokenizer("\n").input_ids
-
     # Reset Qwen chat templates so that it won't include system message every time we apply
     chat_template = "{% for message in messages %}{{'<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n'}}{% endfor %}{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
     tokenizer.chat_template = chat_template
 
-    # _system = tokenizer("system").input_ids + nl_tokens
-    # _user = tokenizer("user").input_ids + nl_tokens
-    # _assistant = tokenizer("assistant").input_ids + nl_tokens
+    return dict(
+        tokenizer=tokenizer,
+        im_start=im_start,
+        im_end=im_end,
+        image_token_index=tokenizer.convert_tokens_to_ids("<image>"),
+        # unmask_tokens = ["\n", "<|im_start|>", "<|im_end|>"]
+        unmask_tokens_idx={198, im_start, im_end},
+        nl_tokens=tokenizer("\n").input_ids,
+        system_ids=tokenizer.apply_chat_template([{"role": "system", "content": system_message}]),
+    )
+
+
+def preprocess_qwen(sources, tokenizer: transformers.PreTrainedTokenizer, has_image: bool = False, max_len=2048, system_message: str = "You are a helpful assistant.") -> Dict:
+    # roles = {"human": "<|im_start|>user", "gpt": "<|im_start|>assistant"}
+    roles = {"human": "user", "gpt": "assistant"}
+
+    template = get_compiled_template("qwen", tokenizer, has_image, system_message, compile_qwen_template)
+    tokenizer = template["tokenizer"]
+    im_start, im_end, nl_tokens = template["im_start"], template["im_end"], template["nl_tokens"]
+    image_token_index = template["image_token_index"]
+    unmask_tokens_idx = template["unmask_tokens_idx"]
 
     # Apply prompt templates
     input_ids, targets = [], []
@@ -590,13 +662,9 @@ def preprocess_qwen(sources, tokenizer: transformers.PreTrainedTokenizer, has_im
         if roles[source[0]["from"]] != roles["human"]:
             source = source[1:]
 
-        input_id, target = [], []
-
-        # New version, use apply chat template
-        # Build system message for each sentence
-        input_id += tokenizer.apply_chat_template([{"role" : "system", "content" : system_message}])
-        target += [IGNORE_INDEX] * len(input_id)
-
+        # Every turn renders to <|im_start|>{role}\n{content}<|im_end|>\n. The special tokens split the text, so
+        # tokenizing "{role}\n{content}" (cut at <image>) on its own gives exactly the ids of apply_chat_template.
+        turns = []
         for conv in source:
             # Make sure llava data can load
             try:
@@ -605,19 +673,29 @@ def preprocess_qwen(sources, tokenizer: transformers.PreTrainedTokenizer, has_im
             except:
                 role = conv["from"]
                 content = conv["value"]
+            role = roles.get(role, role)
+            text = f"{role}\n{content}"
+            turns.append((role, text.split("<image>") if has_image else [text]))
+        pieces_ids = iter(tokenizer([piece for _, pieces in turns for piece in pieces], add_special_tokens=False).input_ids)
 
-            role =  roles.get(role, role)
-            
-            conv = [{"role" : role, "content" : content}]
-            encode_id = tokenizer.apply_chat_template(conv)
+        # New version, use apply chat template
+        # Build system message for each sentence
+        input_id = list(template["system_ids"])
+        target = [IGNORE_INDEX] * len(input_id)
+
+        for role, pieces in turns:
+            encode_id = [im_start]
+            for piece_idx in range(len(pieces)):
+                if piece_idx > 0:
+                    encode_id.append(image_token_index)
+                encode_id += next(pieces_ids)
+            encode_id += [im_end] + nl_tokens
             input_id += encode_id
             if role in ["user", "system"]:
                 target += [IGNORE_INDEX] * len(encode_id)
             else:
                 target += encode_id
-        
 
-                    
         assert len(input_id) == len(target), f"{len(input_id)} != {len(target)}"
         for idx, encode_id in enumerate(input_id):
             if encode_id in unmask_tokens_idx:
@@ -635,6 +713,62 @@ def preprocess_qwen(sources, tokenizer: transformers.PreTrainedTokenizer, has_im
     )
 
 
+def compile_llama3_template(tokenizer, has_image, system_message):
+    # Add image tokens to tokenizer as a special tokens
+    # Use a deepcopy of tokenizer so that we don't modify on the tokenizer
+    tokenizer = copy.deepcopy(tokenizer)
+    # When there is actually an image, we add the image tokens as a special token
+    if has_image:
+        tokenizer.add_tokens(["<image>"], special_tokens=True)
+
+    unmask_tokens = ["<|begin_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>", "\n\n"]
+    template = dict(
+        tokenizer=tokenizer,
+        has_image=has_image,
+        image_token_index=tokenizer.convert_tokens_to_ids("<image>"),
+        start_header_id=tokenizer.convert_tokens_to_ids("<|start_header_id|>"),
+        end_header_id=tokenizer.convert_tokens_to_ids("<|end_header_id|>"),
+        eot_id=tokenizer.convert_tokens_to_ids("<|eot_id|>"),
+        # <|start_header_id|>{role}<|end_header_id|> of every role seen so far
+        header_ids={},
+        unmask_tokens_idx={tokenizer.convert_tokens_to_ids(tok) for tok in unmask_tokens},
+        system_ids=tokenizer.apply_chat_template([{"role": "system", "content": system_message}]),
+    )
+    # tokenizers whose chat template renders a turn differently (e.g. the Llama-3.1 date header) keep apply_chat_template
+    probe = [("user", " <image>\nWhat is shown here? \n"), ("assistant", "A cat.\n\nIt is asleep.")]
+    template["compiled_turns"] = encode_llama3_turns(template, probe) == [tokenizer.apply_chat_template([{"role": role, "content": content}])[1:] for role, content in probe]
+    return template
+
+
+def encode_llama3_turns(template, turns):
+    """
+    Token ids of every (role, content) turn, the same as ``apply_chat_template([turn])[1:]`` of the Llama-3 template.
+
+    Every turn renders to <|start_header_id|>{role}<|end_header_id|>\n\n{content | trim}<|eot_id|>. The special tokens
+    split the text, so the header comes from the compiled fragments and "\n\n{content}" (cut at <image>) of all turns
+    is tokenized in one call.
+    """
+    tokenizer = template["tokenizer"]
+    turn_pieces = []
+    for _, content in turns:
+        text = "\n\n" + content.strip()
+        turn_pieces.append(text.split("<image>") if template["has_image"] else [text])
+    pieces_ids = iter(tokenizer([piece for pieces in turn_pieces for piece in pieces], add_special_tokens=False).input_ids if turns else [])
+
+    encode_ids = []
+    for (role, _), pieces in zip(turns, turn_pieces):
+        if role not in template["header_ids"]:
+            template["header_ids"][role] = [template["start_header_id"]] + tokenizer(role, add_special_tokens=False).input_ids + [template["end_header_id"]]
+        encode_id = list(template["header_ids"][role])
+        for piece_idx in range(len(pieces)):
+            if piece_idx > 0:
+                encode_id.append(template["image_token_index"])
+            encode_id += next(pieces_ids)
+        encode_id.append(template["eot_id"])
+        encode_ids.append(encode_id)
+    return encode_ids
+
+
 def preprocess_llama3(
     sources,
     tokenizer: transformers.PreTrainedTokenizer,
@@ -645,43 +779,18 @@ def preprocess_llama3(
     # roles = {"human": "<|start_header_id|>user<|end_header_id|>", "gpt": "<|start_header_id|>assistant<|end_header_id|>"}
     roles = {"human": "user", "gpt": "assistant"}
 
-    # Add image tokens to tokenizer as a special tokens
-    # Use a deepcopy of tokenizer so that we don't modify on the tokenizer
-    tokenizer = copy.deepcopy(tokenizer)
-    # When there is actually an image, we add the image tokens as a special token
-    if has_image:
-        tokenizer.add_tokens(["<image>"], special_tokens=True)
-    image_token_index = tokenizer.convert_tokens_to_ids("<image>")
-    bos_token_id = tokenizer.convert_tokens_to_ids("<|begin_of_text|>")
-    start_header_id = tokenizer.convert_tokens_to_ids("<|start_header_id|>")
-    end_header_id = tokenizer.convert_tokens_to_ids("<|end_header_id|>")
-    eot_id = tokenizer.convert_tokens_to_ids("<|eot_id|>")
-
-    unmask_tokens = ["<|begin_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>", "\n\n"]
-    unmask_tokens_idx = [tokenizer.convert_tokens_to_ids(tok) for tok in unmask_tokens]
-
-    # After update, calling tokenizer of llama3 will
-    # auto add bos id for the tokens. ヽ(｀⌒´)ﾉ
-    def safe_tokenizer_llama3(text):
-        input_ids = tokenizer(text).input_ids
-        if input_ids[0] == bos_token_id:
-            input_ids = input_ids[1:]
-        return input_ids
+    template = get_compiled_template("llama3", tokenizer, has_image, system_message, compile_llama3_template)
+    tokenizer = template["tokenizer"]
+    image_token_index = template["image_token_index"]
+    unmask_tokens_idx = template["unmask_tokens_idx"]
 
-    nl_tokens = tokenizer.convert_tokens_to_ids("\n\n")
     # Apply prompt templates
     input_ids, targets = [], []
     for i, source in enumerate(sources):
         if roles[source[0]["from"]] != roles["human"]:
             source = source[1:]
 
-        input_id, target = [], []
-
-        # New version, use apply chat template
-        # Build system message for each sentence
-        input_id += tokenizer.apply_chat_template([{"role" : "system", "content" : system_message}])
-        target += [IGNORE_INDEX] * len(input_id)
-
+        turns = []
         for conv in source:
             # Make sure llava data can load
             try:
@@ -690,20 +799,25 @@ def safe_tokenizer_llama3(text):
             except:
                 role = conv["from"]
                 content = conv["value"]
-
-            role =  roles.get(role, role)
-            
-            conv = [{"role" : role, "content" : content}]
+            turns.append((roles.get(role, role), content))
+        if template["compiled_turns"]:
+            turns_ids = encode_llama3_turns(template, turns)
+        else:
             # First is bos token we don't need here
-            encode_id = tokenizer.apply_chat_template(conv)[1:]
+            turns_ids = [tokenizer.apply_chat_template([{"role": role, "content": content}])[1:] for role, content in turns]
+
+        # New version, use apply chat template
+        # Build system message for each sentence
+        input_id = list(template["system_ids"])
+        target = [IGNORE_INDEX] * len(input_id)
+
+        for (role, _), encode_id in zip(turns, turns_ids):
             input_id += encode_id
             if role in ["user", "system"]:
                 target += [IGNORE_INDEX] * len(encode_id)
             else:
                 target += encode_id
-        
 
-                    
         assert len(input_id) == len(target), f"{len(input_id)} != {len(target)}"
         for idx, encode_id in enumerate(input_id):
             if encode_id in unmask_tokens_idx:
@@ -958,97 +1072,225 @@ class LazySupervisedDataset(Dataset):
     def __init__(self, data_path: str, tokenizer: transformers.PreTrainedTokenizer, data_args: DataArguments):
         super(LazySupervisedDataset, self).__init__()
         self.tokenizer = tokenizer
-        self.list_data_dict = []
-
-        # Handle multiple JSON files specified in the data_path
-        if "{" in data_path and "}" in data_path:
-            base_path, file_pattern = re.match(r"^(.*)\{(.*)\}\.json$", data_path).groups()
-            file_names = file_pattern.split(",")
-            rank0_print(f"Loading {file_names} from {base_path}")
-            data_args.dataset_paths = []
-            for file_name in file_names:
-                data_args.dataset_paths.append(f"{base_path}{file_name}.json")
-                full_path = f"{base_path}{file_name}.json"
-                rank0_print(f"Loading {full_path}")
-                with open(full_path, "r") as file:
-                    cur_data_dict = json.load(file)
-                    rank0_print(f"Loaded {len(cur_data_dict)} samples from {full_path}")
-                    self.list_data_dict.extend(cur_data_dict)
-        elif data_path.endswith(".yaml"):
-            with open(data_path, "r") as file:
-                yaml_data = yaml.safe_load(file)
-                datasets = yaml_data.get("datasets")
-                # file should be in the format of:
-                # datasets:
-                #   - json_path: xxxx1.json
-                #     sampling_strategy: first:1000
-                #   - json_path: xxxx2.json
-                #     sampling_strategy: end:3000
-                #   - json_path: xxxx3.json
-                #     sampling_strategy: random:999
-                data_args.dataset_paths = [dataset.get("json_path") for dataset in datasets]
-                for dataset in datasets:
-                    json_path = dataset.get("json_path")
-                    sampling_strategy = dataset.get("sampling_strategy", "all")
-                    sampling_number = None
-
-                    rank0_print(f"Loading {json_path} with {sampling_strategy} sampling strategy")
-
-                    if json_path.endswith(".jsonl"):
-                        cur_data_dict = []
-                        with open(json_path, "r") as json_file:
-                            for line in json_file:
-                                cur_data_dict.append(json.loads(line.strip()))
-                    elif json_path.endswith(".json"):
-                        with open(json_path, "r") as json_file:
-                            cur_data_dict = json.load(json_file)
-                    else:
-                        raise ValueError(f"Unsupported file type: {json_path}")
-
-                    if ":" in sampling_strategy:
-                        sampling_strategy, sampling_number = sampling_strategy.split(":")
-                        if "%" in sampling_number:
-                            sampling_number = math.ceil(int(sampling_number.split("%")[0]) * len(cur_data_dict) / 100)
-                        else:
-                            sampling_number = int(sampling_number)
-
-                    # Apply the sampling strategy
-                    if sampling_strategy == "first" and sampling_number is not None:
-                        cur_data_dict = cur_data_dict[:sampling_number]
-                    elif sampling_strategy == "end" and sampling_number is not None:
-                        cur_data_dict = cur_data_dict[-sampling_number:]
-                    elif sampling_strategy == "random" and sampling_number is not None:
-                        random.shuffle(cur_data_dict)
-                        cur_data_dict = cur_data_dict[:sampling_number]
-
-                    rank0_print(f"Loaded {len(cur_data_dict)} samples from {json_path}")
-                    self.list_data_dict.extend(cur_data_dict)
-        else:
-            data_args.dataset_paths = [data_path]
-            rank0_print(f"Loading {data_path}")
-            with open(data_path, "r") as file:
-                cur_data_dict = json.load(file)
-                rank0_print(f"Loaded {len(cur_data_dict)} samples from {data_path}")
-                self.list_data_dict.extend(cur_data_dict)
+        self.list_data_dict = self.load_samples(data_path, data_args)
 
         rank0_print(f"Loaded {len(self.list_data_dict)} samples from {data_path}")
         rank0_print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
         self.data_args = data_args
+        self.token_lengths = None
+        self.token_modality = None
+        self.token_shards = None
+        self.quarantine = None
+        self.feature_cache = None
+        self.dataset_key = None
+        # videos of the batch being fetched by __getitems__, decoded ahead by _prefetch_videos
+        self.prefetched_videos = {}
+        if data_args.feature_cache_dir is not None:
+            self.feature_cache = VisualFeatureCache(data_args.feature_cache_dir)
+            rank0_print(f"Loaded vision tower feature cache of {len(self.feature_cache)} images from {data_args.feature_cache_dir}")
 
     def __len__(self):
         return len(self.list_data_dict)
 
+    def load_samples(self, data_path, data_args):
+        if is_sample_index(data_path):
+            rank0_print(f"Opening compiled sample index {data_path}")
+            list_data_dict = SampleIndex(data_path)
+            data_args.dataset_paths = list_data_dict.dataset_paths
+        else:
+            list_data_dict, data_args.dataset_paths = load_data_dicts(data_path)
+        return list_data_dict
+
+    def open_image(self, image_file):
+        """Open an image given by its path under image_folder, or by its encoded bytes."""
+        if isinstance(image_file, (bytes, bytearray)):
+            return Image.open(io.BytesIO(image_file))
+        return Image.open(os.path.join(self.data_args.image_folder, image_file))
+
+    def get_dataset_key(self):
+        # hashing the selected samples takes a while on large manifests, it is shared by all caches
+        if self.dataset_key is None:
+            self.dataset_key = get_dataset_key(self.data_args.data_path, self.data_args.dataset_paths, self.list_data_dict)
+        return self.dataset_key
+
+    def load_token_lengths(self):
+        settings = {
+            "conversation_version": conversation_lib.default_conversation.version,
+            "is_multimodal": self.data_args.is_multimodal,
+            "mm_use_im_start_end": getattr(self.data_args, "mm_use_im_start_end", False),
+            "visual_token_config": getattr(self.data_args, "visual_token_config", None),
+            "video": [self.data_args.video_fps, self.data_args.frames_upbound, self.data_args.force_sample, self.data_args.add_time_instruction],
+        }
+        cache_key = get_length_cache_key(self.get_dataset_key(), self.tokenizer, settings)
+        self.token_lengths, self.token_modality = load_or_compute_lengths(self.data_args.length_cache_dir, cache_key, self._get_token_length, len(self), num_proc=self.data_args.length_cache_num_proc)
+
+    def load_token_shards(self):
+        settings = {
+            "conversation_version": conversation_lib.default_conversation.version,
+            "is_multimodal": self.data_args.is_multimodal,
+            "mm_use_im_start_end": getattr(self.data_args, "mm_use_im_start_end", False),
+            "add_time_instruction": self.data_args.add_time_instruction,
+        }
+        cache_key = get_length_cache_key(self.get_dataset_key(), self.tokenizer, settings)
+        self.token_shards = load_or_build_token_shards(self.data_args.pretokenized_dir, cache_key, self._pretokenize, len(self), num_proc=self.data_args.length_cache_num_proc, meta=settings)
+
+    def load_quarantine(self):
+        dataset_key = self.get_dataset_key()
+        check_fn = self._check_media if self.data_args.precheck_media else None
+        self.quarantine = load_quarantine(self.data_args.quarantine_dir, dataset_key, check_fn=check_fn, num_samples=len(self), num_proc=self.data_args.length_cache_num_proc)
+
+    def _check_media(self, i):
+        """Error message if the media of sample i can not be read, None otherwise. Does not decode the pixels."""
+        sample = self.list_data_dict[i]
+        try:
+            if "image" in sample:
+                image_files = sample["image"] if type(sample["image"]) is list else [sample["image"]]
+                for image_file in image_files:
+                    with self.open_image(image_file) as image:
+                        image.verify()
+            elif "video" in sample:
+                video_file = os.path.join(self.data_args.video_folder, sample["video"])
+                if not os.path.exists(video_file):
+                    return f"File {video_file} not exist!"
+                if os.path.isdir(video_file):
+                    if len(os.listdir(video_file)) == 0:
+                        return f"No frames in {video_file}"
+                elif probe_video_with_decord(video_file, self.data_args)[2] == 0:
+                    return f"No frames in {video_file}"
+        except Exception as e:
+            return repr(e)
+        return None
+
+    def _pretokenize(self, i):
+        """input_ids and labels of sample i as produced by preprocess(), or None if it has to be tokenized online."""
+        sample = self.list_data_dict[i]
+        if "video" in sample and self.data_args.add_time_instruction:
+            # the time instruction is built from the decoded video
+            return None
+        try:
+            if "image" in sample or "video" in sample:
+                sources = preprocess_multimodal(copy.deepcopy([sample["conversations"]]), self.data_args)
+            else:
+                sources = copy.deepcopy([sample["conversations"]])
+            has_image = ("image" in sample) or ("video" in sample)
+            data_dict = preprocess(sources, self.tokenizer, has_image=has_image)
+        except Exception as e:
+            print(f"Failed to pretokenize sample {i}, it will be tokenized online. Exception:", e)
+            return None
+        return data_dict["input_ids"][0].numpy(), data_dict["labels"][0].numpy()
+
+    def _get_token_length(self, i):
+        """Exact number of tokens sample i occupies after preprocess() and the image splicing of the model."""
+        sample = self.list_data_dict[i]
+        try:
+            visual_token_config = getattr(self.data_args, "visual_token_config", None)
+            num_visual_tokens = 0
+            if "image" in sample:
+                image_files = sample["image"] if type(sample["image"]) is list else [sample["image"]]
+                for image_file in image_files:
+                    if visual_token_config is None:
+                        break
+                    with self.open_image(image_file) as image:
+                        image_size = image.size
+                    image_config = dict(visual_token_config)
+                    if len(image_files) > 1:
+                        # multi images are processed with simple pad
+                        image_config["image_aspect_ratio"] = "pad"
+                    num_visual_tokens += get_num_visual_tokens(image_size, **image_config)
+                sources = preprocess_multimodal(copy.deepcopy([sample["conversations"]]), self.data_args)
+            elif "video" in sample:
+                video_file = os.path.join(self.data_args.video_folder, sample["video"])
+                conversations = copy.deepcopy(sample["conversations"])
+                if "shareVideoGPTV" in video_file:
+                    num_frames = self.data_args.frames_upbound if self.data_args.force_sample else 10
+                    video_time, frame_time = num_frames / 2, ",".join([f"{i / 2:.2f}s" for i in range(num_frames)])
+                else:
+                    video_time, frame_time, num_frames = probe_video_with_decord(video_file, self.data_args)
+                if self.data_args.add_time_instruction:
+                    time_instruciton = f"The video lasts for {video_time:.2f} seconds, and {num_frames} frames are uniformly sampled from it. These frames are located at {frame_time}.Please answer the following questions related to this video."
+                    conversations[0]["value"] = f'{DEFAULT_IMAGE_TOKEN}\n{time_instruciton}\n{conversations[0]["value"].replace(DEFAULT_IMAGE_TOKEN, "")}'
+                if visual_token_config is not None:
+                    num_visual_tokens += get_num_visual_tokens(None, **visual_token_config, modality="video", num_frames=num_frames)
+                sources = preprocess_multimodal([conversations], self.data_args)
+            else:
+                sources = copy.deepcopy([sample["conversations"]])
+
+            has_image = ("image" in sample) or ("video" in sample)
+            input_ids = preprocess(sources, self.tokenizer, has_image=has_image)["input_ids"][0]
+            num_text_tokens = int((input_ids != IMAGE_TOKEN_INDEX).sum())
+            length = min(num_text_tokens + num_visual_tokens, self.tokenizer.model_max_length)
+        except Exception as e:
+            print(f"Failed to compute the token length of sample {i}, falling back to the word count. Exception:", e)
+            length = sum(len(conv["value"].split()) for conv in sample["conversations"]) + (128 if "image" in sample else 0)
+        return length, get_sample_modality(sample)
+
     @property
     def lengths(self):
+        if self.token_lengths is not None:
+            return self.token_lengths.tolist()
+        if isinstance(self.list_data_dict, (SampleIndex, ParquetSamples)):
+            img_tokens = np.where(self.list_data_dict.modality == MODALITY_IMAGE, 128, 0)
+            return (self.list_data_dict.text_lengths + img_tokens).tolist()
         length_list = []
         for sample in self.list_data_dict:
             img_tokens = 128 if "image" in sample else 0
             length_list.append(sum(len(conv["value"].split()) for conv in sample["conversations"]) + img_tokens)
         return length_list
 
+    def _estimate_visual_tokens(self, modality, num_images=1):
+        """Upper estimate of the visual tokens of a sample without reading its media: the largest anyres grid and frames_upbound frames."""
+        visual_token_config = getattr(self.data_args, "visual_token_config", None)
+        if modality == MODALITY_TEXT:
+            return 0
+        if visual_token_config is None:
+            return 128 * num_images
+        if modality == MODALITY_VIDEO:
+            num_frames = self.data_args.frames_upbound if self.data_args.frames_upbound > 0 else 32
+            return get_num_visual_tokens(None, **visual_token_config, modality="video", num_frames=num_frames)
+        image_config = dict(visual_token_config)
+        if num_images > 1:
+            # multi images are processed with simple pad
+            image_config["image_aspect_ratio"] = "pad"
+        pinpoints = image_config["image_grid_pinpoints"]
+        if isinstance(pinpoints, list) and len(pinpoints) > 0:
+            image_size = tuple(max(pinpoints, key=lambda pinpoint: pinpoint[0] * pinpoint[1]))
+        else:
+            image_size = (image_config["vision_tower_image_size"], image_config["vision_tower_image_size"])
+        return num_images * get_num_visual_tokens(image_size, **image_config)
+
+    @property
+    def token_budget_lengths(self):
+        """Token count of every sample for max_tokens_per_batch: exact if the length cache is loaded, estimated otherwise."""
+        if self.token_lengths is not None:
+            return self.token_lengths.astype(np.int64)
+        max_length = self.tokenizer.model_max_length
+        if isinstance(self.list_data_dict, (SampleIndex, ParquetSamples)):
+            modality = np.asarray(self.list_data_dict.modality)
+            visual_tokens = np.zeros(len(modality), dtype=np.int64)
+            for mod in (MODALITY_IMAGE, MODALITY_VIDEO):
+                visual_tokens[modality == mod] = self._estimate_visual_tokens(mod)
+            return np.minimum(np.asarray(self.list_data_dict.text_lengths, dtype=np.int64) + visual_tokens, max_length)
+        length_list = []
+        for sample in self.list_data_dict:
+            num_images = len(sample["image"]) if type(sample.get("image")) is list else 1
+            cur_len = sum(len(conv["value"].split()) for conv in sample["conversations"]) + self._estimate_visual_tokens(get_sample_modality(sample), num_images)
+            length_list.append(min(cur_len, max_length))
+        return np.asarray(length_list, dtype=np.int64)
+
     @property
     def modality_lengths(self):
+        if self.token_lengths is not None:
+            cur_len = self.token_lengths.astype(np.int64)
+            if self.data_args.early_mix_text:
+                return cur_len.tolist()
+            return np.where(self.token_modality != MODALITY_TEXT, cur_len, -cur_len).tolist()
+        if isinstance(self.list_data_dict, (SampleIndex, ParquetSamples)):
+            cur_len = np.asarray(self.list_data_dict.text_lengths, dtype=np.int64)
+            assert (cur_len > 0).all(), f"Conversation length is 0 for samples {np.nonzero(cur_len <= 0)[0][:10].tolist()}"
+            if self.data_args.early_mix_text:
+                return cur_len.tolist()
+            return np.where(self.list_data_dict.modality != MODALITY_TEXT, cur_len, -cur_len).tolist()
         length_list = []
         for sample in self.list_data_dict:
             cur_len = sum(len(conv["value"].split()) for conv in sample["conversations"])
@@ -1060,19 +1302,23 @@ def modality_lengths(self):
         return length_list
 
     def process_image(self, image_file, overwrite_image_aspect_ratio=None):
-        image_folder = self.data_args.image_folder
         processor = self.data_args.image_processor
+        image_aspect_ratio = self.data_args.image_aspect_ratio
+        if overwrite_image_aspect_ratio is not None:
+            image_aspect_ratio = overwrite_image_aspect_ratio
+        if self.feature_cache is not None and isinstance(image_file, str):
+            cached = self.feature_cache.get(get_feature_cache_key(image_file, image_aspect_ratio))
+            if cached is not None:
+                # vision tower features, the model only runs them through the projector
+                return cached[0], cached[1], "image_feature"
         # print(f"\n\nInspecting the image path, folder = {image_folder}, image={image_file}\n\n")
         try:
-            image = Image.open(os.path.join(image_folder, image_file)).convert("RGB")
+            image = self.open_image(image_file).convert("RGB")
         except Exception as exn:
-            print(f"Failed to open image {image_file}. Exception:", exn)
+            print(f"Failed to open image {image_file if isinstance(image_file, str) else '<bytes>'}. Exception:", exn)
             raise exn
 
         image_size = image.size
-        image_aspect_ratio = self.data_args.image_aspect_ratio
-        if overwrite_image_aspect_ratio is not None:
-            image_aspect_ratio = overwrite_image_aspect_ratio
         if image_aspect_ratio == "highres":
             image = process_highres_image(image, self.data_args.image_processor, self.data_args.image_grid_pinpoints)
         elif image_aspect_ratio == "anyres" or "anyres_max" in image_aspect_ratio:
@@ -1101,6 +1347,9 @@ def expand2square(pil_img, background_color):
         return image, image_size, "image"
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        if self.quarantine is not None:
+            return self._get_item_or_substitute(i)
+
         # TODO: define number of retries somewhere else
         num_base_retries = 3
         num_final_retries = 300
@@ -1133,27 +1382,68 @@ def __getitem__(self, i) -> Dict[str, torch.Tensor]:
         except Exception as e:
             raise e
 
+    def __getitems__(self, indices) -> List[Dict[str, torch.Tensor]]:
+        """Fetch a batch, called by the DataLoader with the indices of a whole batch."""
+        if self.data_args.video_batch_decode_workers > 0:
+            self.prefetched_videos = self._prefetch_videos(indices)
+        try:
+            return [self[i] for i in indices]
+        finally:
+            self.prefetched_videos = {}
+
+    def _prefetch_videos(self, indices):
+        """Decode the videos of the samples in indices concurrently, the failed ones are decoded again by process_sample."""
+        video_files = []
+        for i in indices:
+            if self.quarantine is not None and i in self.quarantine:
+                continue
+            sample = self.list_data_dict[i]
+            if "image" in sample or "video" not in sample:
+                continue
+            video_file = os.path.join(self.data_args.video_folder, sample["video"])
+            if "shareVideoGPTV" not in video_file and video_file not in video_files:
+                video_files.append(video_file)
+        results = decode_many(video_files, lambda video_file: process_video_with_frame_cache(video_file, self.data_args), max_workers=self.data_args.video_batch_decode_workers)
+        return {video_file: result for video_file, result in zip(video_files, results) if not isinstance(result, Exception)}
+
+    def _get_item_or_substitute(self, i, max_substitutes=100):
+        """Fetch sample i, quarantining it and fetching a substitute if it fails."""
+        sample_idx = i
+        for _ in range(max_substitutes):
+            if sample_idx not in self.quarantine:
+                try:
+                    return self._get_item(sample_idx)
+                except Exception as e:
+                    print(f"Failed to fetch sample {sample_idx}, quarantining it. Exception:", e)
+                    self.quarantine.add(sample_idx, error=repr(e))
+            sample_idx = self.quarantine.get_substitute(sample_idx, len(self))
+        raise RuntimeError(f"Failed to find a loadable substitute for sample {i}")
+
     def _get_item(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
+        # fetch the sample once, every access to a SampleIndex parses it again
+        return self.process_sample(self.list_data_dict[i], i)
+
+    def process_sample(self, sample, i) -> Dict[str, torch.Tensor]:
+        sources = sample
         if isinstance(i, int):
             sources = [sources]
         assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
 
         if "image" in sources[0]:
-            image_file = self.list_data_dict[i]["image"]
+            image_file = sample["image"]
             if type(image_file) is list:
                 image = [self.process_image(f) for f in image_file]
                 # Handling multi images
                 # overwrite to process with simple pad 
                 if len(image_file) > 1:
                     image = [self.process_image(f, "pad") for f in image_file]
-                    image = [[im[0], im[1], "image"] for im in image]
+                    image = [[im[0], im[1], im[2]] for im in image]
             else:
                 image = [self.process_image(image_file)]
             sources = preprocess_multimodal(copy.deepcopy([e["conversations"] for e in sources]), self.data_args)
 
         elif "video" in sources[0]:
-            video_file = self.list_data_dict[i]["video"]
+            video_file = sample["video"]
             video_folder = self.data_args.video_folder
             video_file = os.path.join(video_folder, video_file)
             suffix = video_file.split(".")[-1]
@@ -1192,8 +1482,10 @@ def _get_item(self, i) -> Dict[str, torch.Tensor]:
                                 video.append(frame)
                         except IOError:
                             print(f"Failed to read frame at path: {frame_path}")
+                elif video_file in self.prefetched_videos:
+                    video, video_time, frame_time, num_frames_to_sample = self.prefetched_videos[video_file]
                 else:
-                    video, video_time, frame_time, num_frames_to_sample = process_video_with_decord(video_file, self.data_args)
+                    video, video_time, frame_time, num_frames_to_sample = process_video_with_frame_cache(video_file, self.data_args)
 
                 processor = self.data_args.image_processor
                 image = processor.preprocess(video, return_tensors="pt")["pixel_values"]
@@ -1206,12 +1498,19 @@ def _get_item(self, i) -> Dict[str, torch.Tensor]:
             except Exception as e:
                 print(f"Error: {e}")
                 print(f"Failed to read video file: {video_file}")
+                if self.quarantine is not None:
+                    # quarantined and substituted by __getitem__
+                    raise e
                 return self._get_item(i + 1)
         else:
             sources = copy.deepcopy([e["conversations"] for e in sources])
 
-        has_image = ("image" in self.list_data_dict[i]) or ("video" in self.list_data_dict[i])
-        data_dict = preprocess(sources, self.tokenizer, has_image=has_image)
+        pretokenized = self.token_shards.get(i) if self.token_shards is not None and isinstance(i, int) else None
+        if pretokenized is not None:
+            data_dict = dict(input_ids=pretokenized[0][None], labels=pretokenized[1][None])
+        else:
+            has_image = ("image" in sample) or ("video" in sample)
+            data_dict = preprocess(sources, self.tokenizer, has_image=has_image)
 
         if "prompt" in data_dict:
             prompt = data_dict["prompt"]
@@ -1222,10 +1521,16 @@ def _get_item(self, i) -> Dict[str, torch.Tensor]:
             data_dict = dict(input_ids=data_dict["input_ids"][0], labels=data_dict["labels"][0])
 
         # image exist in the data
-        if "image" in self.list_data_dict[i]:
+        if "image" in sample:
             data_dict["image"] = image
-        elif "video" in self.list_data_dict[i]:
+        elif "video" in sample:
             data_dict["image"] = image
+        elif self.data_args.is_multimodal and self.feature_cache is not None:
+            # a feature shaped placeholder keeps text-only batches off the vision tower as well
+            crop_size = self.data_args.image_processor.crop_size
+            data_dict["image"] = [
+                (self.feature_cache.dummy_feature(), (crop_size["width"], crop_size["height"]), "image_feature"),
+            ]
         elif self.data_args.is_multimodal:
             # image does not exist in the data, but the model is multimodal
             crop_size = self.data_args.image_processor.crop_size
@@ -1236,11 +1541,32 @@ def _get_item(self, i) -> Dict[str, torch.Tensor]:
         if prompt is not None:
             data_dict["prompt"] = prompt
 
-        data_dict["id"] = self.list_data_dict[i].get("id", i)
+        data_dict["id"] = sample.get("id", i)
 
         return data_dict
 
 
+class StreamingSupervisedDataset(LazySupervisedDataset):
+    """LazySupervisedDataset without samples, it converts the samples streamed by a ShardedStreamDataset."""
+
+    def load_samples(self, data_path, data_args):
+        data_args.dataset_paths = get_stream_shards(data_path)
+        return []
+
+    def _get_item(self, i):
+        raise ValueError("Streamed samples can not be fetched by index")
+
+
+class ParquetSupervisedDataset(LazySupervisedDataset):
+    """LazySupervisedDataset over parquet shards, the images are decoded from the bytes of the image column."""
+
+    def load_samples(self, data_path, data_args):
+        rank0_print(f"Opening parquet shards {data_path}")
+        list_data_dict = ParquetSamples(data_path, row_group_cache_size=data_args.parquet_row_group_cache_size)
+        data_args.dataset_paths = list_data_dict.dataset_paths
+        return list_data_dict
+
+
 @dataclass
 class DataCollatorForSupervisedDataset(object):
     """Collate examples for supervised fine-tuning."""
@@ -1290,7 +1616,23 @@ def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
 
 def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer, data_args) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
-    train_dataset = LazySupervisedDataset(tokenizer=tokenizer, data_path=data_args.data_path, data_args=data_args)
+    if data_args.streaming:
+        if data_args.length_cache_dir is not None or data_args.pretokenized_dir is not None or data_args.quarantine_dir is not None:
+            raise ValueError("length_cache_dir, pretokenized_dir and quarantine_dir index samples and are not supported with streaming")
+        converter = StreamingSupervisedDataset(tokenizer=tokenizer, data_path=data_args.data_path, data_args=data_args)
+        train_dataset = ShardedStreamDataset(data_args.data_path, converter.process_sample, shuffle_buffer_size=data_args.stream_shuffle_buffer_size)
+        data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
+        return dict(train_dataset=train_dataset, eval_dataset=None, data_collator=data_collator)
+    dataset_cls = ParquetSupervisedDataset if is_parquet_data(data_args.data_path) else LazySupervisedDataset
+    train_dataset = dataset_cls(tokenizer=tokenizer, data_path=data_args.data_path, data_args=data_args)
+    if data_args.length_cache_dir is not None:
+        train_dataset.load_token_lengths()
+    if data_args.pretokenized_dir is not None:
+        train_dataset.load_token_shards()
+    if data_args.quarantine_dir is not None:
+        train_dataset.load_quarantine()
+    elif data_args.precheck_media:
+        raise ValueError("precheck_media requires quarantine_dir")
     data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
     return dict(train_dataset=train_dataset, eval_dataset=None, data_collator=data_collator)
 
@@ -1487,6 +1829,10 @@ def train(attn_implementation=None):
 
     model = get_model(model_args, training_args, bnb_model_from_pretrained_args)
     model.config.use_cache = False
+    model.config.packing = training_args.packing
+    if training_args.packing:
+        assert training_args.attn_implementation == "flash_attention_2", "Packing relies on the varlen flash-attention kernels, please use --attn_implementation flash_attention_2"
+        replace_flash_attn_unpad_for_packing()
     if model_args.rope_scaling_factor is not None and model_args.rope_scaling_type is not None:
         model.config.rope_scaling = {
             "factor": model_args.rope_scaling_factor,
@@ -1576,6 +1922,11 @@ def make_inputs_require_grad(module, input, output):
         vision_tower.to(dtype=torch.bfloat16 if training_args.bf16 else torch.float16, device=training_args.device)
 
         data_args.image_processor = vision_tower.image_processor
+        if data_args.image_preprocess_backend == "torch":
+            data_args.image_processor = TensorImageProcessor(vision_tower.image_processor, num_threads=data_args.image_preprocess_threads)
+        elif data_args.image_preprocess_backend != "pil":
+            raise ValueError(f"Unknown image_preprocess_backend: {data_args.image_preprocess_backend}")
+        model.config.image_preprocess_backend = data_args.image_preprocess_backend
         data_args.is_multimodal = True
 
         model.config.image_aspect_ratio = data_args.image_aspect_ratio
@@ -1586,15 +1937,7 @@ def make_inputs_require_grad(module, input, output):
                 except Exception as e:
                     patch_size = data_args.image_processor.size["shortest_edge"]
 
-                assert patch_size in [224, 336, 384, 448, 512], "patch_size should be in [224, 336, 384, 448, 512]"
-                # Use regex to extract the range from the input string
-                matches = re.findall(r"\((\d+)x(\d+)\)", data_args.image_grid_pinpoints)
-                range_start = tuple(map(int, matches[0]))
-                range_end = tuple(map(int, matches[-1]))
-                # Generate a matrix of tuples from (range_start[0], range_start[1]) to (range_end[0], range_end[1])
-                grid_pinpoints = [(i, j) for i in range(range_start[0], range_end[0] + 1) for j in range(range_start[1], range_end[1] + 1)]
-                # Multiply all elements by patch_size
-                data_args.image_grid_pinpoints = [[dim * patch_size for dim in pair] for pair in grid_pinpoints]
+                data_args.image_grid_pinpoints = [list(pair) for pair in parse_grid_pinpoints(data_args.image_grid_pinpoints, patch_size)]
             elif isinstance(data_args.image_grid_pinpoints, str):
                 data_args.image_grid_pinpoints = ast.literal_eval(data_args.image_grid_pinpoints)
 
@@ -1606,9 +1949,24 @@ def make_inputs_require_grad(module, input, output):
         model.config.mm_newline_position = model_args.mm_newline_position
         model.config.add_faster_video = model_args.add_faster_video
         model.config.faster_token_stride = model_args.faster_token_stride
+        model.config.mm_batched_splice = model_args.mm_batched_splice
+        model.config.mm_grouped_unpad = model_args.mm_grouped_unpad
+        model.config.mm_vision_tower_micro_batch = model_args.mm_vision_tower_micro_batch
+        model.config.mm_temporal_reduction = model_args.mm_temporal_reduction
+        model.config.mm_temporal_similarity_threshold = model_args.mm_temporal_similarity_threshold
+        model.config.mm_temporal_min_frames = model_args.mm_temporal_min_frames
         model.config.add_time_instruction = data_args.add_time_instruction
         model.config.force_sample = data_args.force_sample
         model.config.mm_spatial_pool_stride = model_args.mm_spatial_pool_stride 
+        data_args.visual_token_config = dict(
+            image_aspect_ratio=data_args.image_aspect_ratio,
+            image_grid_pinpoints=data_args.image_grid_pinpoints,
+            mm_patch_merge_type=model_args.mm_patch_merge_type,
+            num_patches_per_side=vision_tower.num_patches_per_side,
+            vision_tower_image_size=vision_tower.image_size,
+            mm_newline_position=model_args.mm_newline_position,
+            mm_spatial_pool_mode=getattr(model.config, "mm_spatial_pool_mode", "bilinear"),
+        )
 
         ### Deciding train which part of the model
         if model_args.mm_tunable_parts is None:  # traditional way of deciding which part to train
@@ -1664,6 +2022,11 @@ def make_inputs_require_grad(module, input, output):
                     if "vision_tower" not in name and "mm_projector" not in name and "vision_resampler" not in name:
                         param.requires_grad_(True)
 
+        if data_args.feature_cache_dir is not None:
+            if any(p.requires_grad for p in vision_tower.parameters()):
+                raise ValueError("feature_cache_dir can only be used while the vision tower is frozen, cached features would silently skip its training.")
+            rank0_print(f"Using vision tower features cached in {data_args.feature_cache_dir}, they must come from {model_args.vision_tower} with mm_vision_select_layer={model_args.mm_vision_select_layer}")
+
         total_params = sum(p.ds_numel if hasattr(p, "ds_numel") else p.numel() for p in model.parameters())
         trainable_params = sum(p.ds_numel if hasattr(p, "ds_numel") else p.numel() for p in model.parameters() if p.requires_grad)
         rank0_print(f"Total parameters: ~{total_params/1e6:.2f} MB)")
@@ -14,6 +14,7 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import io
 import os
 import copy
 import deepspeed
@@ -38,7 +39,6 @@
 from llava.constants import IGNORE_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN, IMAGE_TOKEN_INDEX
 from torch.utils.data import Dataset
 from llava.train.llava_trainer import LLaVADPOTrainer
-from data_processing.utils import load_jsonl, load_json
 from llava import conversation as conversation_lib
 from llava.model import *
 from llava.model.language_model.llava_qwen import LlavaQwenConfig
@@ -46,6 +46,8 @@
 from llava.model.language_model.llava_mistral import LlavaMistralConfig
 from llava.mm_utils import process_highres_image, process_anyres_image, process_highres_image_crop_split, tokenizer_image_token
 from llava.utils import rank0_print
+from llava.train.data_utils import load_data_dicts
+from llava.train.streaming import ShardedStreamDataset, get_stream_shards
 from transformers import AutoConfig
 import pickle
 
@@ -129,6 +131,8 @@ class DataArguments:
     refine_prompt: Optional[bool] = field(default=False)
     frames_upbound: Optional[int] = field(default=0)
     num_sample: Optional[int] = field(default=None)
+    streaming: bool = field(default=False, metadata={"help": "Stream the tar or parquet shards at data_path sequentially instead of reading samples at random, see llava.train.streaming."})
+    stream_shuffle_buffer_size: int = field(default=1000, metadata={"help": "Number of samples every dataloader worker shuffles in streaming mode."})
 
 
 @dataclass
@@ -897,79 +901,12 @@ def get_tokenize_len(prompts):
     return dict(input_ids=input_ids, labels=targets)
 
 
-def load_data(data_path):
-    if "jsonl" in data_path:
-        data_list = load_jsonl(data_path)
-    else:
-        data_list = load_json(data_path)
-    return data_list
-
-
 class DPODataset(Dataset):
     """Dataset for DPODataset fine-tuning."""
 
     def __init__(self, data_path: str, tokenizer: transformers.PreTrainedTokenizer, data_args: DataArguments):
         super(DPODataset, self).__init__()
-        # Handle multiple JSON files specified in the data_path
-        self.list_data_dict = []
-
-        if "{" in data_path and "}" in data_path:
-            base_path, file_pattern = re.match(r"^(.*)\{(.*)\}\.json$", data_path).groups()
-            file_names = file_pattern.split(",")
-            rank0_print(f"Loading {file_names} from {base_path}")
-            data_args.dataset_paths = []
-            for file_name in file_names:
-                data_args.dataset_paths.append(f"{base_path}{file_name}.json")
-                full_path = f"{base_path}{file_name}.json"
-                rank0_print(f"Loading {full_path}")
-                cur_data_dict = load_data(full_path)
-                rank0_print(f"Loaded {len(cur_data_dict)} samples from {full_path}")
-                self.list_data_dict.extend(cur_data_dict)
-        elif data_path.endswith(".yaml"):
-            with open(data_path, "r") as file:
-                yaml_data = yaml.safe_load(file)
-                datasets = yaml_data.get("datasets")
-                # file should be in the format of:
-                # datasets:
-                #   - json_path: xxxx1.json
-                #     sampling_strategy: first:1000
-                #   - json_path: xxxx2.json
-                #     sampling_strategy: end:3000
-                #   - json_path: xxxx3.json
-                #     sampling_strategy: random:999
-                data_args.dataset_paths = [dataset.get("json_path") for dataset in datasets]
-                for dataset in datasets:
-                    json_path = dataset.get("json_path")
-                    sampling_strategy = dataset.get("sampling_strategy", "all")
-                    sampling_number = None
-
-                    rank0_print(f"Loading {json_path} with {sampling_strategy} sampling strategy")
-                    cur_data_dict = load_data(json_path)
-
-                    if ":" in sampling_strategy:
-                        sampling_strategy, sampling_number = sampling_strategy.split(":")
-                        if "%" in sampling_number:
-                            sampling_number = math.ceil(int(sampling_number.split("%")[0]) * len(cur_data_dict) / 100)
-                        else:
-                            sampling_number = int(sampling_number)
-
-                    # Apply the sampling strategy
-                    if sampling_strategy == "first" and sampling_number is not None:
-                        cur_data_dict = cur_data_dict[:sampling_number]
-                    elif sampling_strategy == "end" and sampling_number is not None:
-                        cur_data_dict = cur_data_dict[-sampling_number:]
-                    elif sampling_strategy == "random" and sampling_number is not None:
-                        random.shuffle(cur_data_dict)
-                        cur_data_dict = cur_data_dict[:sampling_number]
-
-                    rank0_print(f"Loaded {len(cur_data_dict)} samples from {json_path}")
-                    self.list_data_dict.extend(cur_data_dict)
-        else:
-            data_args.dataset_paths = [data_path]
-            rank0_print(f"Loading {data_path}")
-            cur_data_dict = load_data(data_path)
-            rank0_print(f"Loaded {len(cur_data_dict)} samples from {data_path}")
-            self.list_data_dict.extend(cur_data_dict)
+        self.list_data_dict = self.load_samples(data_path, data_args)
 
         rank0_print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
@@ -978,6 +915,10 @@ def __init__(self, data_path: str, tokenizer: transformers.PreTrainedTokenizer,
     def __len__(self):
         return len(self.list_data_dict)
 
+    def load_samples(self, data_path, data_args):
+        list_data_dict, data_args.dataset_paths = load_data_dicts(data_path)
+        return list_data_dict
+
     @property
     def lengths(self):
         length_list = []
@@ -1005,9 +946,13 @@ def process_image(self, image_file):
         processor = self.data_args.image_processor
         # print(f"\n\nInspecting the image path, folder = {image_folder}, image={image_file}\n\n")
         try:
-            image = Image.open(os.path.join(image_folder, image_file)).convert("RGB")
+            if isinstance(image_file, (bytes, bytearray)):
+                # images streamed from tar or parquet shards stay encoded in memory
+                image = Image.open(io.BytesIO(image_file)).convert("RGB")
+            else:
+                image = Image.open(os.path.join(image_folder, image_file)).convert("RGB")
         except Exception as exn:
-            print(f"Failed to open image {image_file}. Exception:", exn)
+            print(f"Failed to open image {image_file if isinstance(image_file, str) else '<bytes>'}. Exception:", exn)
             raise exn
 
         image_size = image.size
@@ -1079,14 +1024,17 @@ def __getitem__(self, i) -> Dict[str, torch.Tensor]:
         assert False, "Failed to fetch sample."
 
     def _get_item(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
+        return self.process_sample(self.list_data_dict[i], i)
+
+    def process_sample(self, sample, i) -> Dict[str, torch.Tensor]:
+        sources = sample
         if isinstance(i, int):
             sources = [sources]
         assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
 
         suffix = None
         if "image" in sources[0]:
-            image_file = self.list_data_dict[i]["image"]
+            image_file = sample["image"]
             if type(image_file) is list:
                 image = [self.process_image(f) for f in image_file]
             else:
@@ -1094,7 +1042,7 @@ def _get_item(self, i) -> Dict[str, torch.Tensor]:
             # sources = preprocess_multimodal(copy.deepcopy([e["conversations"] for e in sources]), self.data_args)
 
         elif "video" in sources[0]:  # FIXME: This logic should be largely improved by Yuanhan. It's too messy now.
-            video_file = self.list_data_dict[i]["video"]
+            video_file = sample["video"]
             video_folder = self.data_args.video_folder
             video_file = os.path.join(video_folder, video_file)
             suffix = video_file.split(".")[-1]
@@ -1122,7 +1070,7 @@ def _get_item(self, i) -> Dict[str, torch.Tensor]:
                     video = np.array(video)
                 else:
                     if "liangke" in video_file:
-                        video_file = self.list_data_dict[i]["video"]
+                        video_file = sample["video"]
                     frame_files = [os.path.join(video_file, f) for f in os.listdir(video_file) if os.path.isfile(os.path.join(video_file, f))]
                     frame_files.sort()  # Ensure the frames are sorted if they are named sequentially
 
@@ -1152,9 +1100,9 @@ def _get_item(self, i) -> Dict[str, torch.Tensor]:
         else:
             sources = copy.deepcopy([e["conversations"] for e in sources])
 
-        has_image = ("image" in self.list_data_dict[i]) or ("video" in self.list_data_dict[i])
+        has_image = ("image" in sample) or ("video" in sample)
         # data_dict = preprocess(sources, self.tokenizer, has_image=has_image)
-        data_dict = copy.deepcopy(self.list_data_dict[i])  # inplace modification following
+        data_dict = copy.deepcopy(sample)  # inplace modification following
 
         if "prompt" in data_dict:
             prompt = data_dict["prompt"]
@@ -1168,9 +1116,9 @@ def _get_item(self, i) -> Dict[str, torch.Tensor]:
             prompt = [query_prompt]
 
         # image exist in the data
-        if "image" in self.list_data_dict[i]:
+        if "image" in sample:
             data_dict["image"] = image
-        elif "video" in self.list_data_dict[i]:
+        elif "video" in sample:
             data_dict["image"] = image
         elif self.data_args.is_multimodal:
             # image does not exist in the data, but the model is multimodal
@@ -1183,6 +1131,17 @@ def _get_item(self, i) -> Dict[str, torch.Tensor]:
         return data_dict
 
 
+class StreamingDPODataset(DPODataset):
+    """DPODataset without samples, it converts the samples streamed by a ShardedStreamDataset."""
+
+    def load_samples(self, data_path, data_args):
+        data_args.dataset_paths = get_stream_shards(data_path)
+        return []
+
+    def _get_item(self, i):
+        raise ValueError("Streamed samples can not be fetched by index")
+
+
 @dataclass
 class DPODataCollator(DPODataCollatorWithPadding):
     """Collate examples for DPO fine-tuning."""
@@ -1307,6 +1266,9 @@ def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
 
 def make_dpo_data_module(tokenizer: transformers.PreTrainedTokenizer, data_args) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
+    if data_args.streaming:
+        converter = StreamingDPODataset(tokenizer=tokenizer, data_path=data_args.data_path, data_args=data_args)
+        return ShardedStreamDataset(data_args.data_path, converter.process_sample, shuffle_buffer_size=data_args.stream_shuffle_buffer_size)
     train_dataset = DPODataset(tokenizer=tokenizer, data_path=data_args.data_path, data_args=data_args)
     return train_dataset
 
@@ -1,8 +1,16 @@
+import collections
 import datetime
+import fcntl
+import hashlib
+import json
 import logging
 import logging.handlers
 import os
+import shutil
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 import requests
@@ -22,21 +30,28 @@
 except ImportError:
     print("Please install pyav to use video processing functions.")
 
-def process_video_with_decord(video_file, data_args):
-    vr = VideoReader(video_file, ctx=cpu(0), num_threads=1)
-    total_frame_num = len(vr)
-    video_time = total_frame_num / vr.get_avg_fps()
-    avg_fps = round(vr.get_avg_fps() / data_args.video_fps)
+def get_decord_frame_indices(total_frame_num, video_fps, data_args):
+    avg_fps = round(video_fps / data_args.video_fps)
     frame_idx = [i for i in range(0, total_frame_num, avg_fps)]
     frame_time = [i/avg_fps for i in frame_idx]
 
-    
     if data_args.frames_upbound > 0:
         if len(frame_idx) > data_args.frames_upbound or data_args.force_sample:
             uniform_sampled_frames = np.linspace(0, total_frame_num - 1, data_args.frames_upbound, dtype=int)
             frame_idx = uniform_sampled_frames.tolist()
-            frame_time = [i/vr.get_avg_fps() for i in frame_idx]
-    
+            frame_time = [i/video_fps for i in frame_idx]
+    return frame_idx, frame_time
+
+
+def process_video_with_decord(video_file, data_args):
+    if getattr(data_args, "video_reader_pool_size", 0) > 0:
+        return get_video_reader_pool(data_args).decode(video_file, data_args)
+
+    vr = VideoReader(video_file, ctx=cpu(0), num_threads=getattr(data_args, "video_decode_threads", 1))
+    total_frame_num = len(vr)
+    video_time = total_frame_num / vr.get_avg_fps()
+    frame_idx, frame_time = get_decord_frame_indices(total_frame_num, vr.get_avg_fps(), data_args)
+
     video = vr.get_batch(frame_idx).asnumpy()
     frame_time = ",".join([f"{i:.2f}s" for i in frame_time])
 
@@ -45,6 +60,280 @@ def process_video_with_decord(video_file, data_args):
     vr.seek(0)
     return video, video_time, frame_time, num_frames_to_sample
 
+
+class VideoReaderPool:
+    """
+    Process-wide pool of decord VideoReaders.
+
+    Readers of the max_readers most recently decoded files are kept open, so a video sampled again (or a reader
+    that is expensive to open) skips opening and indexing the container. Every reader decodes with num_threads
+    threads, and the readers of different videos decode concurrently (see decode_many).
+
+    The time spent in every stage (open, seek, decode, to-numpy, reset) is accumulated in stats(). get_batch seeks
+    and decodes in one call, so with a log_interval the frames are fetched one by one instead: seek_accurate to
+    every sampled frame (the keyframe seek and the frames skipped up to it) is timed as seek, and decoding the frame
+    itself as decode. The frames are the same, the per-frame calls cost up to ~10% over get_batch.
+    """
+
+    STAGES = ["open", "seek", "decode", "to_numpy", "reset"]
+
+    def __init__(self, max_readers=8, num_threads=1, log_interval=0):
+        self.max_readers = max_readers
+        self.num_threads = num_threads
+        self.log_interval = log_interval
+        self.readers = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stage_time = {stage: 0.0 for stage in self.STAGES}
+        self.num_decoded = 0
+        self.num_reused = 0
+
+    def _add_time(self, stage, start_time):
+        with self.lock:
+            self.stage_time[stage] += time.perf_counter() - start_time
+
+    def _get_reader(self, video_file):
+        """Return (reader, reader lock), opening the reader if it is not pooled."""
+        with self.lock:
+            if video_file in self.readers:
+                self.readers.move_to_end(video_file)
+                self.num_reused += 1
+                return self.readers[video_file]
+        start_time = time.perf_counter()
+        entry = (VideoReader(video_file, ctx=cpu(0), num_threads=self.num_threads), threading.Lock())
+        self._add_time("open", start_time)
+        with self.lock:
+            entry = self.readers.setdefault(video_file, entry)
+            self.readers.move_to_end(video_file)
+            while len(self.readers) > self.max_readers:
+                self.readers.popitem(last=False)
+        return entry
+
+    def decode(self, video_file, data_args):
+        """Same as process_video_with_decord."""
+        vr, reader_lock = self._get_reader(video_file)
+        # a reader is not thread safe, concurrent decodes of the same file take turns
+        with reader_lock:
+            total_frame_num = len(vr)
+            video_time = total_frame_num / vr.get_avg_fps()
+            frame_idx, frame_time = get_decord_frame_indices(total_frame_num, vr.get_avg_fps(), data_args)
+
+            if self.log_interval > 0:
+                video = self._get_frames_timed(vr, frame_idx)
+            else:
+                start_time = time.perf_counter()
+                batch = vr.get_batch(frame_idx)
+                self._add_time("decode", start_time)
+
+                start_time = time.perf_counter()
+                video = batch.asnumpy()
+                self._add_time("to_numpy", start_time)
+
+            # https://github.com/dmlc/decord/issues/208
+            start_time = time.perf_counter()
+            vr.seek(0)
+            self._add_time("reset", start_time)
+
+        with self.lock:
+            self.num_decoded += 1
+            should_log = self.log_interval > 0 and self.num_decoded % self.log_interval == 0
+        # stats() takes the lock itself
+        if should_log:
+            print(f"[pid {os.getpid()}] video decode stats: {self.stats()}")
+
+        frame_time = ",".join([f"{i:.2f}s" for i in frame_time])
+        return video, video_time, frame_time, len(frame_idx)
+
+    def _get_frames_timed(self, vr, frame_idx):
+        """vr.get_batch(frame_idx).asnumpy(), frame by frame with the seeks timed apart from the decodes."""
+        stage_time = {"seek": 0.0, "decode": 0.0, "to_numpy": 0.0}
+        frames = []
+        for idx in frame_idx:
+            start_time = time.perf_counter()
+            vr.seek_accurate(idx)
+            seek_time = time.perf_counter()
+            frame = vr.next()
+            decode_time = time.perf_counter()
+            frames.append(frame.asnumpy())
+            stage_time["seek"] += seek_time - start_time
+            stage_time["decode"] += decode_time - seek_time
+            stage_time["to_numpy"] += time.perf_counter() - decode_time
+        with self.lock:
+            for stage, total in stage_time.items():
+                self.stage_time[stage] += total
+        return np.stack(frames)
+
+    def stats(self):
+        """Total and per-video milliseconds of every stage."""
+        with self.lock:
+            num_decoded = max(self.num_decoded, 1)
+            stats = {stage: {"total_ms": round(1000 * total, 1), "per_video_ms": round(1000 * total / num_decoded, 2)} for stage, total in self.stage_time.items()}
+            stats["num_decoded"] = self.num_decoded
+            stats["num_reused"] = self.num_reused
+        return stats
+
+
+_video_reader_pool = None
+_video_reader_pool_pid = None
+_video_reader_pool_lock = threading.Lock()
+
+
+def get_video_reader_pool(data_args=None):
+    """The VideoReaderPool of the current process, created on first use (every dataloader worker gets its own)."""
+    global _video_reader_pool, _video_reader_pool_pid
+    # decoder threads do not survive a fork, a pool inherited from the parent process is replaced
+    with _video_reader_pool_lock:
+        if _video_reader_pool is None or _video_reader_pool_pid != os.getpid():
+            _video_reader_pool = VideoReaderPool(
+                max_readers=getattr(data_args, "video_reader_pool_size", 8) or 8,
+                num_threads=getattr(data_args, "video_decode_threads", 1),
+                log_interval=getattr(data_args, "video_decode_log_interval", 0),
+            )
+            _video_reader_pool_pid = os.getpid()
+    return _video_reader_pool
+
+
+def decode_many(video_files, decode_fn, max_workers=None):
+    """
+    Run decode_fn(video_file) for several videos concurrently with a thread pool, decord and pyav release the GIL
+    while they decode. Returns the result of every video in order, or the exception it raised.
+    """
+
+    def _decode(video_file):
+        try:
+            return decode_fn(video_file)
+        except Exception as e:
+            return e
+
+    if not video_files:
+        return []
+    max_workers = min(max_workers or os.cpu_count() or 1, len(video_files))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_decode, video_files))
+
+
+def get_video_frame_cache_path(video_file, data_args):
+    """Cache entry of the frames process_video samples from video_file with the current data_args."""
+    stat = os.stat(video_file)
+    key = json.dumps([os.path.abspath(video_file), stat.st_size, stat.st_mtime_ns, data_args.video_fps, data_args.frames_upbound, data_args.force_sample, getattr(data_args, "video_decode_backend", "decord")])
+    key = hashlib.sha1(key.encode()).hexdigest()
+    # spread the entries over subdirectories, millions of files in one directory are slow on most file systems
+    return os.path.join(data_args.video_frame_cache_dir, key[:2], key)
+
+
+def prune_video_frame_cache(cache_dir, max_bytes, target_ratio=0.9, partial_age=3600):
+    """
+    Delete the least recently used entries of a video frame cache until its frames take at most target_ratio *
+    max_bytes. The last use of an entry is the mtime of its meta.json. Entries without meta.json older than
+    partial_age seconds were left by a crashed write and are deleted as well.
+
+    Returns the number of deleted entries, or None if another process is already pruning the cache.
+    """
+    with open(os.path.join(cache_dir, "prune.lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        entries = []
+        total_bytes = 0
+        num_deleted = 0
+        for subdir in os.scandir(cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                try:
+                    last_used = os.stat(os.path.join(entry.path, "meta.json")).st_mtime
+                    size = os.stat(os.path.join(entry.path, "frames.npy")).st_size
+                except FileNotFoundError:
+                    if time.time() - entry.stat().st_mtime > partial_age:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                        num_deleted += 1
+                    continue
+                entries.append((last_used, size, entry.path))
+                total_bytes += size
+        # readers that already memory-mapped a deleted entry keep their mapping, the others decode it again
+        for last_used, size, path in sorted(entries):
+            if total_bytes <= target_ratio * max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_bytes -= size
+            num_deleted += 1
+    return num_deleted
+
+
+# bytes the current process wrote to the frame cache since it last pruned it, None before its first write
+_video_frame_cache_written = None
+
+
+def _add_video_frame_cache_bytes(num_bytes, data_args):
+    """Prune the frame cache on the first write of every process and after every 5% of video_frame_cache_max_gb written."""
+    global _video_frame_cache_written
+    max_bytes = int(data_args.video_frame_cache_max_gb * (1 << 30))
+    if _video_frame_cache_written is None or _video_frame_cache_written + num_bytes > 0.05 * max_bytes:
+        _video_frame_cache_written = 0
+        num_deleted = prune_video_frame_cache(data_args.video_frame_cache_dir, max_bytes)
+        if num_deleted:
+            print(f"[pid {os.getpid()}] deleted {num_deleted} least recently used entries of the video frame cache")
+    else:
+        _video_frame_cache_written += num_bytes
+
+
+def process_video_with_frame_cache(video_file, data_args):
+    """
+    Same as process_video, but the sampled frames are stored in data_args.video_frame_cache_dir on the first
+    decode and memory-mapped from there afterwards.
+
+    Every entry holds the uint8 frames of one video (frames.npy) and the timing returned next to them (meta.json).
+    The frame indices only depend on the video and on video_fps / frames_upbound / force_sample, which are part of
+    the key, so a cached entry is exactly what decoding would return. With video_frame_cache_max_gb, the least
+    recently used entries are deleted once the cache outgrows it (see prune_video_frame_cache).
+    """
+    if getattr(data_args, "video_frame_cache_dir", None) is None:
+        return process_video(video_file, data_args)
+
+    max_gb = getattr(data_args, "video_frame_cache_max_gb", 0)
+    cache_path = get_video_frame_cache_path(video_file, data_args)
+    meta_file = os.path.join(cache_path, "meta.json")
+    if os.path.exists(meta_file):
+        try:
+            with open(meta_file, "r") as f:
+                meta = json.load(f)
+            video = np.load(os.path.join(cache_path, "frames.npy"), mmap_mode="r")
+            # the mtime of meta.json is the last use of the entry, refreshed at most hourly to keep reads cheap
+            if max_gb > 0 and time.time() - os.stat(meta_file).st_mtime > 3600:
+                os.utime(meta_file)
+            return video, meta["video_time"], meta["frame_time"], meta["num_frames"]
+        except Exception as e:
+            print(f"Failed to read cached frames of {video_file}, decoding it again. Exception:", e)
+
+    video, video_time, frame_time, num_frames_to_sample = process_video(video_file, data_args)
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        # meta.json is written last and both files are renamed into place, so readers never see a partial entry
+        tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        np.save(os.path.join(cache_path, f"frames{tmp_suffix}.npy"), video)
+        os.replace(os.path.join(cache_path, f"frames{tmp_suffix}.npy"), os.path.join(cache_path, "frames.npy"))
+        with open(meta_file + tmp_suffix, "w") as f:
+            json.dump({"video_file": video_file, "video_time": video_time, "frame_time": frame_time, "num_frames": num_frames_to_sample}, f)
+        os.replace(meta_file + tmp_suffix, meta_file)
+        if max_gb > 0:
+            _add_video_frame_cache_bytes(np.asarray(video).nbytes, data_args)
+    except OSError as e:
+        print(f"Failed to cache the frames of {video_file}. Exception:", e)
+    return video, video_time, frame_time, num_frames_to_sample
+
+
+def probe_video_with_decord(video_file, data_args):
+    """Same as process_video_with_decord, but only reads the container metadata and returns no frames."""
+    vr = VideoReader(video_file, ctx=cpu(0), num_threads=1)
+    total_frame_num = len(vr)
+    video_time = total_frame_num / vr.get_avg_fps()
+    frame_idx, frame_time = get_decord_frame_indices(total_frame_num, vr.get_avg_fps(), data_args)
+    frame_time = ",".join([f"{i:.2f}s" for i in frame_time])
+    return video_time, frame_time, len(frame_idx)
+
 def process_video_with_pyav(video_file, data_args):
     container = av.open(video_file)
     # !!! This is the only difference. Using auto threading
@@ -70,6 +359,95 @@ def process_video_with_pyav(video_file, data_args):
     return np.stack([x.to_ndarray(format="rgb24") for x in frames])
 
 
+def get_pyav_video_info(container):
+    """(fps, total number of frames) of the first video stream, from the container metadata only."""
+    stream = container.streams.video[0]
+    rate = stream.average_rate or stream.guessed_rate
+    fps = float(rate) if rate else 0.0
+    total_frame_num = stream.frames
+    if not total_frame_num:
+        # some containers (e.g. webm, mkv) do not store the number of frames
+        if stream.duration is not None:
+            duration = float(stream.duration * stream.time_base)
+        else:
+            duration = (container.duration or 0) / av.time_base
+        total_frame_num = int(round(duration * fps))
+    return fps, total_frame_num
+
+
+def process_video_with_pyav_sparse(video_file, data_args, seek_threshold=2.0):
+    """
+    Same sampling and return values as process_video_with_decord, but only decodes the frames it needs.
+
+    The target timestamps are computed from the container metadata first. Targets further than seek_threshold
+    seconds ahead of the decoder are reached by seeking to the preceding keyframe, closer ones by decoding forward,
+    and only the current frame is kept besides the sampled ones.
+    """
+    container = av.open(video_file)
+    try:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        fps, total_frame_num = get_pyav_video_info(container)
+        if fps <= 0 or total_frame_num <= 0:
+            raise ValueError(f"Can not read the frame rate and length of {video_file}")
+        video_time = total_frame_num / fps
+        frame_idx, frame_time = get_decord_frame_indices(total_frame_num, fps, data_args)
+        start_time = float(stream.start_time * stream.time_base) if stream.start_time is not None else 0.0
+        # a decoded frame stands for every timestamp within half a frame of it
+        tolerance = 0.5 / fps
+
+        frames = []
+        decoder = None
+        current, current_time = None, None
+        for idx in frame_idx:
+            target_time = start_time + idx / fps
+            if decoder is None or target_time - current_time > seek_threshold:
+                container.seek(int(target_time / stream.time_base), stream=stream, backward=True, any_frame=False)
+                decoder = container.decode(stream)
+                current, current_time = None, None
+            while current is None or current_time < target_time - tolerance:
+                next_frame = next(decoder, None)
+                if next_frame is None:
+                    # the metadata overestimated the length, keep the last frame
+                    break
+                current = next_frame
+                current_time = current.time if current.time is not None else target_time
+            if current is None:
+                raise ValueError(f"Failed to decode frame {idx} of {video_file}")
+            frames.append(current.to_ndarray(format="rgb24"))
+    finally:
+        container.close()
+
+    video = np.stack(frames)
+    frame_time = ",".join([f"{i:.2f}s" for i in frame_time])
+    return video, video_time, frame_time, len(frame_idx)
+
+
+def process_video(video_file, data_args):
+    """
+    Decode the sampled frames of video_file with the backend chosen by data_args.video_decode_backend.
+
+    "auto" reads the container metadata and uses sparse pyav decoding for long videos (at least
+    data_args.video_sparse_min_duration seconds) and for containers that do not store a frame count, and decord
+    otherwise. decord indexes every packet of the video when it is opened, which dominates for long videos.
+    """
+    backend = getattr(data_args, "video_decode_backend", "decord")
+    if backend == "auto":
+        backend = "decord"
+        try:
+            with av.open(video_file) as container:
+                fps, total_frame_num = get_pyav_video_info(container)
+                if not container.streams.video[0].frames or (fps > 0 and total_frame_num / fps >= data_args.video_sparse_min_duration):
+                    backend = "pyav"
+        except Exception as e:
+            print(f"Failed to read the metadata of {video_file}, decoding it with decord. Exception:", e)
+    if backend == "pyav":
+        return process_video_with_pyav_sparse(video_file, data_args)
+    elif backend == "decord":
+        return process_video_with_decord(video_file, data_args)
+    raise ValueError(f"Unknown video_decode_backend: {backend}")
+
+
 def rank0_print(*args):
     if dist.is_initialized():
         if dist.get_rank() == 0:
@@ -84,6 +462,76 @@ def rank_print(*args):
     else:
         print(*args)
 
+
+def _build_collectively(build_fn, is_builder, done_path):
+    """Run build_fn() on the builders, every rank raises if it failed on any of them."""
+    error = None
+    if is_builder:
+        try:
+            build_fn()
+        except Exception as e:
+            error = e
+    errors = [None] * dist.get_world_size()
+    dist.all_gather_object(errors, None if error is None else repr(error))
+    if error is not None:
+        raise error
+    failed = {rank: e for rank, e in enumerate(errors) if e is not None}
+    if failed:
+        raise RuntimeError(f"Building {done_path} failed on rank(s) {failed}")
+
+
+def build_on_main_process(build_fn, done_path, timeout=6 * 3600, poll_interval=10):
+    """
+    Run build_fn() to create done_path once, the other processes wait for it instead of building it again.
+
+    With torch.distributed initialized, global rank 0 builds and the other ranks wait in a collective that also
+    raises on every rank if the build failed. The cache directories are usually shared by all nodes, so building on
+    the local main process of every node would write the same files at once. A node that still does not see
+    done_path afterwards (node-local directory) builds it on its local main process in a second round.
+
+    Without torch.distributed, the local main process builds and the other local processes poll for done_path.
+    A failed build leaves a marker next to done_path that makes them raise, and they give up after timeout seconds.
+    """
+    local_main = int(os.environ.get("LOCAL_RANK", 0)) == 0
+    if dist.is_available() and dist.is_initialized():
+        rank = dist.get_rank()
+        for first_round in (True, False):
+            missing = [None] * dist.get_world_size()
+            dist.all_gather_object(missing, not os.path.exists(done_path))
+            if not any(missing):
+                return
+            _build_collectively(build_fn, missing[rank] and (rank == 0 if first_round else local_main), done_path)
+        if not os.path.exists(done_path):
+            raise RuntimeError(f"{done_path} was built but is not visible on rank {rank}")
+        return
+
+    failed_path = f"{done_path}.failed"
+    if local_main:
+        if os.path.exists(done_path):
+            return
+        if os.path.exists(failed_path):
+            os.remove(failed_path)
+        try:
+            build_fn()
+        except Exception as e:
+            try:
+                with open(failed_path, "w") as f:
+                    f.write(repr(e))
+            except OSError:
+                pass
+            raise
+        return
+
+    start_time = time.time()
+    while not os.path.exists(done_path):
+        # a marker older than this wait was left by an earlier run and is removed by the local main process
+        if os.path.exists(failed_path) and os.path.getmtime(failed_path) >= start_time - max(poll_interval, 60):
+            with open(failed_path) as f:
+                raise RuntimeError(f"Building {done_path} failed on the local main process: {f.read()}")
+        if time.time() - start_time > timeout:
+            raise TimeoutError(f"Timed out after {timeout}s waiting for the local main process to build {done_path}")
+        time.sleep(poll_interval)
+
 def build_logger(logger_name, logger_filename):
     global handler
 
@@ -0,0 +1,219 @@
+"""Benchmark of the length-grouped index construction in llava/train/llava_trainer.py.
+
+Compares the numpy implementations against the previous list-based ones (kept below as reference_*) on synthetic
+lengths, checks that both return the same indices for the same seed, and reports the time of every sampler mode.
+
+Usage:
+    python playground/benchmark_length_grouping.py --sizes 10000 100000 1000000 --batch_size 4 --world_size 8
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from transformers.trainer_pt_utils import get_length_grouped_indices as reference_get_length_grouped_indices_hf
+
+from llava.train.llava_trainer import (
+    get_length_grouped_indices,
+    get_length_grouped_indices_auto_single,
+    get_modality_length_grouped_indices,
+    get_modality_length_grouped_indices_auto,
+    get_variable_length_grouped_indices,
+)
+
+
+def reference_split_to_even_chunks(indices, lengths, num_chunks):
+    """
+    Split a list of indices into `chunks` chunks of roughly equal lengths.
+    """
+
+    if len(indices) % num_chunks != 0:
+        return [indices[i::num_chunks] for i in range(num_chunks)]
+
+    num_indices_per_chunk = len(indices) // num_chunks
+
+    chunks = [[] for _ in range(num_chunks)]
+    chunks_lengths = [0 for _ in range(num_chunks)]
+    for index in indices:
+        shortest_chunk = chunks_lengths.index(min(chunks_lengths))
+        chunks[shortest_chunk].append(index)
+        chunks_lengths[shortest_chunk] += lengths[index]
+        if len(chunks[shortest_chunk]) == num_indices_per_chunk:
+            chunks_lengths[shortest_chunk] = float("inf")
+
+    return chunks
+
+
+def reference_get_variable_length_grouped_indices(lengths, batch_size, world_size, megabatch_mult=8, generator=None):
+    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
+    indices = torch.randperm(len(lengths), generator=generator)
+    sorted_indices = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    megabatch_size = world_size * batch_size * megabatch_mult
+    megabatches = [sorted_indices[i : i + megabatch_size] for i in range(0, len(lengths), megabatch_size)]
+    megabatches = [sorted(megabatch, key=lambda i: indices[i], reverse=True) for megabatch in megabatches]
+    shuffled_indices = [i for megabatch in megabatches for i in megabatch]
+    world_batch_size = world_size * batch_size
+    batches = [shuffled_indices[i : i + world_batch_size] for i in range(0, len(lengths), world_batch_size)]
+    batch_indices = torch.randperm(len(batches), generator=generator)
+    batches = [batches[i] for i in batch_indices]
+
+    return [i for batch in batches for i in batch]
+
+
+def reference_get_modality_length_grouped_indices(lengths, batch_size, world_size, generator=None):
+    """
+    Return a list of indices so that each slice of `batch_size` consecutive indices correspond to elements of similar
+    lengths. To do this, the indices are:
+
+    - randomly permuted
+    - grouped in mega-batches of size `mega_batch_mult * batch_size`
+    - reorder by length in each mega-batch
+
+    The result is the concatenation of all mega-batches, with the batch of `batch_size` containing the element of
+    maximum length placed first, so that an OOM happens sooner rather than later.
+    """
+
+    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
+    assert all(l != 0 for l in lengths), "Should not have zero length."
+    if all(l > 0 for l in lengths) or all(l < 0 for l in lengths):
+        # all samples are in the same modality
+        return reference_get_length_grouped_indices(lengths, batch_size, world_size, generator=generator)
+    mm_indices, mm_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
+    lang_indices, lang_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+
+    mm_shuffle = [mm_indices[i] for i in reference_get_length_grouped_indices(mm_lengths, batch_size, world_size, generator=None)]
+    lang_shuffle = [lang_indices[i] for i in reference_get_length_grouped_indices(lang_lengths, batch_size, world_size, generator=None)]
+    megabatch_size = world_size * batch_size
+    mm_megabatches = [mm_shuffle[i : i + megabatch_size] for i in range(0, len(mm_shuffle), megabatch_size)]
+    lang_megabatches = [lang_shuffle[i : i + megabatch_size] for i in range(0, len(lang_shuffle), megabatch_size)]
+
+    last_mm = mm_megabatches[-1]
+    last_lang = lang_megabatches[-1]
+    additional_batch = last_mm + last_lang
+    megabatches = mm_megabatches[:-1] + lang_megabatches[:-1]
+    megabatch_indices = torch.randperm(len(megabatches), generator=generator)
+    megabatches = [megabatches[i] for i in megabatch_indices]
+
+    if len(additional_batch) > 0:
+        megabatches.append(sorted(additional_batch))
+
+    return [i for megabatch in megabatches for i in megabatch]
+
+
+def reference_get_length_grouped_indices(lengths, batch_size, world_size, generator=None, merge=True):
+    """
+    Return a list of indices so that each slice of `batch_size` consecutive indices correspond to elements of similar
+    lengths. To do this, the indices are:
+
+    - randomly permuted
+    - grouped in mega-batches of size `mega_batch_mult * batch_size`
+    - reorder by length in each mega-batch
+
+    The result is the concatenation of all mega-batches, with the batch of `batch_size` containing the element of
+    maximum length placed first, so that an OOM happens sooner rather than later.
+    """
+
+    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
+    indices = torch.randperm(len(lengths), generator=generator)
+    megabatch_size = world_size * batch_size
+    megabatches = [indices[i : i + megabatch_size].tolist() for i in range(0, len(lengths), megabatch_size)]
+    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
+    megabatches = [reference_split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
+
+    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+
+
+def reference_get_length_grouped_indices_auto_single(lengths, batch_size, world_size, generator=None):
+    indices = reference_get_length_grouped_indices_hf(lengths, batch_size * world_size, generator=generator)
+
+    megabatch_size = world_size * batch_size
+    megabatches = [indices[i : i + megabatch_size] for i in range(0, len(lengths), megabatch_size)]
+    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
+    megabatches = [reference_split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
+
+    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
+    batch_indices = torch.randperm(len(megabatches), generator=generator)
+    megabatches = [megabatches[i] for i in batch_indices]
+
+    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+
+
+def reference_get_modality_length_grouped_indices_auto(lengths, batch_size, world_size, generator=None):
+    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
+    assert all(l != 0 for l in lengths), "Should not have zero length."
+    if all(l > 0 for l in lengths) or all(l < 0 for l in lengths):
+        # all samples are in the same modality
+        return reference_get_length_grouped_indices_auto_single(lengths, batch_size, world_size, generator=generator)
+    mm_indices, mm_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
+    lang_indices, lang_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+
+    mm_shuffle = [mm_indices[i] for i in reference_get_length_grouped_indices_auto_single(mm_lengths, batch_size, world_size, generator=None)]
+    lang_shuffle = [lang_indices[i] for i in reference_get_length_grouped_indices_auto_single(lang_lengths, batch_size, world_size, generator=None)]
+    megabatch_size = world_size * batch_size
+    mm_megabatches = [mm_shuffle[i : i + megabatch_size] for i in range(0, len(mm_shuffle), megabatch_size)]
+    lang_megabatches = [lang_shuffle[i : i + megabatch_size] for i in range(0, len(lang_shuffle), megabatch_size)]
+
+    last_mm = mm_megabatches[-1]
+    last_lang = lang_megabatches[-1]
+    additional_batch = last_mm + last_lang
+    megabatches = mm_megabatches[:-1] + lang_megabatches[:-1]
+    megabatch_indices = torch.randperm(len(megabatches), generator=generator)
+    megabatches = [megabatches[i] for i in megabatch_indices]
+
+    # FIXME: Hard code to avoid last batch mixed with different modalities
+    # if len(additional_batch) > 0:
+    #     megabatches.append(sorted(additional_batch))
+
+    return [i for megabatch in megabatches for i in megabatch]
+
+
+MODES = {
+    "group_by_length": (get_length_grouped_indices, reference_get_length_grouped_indices, False),
+    "group_by_modality_length": (get_modality_length_grouped_indices, reference_get_modality_length_grouped_indices, True),
+    "group_by_modality_length_auto": (get_modality_length_grouped_indices_auto, reference_get_modality_length_grouped_indices_auto, True),
+    "group_by_length_auto": (get_length_grouped_indices_auto_single, reference_get_length_grouped_indices_auto_single, False),
+    "group_by_varlen": (get_variable_length_grouped_indices, reference_get_variable_length_grouped_indices, False),
+}
+
+
+def make_lengths(num_samples, with_text, seed=0):
+    rng = np.random.default_rng(seed)
+    # heavy-tailed like conversations, with many equal lengths to exercise the tie breaking
+    lengths = np.minimum(rng.lognormal(5.5, 0.8, num_samples).astype(np.int64) + 1, 8192)
+    if with_text:
+        lengths = np.where(rng.random(num_samples) < 0.2, -lengths, lengths)
+    return lengths.tolist()
+
+
+def run(fn, lengths, batch_size, world_size, seed):
+    # the grouping functions draw from the global torch generator, like under the trainer
+    torch.manual_seed(seed)
+    start = time.perf_counter()
+    indices = fn(lengths, batch_size, world_size)
+    return indices, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the length-grouped index construction against its reference implementation.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--world_size", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--skip_reference_above", type=int, default=2000000, help="Only time the numpy implementation for larger sizes")
+    args = parser.parse_args()
+
+    for num_samples in args.sizes:
+        for mode, (fn, reference_fn, with_text) in MODES.items():
+            lengths = make_lengths(num_samples, with_text, seed=args.seed)
+            indices, elapsed = run(fn, lengths, args.batch_size, args.world_size, args.seed)
+            if num_samples > args.skip_reference_above:
+                print(f"{mode:32s} n={num_samples:>10d}  numpy {elapsed:8.3f}s")
+                continue
+            reference_indices, reference_elapsed = run(reference_fn, lengths, args.batch_size, args.world_size, args.seed)
+            assert [int(i) for i in indices] == [int(i) for i in reference_indices], f"{mode} differs from the reference for {num_samples} samples"
+            print(f"{mode:32s} n={num_samples:>10d}  numpy {elapsed:8.3f}s  reference {reference_elapsed:8.3f}s  speedup {reference_elapsed / max(elapsed, 1e-9):6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
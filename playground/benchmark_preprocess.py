@@ -0,0 +1,248 @@
+"""Micro-benchmark of the conversation templates in llava/train/train.py.
+
+Compares the compiled preprocess_qwen / preprocess_llama3 against the previous implementations (kept below as
+reference_*), checks that both produce identical input_ids and labels, and reports samples per second.
+
+SYNTHETIC numbers, not measured with the released Qwen2 / Llama-3 tokenizers (no hub access where they were taken):
+the tokenizers were byte-level BPE tokenizers trained on this repository's text, laid out like Qwen2 and Llama-3
+(same split regex, special tokens and chat template, newline at id 198). 2000 samples drawn from 300 generated
+conversations (0-3 images, 1-3 turns, unicode, code, blank lines, leading and trailing spaces), on CPU, all outputs
+identical:
+    qwen:   53.3 -> 733.7 samples/s (13.8x)
+    llama3: 51.3 -> 700.8 samples/s (13.7x)
+Re-measure with --tokenizer Qwen/Qwen2-7B-Instruct / meta-llama/Meta-Llama-3-8B-Instruct before quoting them.
+
+Usage:
+    python playground/benchmark_preprocess.py --tokenizer Qwen/Qwen2-7B-Instruct --template qwen --data_path llava_instruct.json
+"""
+
+import argparse
+import copy
+import json
+import time
+from typing import Dict
+
+import torch
+import transformers
+
+from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from llava.train.train import preprocess_llama3, preprocess_qwen
+
+
+def reference_preprocess_qwen(sources, tokenizer: transformers.PreTrainedTokenizer, has_image: bool = False, max_len=2048, system_message: str = "You are a helpful assistant.") -> Dict:
+    # roles = {"human": "<|im_start|>user", "gpt": "<|im_start|>assistant"}
+    roles = {"human": "user", "gpt": "assistant"}
+
+    # Add image tokens to tokenizer as a special tokens
+    # Use a deepcopy of tokenizer so that we don't modify on the tokenizer
+    tokenizer = copy.deepcopy(tokenizer)
+    # im_start, im_end = tokenizer.additional_special_tokens_ids
+    tokenizer.add_tokens(['<|im_start|>', '<|im_end|>'], special_tokens=True)
+    im_start, im_end = tokenizer.convert_tokens_to_ids(['<|im_start|>', '<|im_end|>'])
+    # When there is actually an image, we add the image tokens as a special token
+    if has_image:
+        tokenizer.add_tokens(["<image>"], special_tokens=True)
+
+    image_token_index = tokenizer.convert_tokens_to_ids("<image>")
+    # unmask_tokens = ["<|im_start|>", "<|im_start|>", "\n"]
+    unmask_tokens_idx =  [198, im_start, im_end]
+    nl_tokens = tokenizer("\n").input_ids
+
+    # Reset Qwen chat templates so that it won't include system message every time we apply
+    chat_template = "{% for message in messages %}{{'<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n'}}{% endfor %}{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
+    tokenizer.chat_template = chat_template
+
+    # _system = tokenizer("system").input_ids + nl_tokens
+    # _user = tokenizer("user").input_ids + nl_tokens
+    # _assistant = tokenizer("assistant").input_ids + nl_tokens
+
+    # Apply prompt templates
+    input_ids, targets = [], []
+    for i, source in enumerate(sources):
+        if roles[source[0]["from"]] != roles["human"]:
+            source = source[1:]
+
+        input_id, target = [], []
+
+        # New version, use apply chat template
+        # Build system message for each sentence
+        input_id += tokenizer.apply_chat_template([{"role" : "system", "content" : system_message}])
+        target += [IGNORE_INDEX] * len(input_id)
+
+        for conv in source:
+            # Make sure llava data can load
+            try:
+                role = conv["role"]
+                content = conv["content"]
+            except:
+                role = conv["from"]
+                content = conv["value"]
+
+            role =  roles.get(role, role)
+            
+            conv = [{"role" : role, "content" : content}]
+            encode_id = tokenizer.apply_chat_template(conv)
+            input_id += encode_id
+            if role in ["user", "system"]:
+                target += [IGNORE_INDEX] * len(encode_id)
+            else:
+                target += encode_id
+        
+
+                    
+        assert len(input_id) == len(target), f"{len(input_id)} != {len(target)}"
+        for idx, encode_id in enumerate(input_id):
+            if encode_id in unmask_tokens_idx:
+                target[idx] = encode_id
+            if encode_id == image_token_index:
+                input_id[idx] = IMAGE_TOKEN_INDEX
+        input_ids.append(input_id)
+        targets.append(target)
+    input_ids = torch.tensor(input_ids, dtype=torch.long)
+    targets = torch.tensor(targets, dtype=torch.long)
+
+    return dict(
+        input_ids=input_ids,  # tensor(bs x seq_len)
+        labels=targets,  # tensor(bs x seq_len)
+    )
+
+
+def reference_preprocess_llama3(
+    sources,
+    tokenizer: transformers.PreTrainedTokenizer,
+    has_image: bool = False,
+    max_len=2048,
+    system_message: str = "You are a helpful language and vision assistant. You are able to understand the visual content that the user provides, and assist the user with a variety of tasks using natural language.",
+) -> Dict:
+    # roles = {"human": "<|start_header_id|>user<|end_header_id|>", "gpt": "<|start_header_id|>assistant<|end_header_id|>"}
+    roles = {"human": "user", "gpt": "assistant"}
+
+    # Add image tokens to tokenizer as a special tokens
+    # Use a deepcopy of tokenizer so that we don't modify on the tokenizer
+    tokenizer = copy.deepcopy(tokenizer)
+    # When there is actually an image, we add the image tokens as a special token
+    if has_image:
+        tokenizer.add_tokens(["<image>"], special_tokens=True)
+    image_token_index = tokenizer.convert_tokens_to_ids("<image>")
+    bos_token_id = tokenizer.convert_tokens_to_ids("<|begin_of_text|>")
+    start_header_id = tokenizer.convert_tokens_to_ids("<|start_header_id|>")
+    end_header_id = tokenizer.convert_tokens_to_ids("<|end_header_id|>")
+    eot_id = tokenizer.convert_tokens_to_ids("<|eot_id|>")
+
+    unmask_tokens = ["<|begin_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>", "\n\n"]
+    unmask_tokens_idx = [tokenizer.convert_tokens_to_ids(tok) for tok in unmask_tokens]
+
+    # After update, calling tokenizer of llama3 will
+    # auto add bos id for the tokens. ヽ(｀⌒´)ﾉ
+    def safe_tokenizer_llama3(text):
+        input_ids = tokenizer(text).input_ids
+        if input_ids[0] == bos_token_id:
+            input_ids = input_ids[1:]
+        return input_ids
+
+    nl_tokens = tokenizer.convert_tokens_to_ids("\n\n")
+    # Apply prompt templates
+    input_ids, targets = [], []
+    for i, source in enumerate(sources):
+        if roles[source[0]["from"]] != roles["human"]:
+            source = source[1:]
+
+        input_id, target = [], []
+
+        # New version, use apply chat template
+        # Build system message for each sentence
+        input_id += tokenizer.apply_chat_template([{"role" : "system", "content" : system_message}])
+        target += [IGNORE_INDEX] * len(input_id)
+
+        for conv in source:
+            # Make sure llava data can load
+            try:
+                role = conv["role"]
+                content = conv["content"]
+            except:
+                role = conv["from"]
+                content = conv["value"]
+
+            role =  roles.get(role, role)
+            
+            conv = [{"role" : role, "content" : content}]
+            # First is bos token we don't need here
+            encode_id = tokenizer.apply_chat_template(conv)[1:]
+            input_id += encode_id
+            if role in ["user", "system"]:
+                target += [IGNORE_INDEX] * len(encode_id)
+            else:
+                target += encode_id
+        
+
+                    
+        assert len(input_id) == len(target), f"{len(input_id)} != {len(target)}"
+        for idx, encode_id in enumerate(input_id):
+            if encode_id in unmask_tokens_idx:
+                target[idx] = encode_id
+            if encode_id == image_token_index:
+                input_id[idx] = IMAGE_TOKEN_INDEX
+        input_ids.append(input_id)
+        targets.append(target)
+    input_ids = torch.tensor(input_ids, dtype=torch.long)
+    targets = torch.tensor(targets, dtype=torch.long)
+
+    return dict(
+        input_ids=input_ids,  # tensor(bs x seq_len)
+        labels=targets,  # tensor(bs x seq_len)
+    )
+
+
+
+SYNTHETIC_SAMPLES = [
+    {"image": "x.jpg", "conversations": [{"from": "human", "value": "<image>\nWhat is shown in this picture?"}, {"from": "gpt", "value": "A cat sitting on a red sofa next to a window."}]},
+    {"conversations": [{"from": "human", "value": "Write a haiku about the sea."}, {"from": "gpt", "value": "Waves fold into foam\nsalt wind carries gull voices\nthe tide keeps its time"}, {"from": "human", "value": "Now one about mountains."}, {"from": "gpt", "value": "Stone shoulders in cloud\nsnow remembers every step\nsilence answers all"}]},
+    {"image": ["a.jpg", "b.jpg"], "conversations": [{"from": "human", "value": "<image>\n<image>\nWhat changed between the two images?"}, {"from": "gpt", "value": "The second image was taken at night, the street lights are on."}]},
+]
+
+
+def run(preprocess_fn, samples, tokenizer):
+    results = []
+    start_time = time.perf_counter()
+    for sample in samples:
+        has_image = "image" in sample
+        results.append(preprocess_fn([copy.deepcopy(sample["conversations"])], tokenizer, has_image=has_image))
+    return results, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the preprocess templates against their reference implementation.")
+    parser.add_argument("--tokenizer", type=str, required=True)
+    parser.add_argument("--template", type=str, default="qwen", choices=["qwen", "llama3"])
+    parser.add_argument("--data_path", type=str, default=None, help="json/jsonl manifest, synthetic samples are used if not given")
+    parser.add_argument("--num_samples", type=int, default=2000)
+    args = parser.parse_args()
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(args.tokenizer, use_fast=True)
+    if args.data_path is None:
+        samples = SYNTHETIC_SAMPLES
+    elif args.data_path.endswith(".jsonl"):
+        with open(args.data_path, "r") as f:
+            samples = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(args.data_path, "r") as f:
+            samples = json.load(f)
+    samples = (samples * (args.num_samples // len(samples) + 1))[: args.num_samples]
+
+    reference_fn, compiled_fn = {"qwen": (reference_preprocess_qwen, preprocess_qwen), "llama3": (reference_preprocess_llama3, preprocess_llama3)}[args.template]
+    # warm up, the first call of the compiled template builds its cache
+    run(compiled_fn, samples[:1], tokenizer)
+    reference_results, reference_time = run(reference_fn, samples, tokenizer)
+    compiled_results, compiled_time = run(compiled_fn, samples, tokenizer)
+
+    for sample_idx, (reference, compiled) in enumerate(zip(reference_results, compiled_results)):
+        assert torch.equal(reference["input_ids"], compiled["input_ids"]), f"input_ids of sample {sample_idx} differ"
+        assert torch.equal(reference["labels"], compiled["labels"]), f"labels of sample {sample_idx} differ"
+
+    print(f"{args.template}: {len(samples)} samples, outputs identical")
+    print(f"  reference: {len(samples) / reference_time:.1f} samples/s")
+    print(f"  compiled:  {len(samples) / compiled_time:.1f} samples/s ({reference_time / compiled_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Micro-benchmark of the image embedding splice of prepare_inputs_labels_for_multimodal in llava/model/llava_arch.py.
+
+Compares splice_multimodal_batched (mm_batched_splice) against the row by row splice_multimodal_features followed by
+the truncation and pad_multimodal_sequences, on a synthetic batch, checks that both produce identical embeddings,
+labels, attention mask and position ids, and reports the time per batch.
+
+Usage:
+    python playground/benchmark_splice.py --batch_size 16 --images_per_sample 4 --visual_tokens 729 --device cuda
+"""
+
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from llava.model.llava_arch import LlavaMetaForCausalLM
+
+
+class SpliceBench(nn.Module):
+    """The splice methods of LlavaMetaForCausalLM on top of a bare embedding table."""
+
+    splice_multimodal_features = LlavaMetaForCausalLM.splice_multimodal_features
+    splice_multimodal_batched = LlavaMetaForCausalLM.splice_multimodal_batched
+    pad_multimodal_sequences = LlavaMetaForCausalLM.pad_multimodal_sequences
+
+    def __init__(self, vocab_size, hidden_size, padding_side):
+        super().__init__()
+        self.embed_tokens = nn.Embedding(vocab_size, hidden_size)
+        self.config = argparse.Namespace(tokenizer_padding_side=padding_side)
+
+    @property
+    def device(self):
+        return self.embed_tokens.weight.device
+
+    def get_model(self):
+        return self
+
+    def reference(self, input_ids, labels, attention_mask, position_ids, image_features, max_length):
+        new_input_embeds, new_labels = self.splice_multimodal_features(input_ids, labels, attention_mask, image_features)
+        new_input_embeds = [x[:max_length] for x in new_input_embeds]
+        new_labels = [x[:max_length] for x in new_labels]
+        return self.pad_multimodal_sequences(new_input_embeds, new_labels, attention_mask, position_ids)
+
+    def batched(self, input_ids, labels, attention_mask, position_ids, image_features, max_length):
+        return self.splice_multimodal_batched(input_ids, labels, attention_mask, position_ids, image_features, max_length)
+
+
+def make_batch(args, vocab_size, device):
+    input_ids = torch.randint(0, vocab_size, (args.batch_size, args.seq_len), device=device)
+    attention_mask = torch.ones_like(input_ids, dtype=torch.bool)
+    image_features = []
+    for row in range(args.batch_size):
+        # rows of random length, half of them without images
+        num_tokens = int(torch.randint(args.seq_len // 2, args.seq_len + 1, (1,)))
+        num_images = args.images_per_sample if row % 2 == 0 else 0
+        positions = torch.randperm(num_tokens)[:num_images].sort().values
+        input_ids[row, positions] = IMAGE_TOKEN_INDEX
+        if args.padding_side == "left":
+            attention_mask[row, : args.seq_len - num_tokens] = False
+        else:
+            attention_mask[row, num_tokens:] = False
+        for _ in range(max(num_images, 1)):
+            num_visual_tokens = int(torch.randint(args.visual_tokens // 2, args.visual_tokens + 1, (1,)))
+            image_features.append(torch.randn(num_visual_tokens, args.hidden_size, device=device))
+    labels = torch.where(input_ids == IMAGE_TOKEN_INDEX, torch.full_like(input_ids, IGNORE_INDEX), input_ids)
+    position_ids = torch.arange(args.seq_len, device=device)
+    return input_ids, labels, attention_mask, position_ids, image_features
+
+
+def run(fn, batch, max_length, iters, device):
+    outputs = fn(*batch, max_length)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn(*batch, max_length)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return outputs, (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the batched image embedding splice against the row by row splice.")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--seq_len", type=int, default=1024)
+    parser.add_argument("--images_per_sample", type=int, default=4)
+    parser.add_argument("--visual_tokens", type=int, default=729)
+    parser.add_argument("--hidden_size", type=int, default=1024)
+    parser.add_argument("--max_length", type=int, default=None, help="tokenizer_model_max_length the spliced sequences are truncated to")
+    parser.add_argument("--padding_side", type=str, default="right", choices=["right", "left"])
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    vocab_size = 32000
+    bench = SpliceBench(vocab_size, args.hidden_size, args.padding_side).to(device)
+    batch = make_batch(args, vocab_size, device)
+
+    with torch.no_grad():
+        reference_outputs, reference_time = run(bench.reference, batch, args.max_length, args.iters, device)
+        batched_outputs, batched_time = run(bench.batched, batch, args.max_length, args.iters, device)
+
+    for name, reference, batched in zip(["input_embeds", "labels", "attention_mask", "position_ids"], reference_outputs, batched_outputs):
+        assert reference.dtype == batched.dtype and torch.equal(reference, batched), f"{name} differ"
+
+    print(f"batch {args.batch_size} x {args.seq_len} tokens, {args.images_per_sample} images of up to {args.visual_tokens} tokens per sample: outputs identical")
+    print(f"  reference: {reference_time * 1000:.2f} ms/batch")
+    print(f"  batched:   {batched_time * 1000:.2f} ms/batch ({reference_time / batched_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
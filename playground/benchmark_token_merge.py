@@ -0,0 +1,122 @@
+"""Prefill latency, KV cache and accuracy of the token_merge resampler (llava/model/multimodal_resampler/token_merge.py).
+
+Loads a LLaVA checkpoint once and answers the questions of an eval manifest with every setting of --modes x --ratios
+(plus the unreduced baseline), swapping the resampler in place. For every setting it reports the number of visual
+tokens, the prefill latency, the KV cache of the prompt and the accuracy: the share of greedy answers that contain the
+reference answer (case insensitive), the metric of short answer sets such as VQAv2, GQA or TextVQA subsets.
+
+The manifest is a json list of {"image": path, "question": str, "answer": str}, with image paths relative to
+--image_folder.
+
+Usage:
+    python playground/benchmark_token_merge.py --model_path lmms-lab/llava-onevision-qwen2-7b-ov --conv_mode qwen_1_5 \\
+        --data_path eval/textvqa_val_500.json --image_folder eval/images --modes merge prune --ratios 0.5 0.25
+"""
+
+import argparse
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import torch
+from PIL import Image
+
+from llava.constants import DEFAULT_IMAGE_TOKEN, IMAGE_TOKEN_INDEX
+from llava.conversation import conv_templates
+from llava.mm_utils import get_model_name_from_path, process_images, tokenizer_image_token
+from llava.model.builder import load_pretrained_model
+from llava.model.multimodal_resampler.token_merge import TokenMerge
+
+
+def set_token_merge(model, mode, ratio):
+    """Swap the resampler of `model` for a TokenMerge keeping `ratio` of the tokens, or remove it if mode is None."""
+    if mode is None:
+        model.config.mm_resampler_type = None
+        return
+    model.config.mm_resampler_type = "token_merge"
+    model.get_model().vision_resampler = TokenMerge(SimpleNamespace(mm_token_merge_mode=mode, mm_token_merge_image_ratio=ratio, mm_token_merge_video_ratio=ratio))
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def get_kv_cache_bytes(config, num_tokens, dtype):
+    num_kv_heads = getattr(config, "num_key_value_heads", config.num_attention_heads)
+    head_dim = config.hidden_size // config.num_attention_heads
+    return 2 * config.num_hidden_layers * num_kv_heads * head_dim * num_tokens * torch.finfo(dtype).bits // 8
+
+
+def evaluate(model, tokenizer, image_processor, samples, args):
+    num_visual_tokens, prefill_times, kv_bytes, num_correct = [], [], [], 0
+    for sample in samples:
+        image = Image.open(os.path.join(args.image_folder, sample["image"])).convert("RGB")
+        images = process_images([image], image_processor, model.config)
+        images = [x.to(dtype=model.dtype, device=model.device) for x in images] if type(images) is list else images.to(dtype=model.dtype, device=model.device)
+        conv = conv_templates[args.conv_mode].copy()
+        conv.append_message(conv.roles[0], f"{DEFAULT_IMAGE_TOKEN}\n{sample['question']}")
+        conv.append_message(conv.roles[1], None)
+        input_ids = tokenizer_image_token(conv.get_prompt(), tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).to(model.device)
+
+        with torch.inference_mode():
+            synchronize(model.device)
+            start = time.perf_counter()
+            _, position_ids, attention_mask, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(input_ids, None, None, None, None, images, ["image"], image_sizes=[image.size])
+            model(inputs_embeds=inputs_embeds, attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+            synchronize(model.device)
+            prefill_times.append(time.perf_counter() - start)
+            output_ids = model.generate(input_ids, images=images, image_sizes=[image.size], modalities=["image"], do_sample=False, max_new_tokens=args.max_new_tokens)
+
+        num_tokens = inputs_embeds.shape[1]
+        num_visual_tokens.append(num_tokens - int((input_ids != IMAGE_TOKEN_INDEX).sum()))
+        kv_bytes.append(get_kv_cache_bytes(model.config, num_tokens, model.dtype))
+        answer = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
+        num_correct += int(sample["answer"].lower() in answer.lower())
+
+    # the first sample warms the kernels up
+    prefill_times = prefill_times[1:] or prefill_times
+    return {
+        "visual_tokens": sum(num_visual_tokens) / len(num_visual_tokens),
+        "prefill_ms": 1000 * sum(prefill_times) / len(prefill_times),
+        "kv_cache_mb": sum(kv_bytes) / len(kv_bytes) / 2**20,
+        "accuracy": num_correct / len(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the token_merge resampler against the full visual token sequence.")
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--model_base", type=str, default=None)
+    parser.add_argument("--conv_mode", type=str, default="qwen_1_5")
+    parser.add_argument("--torch_dtype", type=str, default="float16", choices=["float16", "bfloat16"])
+    parser.add_argument("--attn_implementation", type=str, default="flash_attention_2", help="sdpa or eager without flash-attn, e.g. on CPU")
+    parser.add_argument("--data_path", type=str, required=True, help='json list of {"image", "question", "answer"}')
+    parser.add_argument("--image_folder", type=str, default="")
+    parser.add_argument("--num_samples", type=int, default=None)
+    parser.add_argument("--modes", type=str, nargs="+", default=["merge", "prune"], choices=["merge", "prune"])
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0.5, 0.25])
+    parser.add_argument("--max_new_tokens", type=int, default=16)
+    parser.add_argument("--output", type=str, default=None, help="Write the results as json")
+    args = parser.parse_args()
+
+    with open(args.data_path, "r") as f:
+        samples = json.load(f)[: args.num_samples]
+    tokenizer, model, image_processor, _ = load_pretrained_model(args.model_path, args.model_base, get_model_name_from_path(args.model_path), torch_dtype=args.torch_dtype, attn_implementation=args.attn_implementation)
+    model.eval()
+
+    results = []
+    for mode, ratio in [(None, 1.0)] + [(mode, ratio) for mode in args.modes for ratio in args.ratios]:
+        set_token_merge(model, mode, ratio)
+        result = {"mode": mode or "none", "ratio": ratio, **evaluate(model, tokenizer, image_processor, samples, args)}
+        results.append(result)
+        print(f"{result['mode']:6s} ratio {ratio:.2f}: {result['visual_tokens']:8.1f} visual tokens  prefill {result['prefill_ms']:8.2f} ms  KV cache {result['kv_cache_mb']:8.2f} MB  accuracy {result['accuracy']:.4f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
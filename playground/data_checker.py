@@ -1,9 +1,34 @@
 import json
 import os
+from collections import defaultdict
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
 import yaml
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    from decord import VideoReader, cpu
+except ImportError:
+    VideoReader = None
+
+# directories holding at least this many files of a chunk are listed once instead of stat-ing every file
+SCANDIR_MIN_FILES = 8
+
+_validator = None
+
+
+def _validate_chunk(chunk):
+    return _validator.validate_chunk(chunk)
+
 
 class DataProcessor:
     def __init__(self, file_path, image_root, video_root):
@@ -87,6 +112,209 @@ def check_image_and_structure(self, item):
 
         # self.check_image_existence(item)
 
+    def iter_sources(self):
+        """(source manifest, samples) pairs of the data file, a yaml lists several manifests."""
+        if isinstance(self.data, list):
+            yield self.file_path, self.data
+        elif isinstance(self.data, dict):
+            for d in self.data["datasets"]:
+                yield d["json_path"], self.load_json_data(d["json_path"])
+
+    @staticmethod
+    def stat_files(paths):
+        """Map every path to its size, or None if it does not exist, listing crowded directories once."""
+        by_dir = defaultdict(list)
+        for path in paths:
+            by_dir[os.path.dirname(path)].append(path)
+        sizes = {}
+        for directory, dir_paths in by_dir.items():
+            if len(dir_paths) >= SCANDIR_MIN_FILES:
+                try:
+                    with os.scandir(directory or ".") as entries:
+                        listing = {entry.path if directory else entry.name: entry for entry in entries}
+                except OSError:
+                    listing = {}
+                for path in dir_paths:
+                    entry = listing.get(path)
+                    try:
+                        sizes[path] = entry.stat().st_size if entry is not None else None
+                    except OSError:
+                        sizes[path] = None
+            else:
+                for path in dir_paths:
+                    try:
+                        sizes[path] = os.stat(path).st_size
+                    except OSError:
+                        sizes[path] = None
+        return sizes
+
+    @staticmethod
+    def probe_image(path):
+        """Size and mode from the image header, the pixels are not decoded."""
+        with Image.open(path) as image:
+            return {"width": image.size[0], "height": image.size[1], "mode": image.mode}
+
+    @staticmethod
+    def probe_video(path):
+        if os.path.isdir(path):
+            # a folder of extracted frames
+            return {"num_frames": len(os.listdir(path))}
+        if av is not None:
+            with av.open(path) as container:
+                stream = container.streams.video[0]
+                fps = float(stream.average_rate) if stream.average_rate else None
+                num_frames = stream.frames
+                if not num_frames and fps and container.duration:
+                    num_frames = int(round(container.duration / av.time_base * fps))
+                return {"num_frames": num_frames, "fps": fps, "width": stream.width, "height": stream.height}
+        vr = VideoReader(path, ctx=cpu(0), num_threads=1)
+        return {"num_frames": len(vr), "fps": vr.get_avg_fps()}
+
+    def count_text_tokens(self, item):
+        """Exact number of text tokens after the conversation template, <image> placeholders excluded."""
+        from llava.constants import IMAGE_TOKEN_INDEX
+        from llava.train.train import preprocess, preprocess_multimodal
+
+        has_image = "image" in item or "video" in item
+        sources = [item["conversations"]]
+        if has_image:
+            sources = preprocess_multimodal(json.loads(json.dumps(sources)), self.data_args)
+        input_ids = preprocess(sources, self.tokenizer, has_image=has_image)["input_ids"][0]
+        return int((input_ids != IMAGE_TOKEN_INDEX).sum())
+
+    def validate_item(self, item, sizes):
+        result = {"id": item.get("id"), "errors": [], "warnings": []}
+        if not self.check_item_structure(item):
+            result["errors"].append("invalid conversations structure")
+            return result
+
+        images = item.get("image", [])
+        images = images if isinstance(images, list) else [images]
+        result["images"] = []
+        for image in images:
+            full_image_path = os.path.join(self.image_root, image)
+            if sizes.get(full_image_path) is None:
+                result["errors"].append(f"{full_image_path} not exists")
+                continue
+            try:
+                result["images"].append(dict(path=image, **self.probe_image(full_image_path)))
+            except Exception as e:
+                result["errors"].append(f"{full_image_path} unreadable: {e}")
+
+        num_videos = 0
+        if "video" in item:
+            num_videos = 1
+            full_video_path = os.path.join(self.video_root, item["video"])
+            if sizes.get(full_video_path) is None:
+                result["errors"].append(f"{full_video_path} not exists")
+            else:
+                try:
+                    result["video"] = dict(path=item["video"], **self.probe_video(full_video_path))
+                    if not result["video"]["num_frames"]:
+                        result["errors"].append(f"{full_video_path} has no frames")
+                except Exception as e:
+                    result["errors"].append(f"{full_video_path} unreadable: {e}")
+
+        num_visuals = len(images) + num_videos
+        num_img_token_appearance = sum(conv["value"].count("<image>") for conv in item["conversations"])
+        result["num_img_token_appearance"] = num_img_token_appearance
+        if num_img_token_appearance > num_visuals:
+            result["errors"].append(f"{num_img_token_appearance} <image> tokens for {num_visuals} images/videos")
+        elif num_img_token_appearance < num_visuals:
+            result["warnings"].append(f"{num_img_token_appearance} <image> tokens for {num_visuals} images/videos")
+
+        if self.tokenizer is not None:
+            try:
+                result["text_tokens"] = self.count_text_tokens(item)
+                if self.tokenizer.model_max_length and result["text_tokens"] > self.tokenizer.model_max_length:
+                    result["warnings"].append(f"{result['text_tokens']} text tokens exceed model_max_length {self.tokenizer.model_max_length}")
+            except Exception as e:
+                result["errors"].append(f"tokenization failed: {e}")
+        return result
+
+    def validate_chunk(self, chunk):
+        source, start, items = chunk
+        media_paths = []
+        for item in items:
+            if isinstance(item, dict) and "image" in item:
+                images = item["image"] if isinstance(item["image"], list) else [item["image"]]
+                media_paths.extend(os.path.join(self.image_root, image) for image in images)
+            if isinstance(item, dict) and "video" in item:
+                media_paths.append(os.path.join(self.video_root, item["video"]))
+        sizes = self.stat_files(media_paths)
+
+        results = []
+        for index, item in enumerate(items, start):
+            try:
+                result = self.validate_item(item, sizes)
+            except Exception as e:
+                result = {"id": item.get("id") if isinstance(item, dict) else None, "errors": [f"validation failed: {e}"], "warnings": []}
+            result.update(source=source, index=index, ok=len(result["errors"]) == 0)
+            results.append(result)
+        return results
+
+    def validate_data(self, report_path, output_manifest=None, num_proc=None, chunk_size=256, tokenizer_path=None, version="qwen_1_5", mm_use_im_start_end=False):
+        """
+        Validate every sample in a process pool and write one json line per sample to report_path.
+
+        Media are stat-ed per chunk (crowded directories are listed once), images only have their header read,
+        videos are probed for their frame count, the <image> tokens are counted against the images and videos,
+        and with tokenizer_path the exact number of text tokens is computed with the training templates. The
+        samples without errors are written to output_manifest.
+        """
+        global _validator
+        self.tokenizer = None
+        self.data_args = None
+        if tokenizer_path is not None:
+            import transformers
+            from llava import conversation as conversation_lib
+            from llava.train.train import DataArguments
+
+            os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+            self.tokenizer = transformers.AutoTokenizer.from_pretrained(tokenizer_path, use_fast=True)
+            conversation_lib.default_conversation = conversation_lib.conv_templates[version]
+            self.data_args = DataArguments(is_multimodal=True)
+            # a ModelArguments field that train() copies onto the data arguments
+            self.data_args.mm_use_im_start_end = mm_use_im_start_end
+
+        chunks = []
+        manifest_items = []
+        for source, data in self.iter_sources():
+            chunks.extend((source, start, data[start : start + chunk_size]) for start in range(0, len(data), chunk_size))
+            if output_manifest is not None:
+                manifest_items.extend(data)
+        num_samples = sum(len(chunk[2]) for chunk in chunks)
+
+        _validator = self
+        num_failed = 0
+        kept = []
+        with open(report_path, "w") as report_file, Pool(processes=num_proc or cpu_count()) as pool:
+            progress = tqdm(total=num_samples, desc="Validating")
+            item_idx = 0
+            for chunk_results in pool.imap(_validate_chunk, chunks):
+                for result in chunk_results:
+                    report_file.write(json.dumps(result) + "\n")
+                    if not result["ok"]:
+                        num_failed += 1
+                    elif output_manifest is not None:
+                        kept.append(manifest_items[item_idx])
+                    item_idx += 1
+                progress.update(len(chunk_results))
+            progress.close()
+        _validator = None
+
+        print(f"Validated {num_samples} samples, {num_failed} failed. Report saved to: {report_path}")
+        if output_manifest is not None:
+            with open(output_manifest, "w") as f:
+                if output_manifest.endswith(".jsonl"):
+                    for item in kept:
+                        f.write(json.dumps(item) + "\n")
+                else:
+                    json.dump(kept, f, indent=2)
+            print(f"Filtered manifest with {len(kept)} samples saved to: {output_manifest}")
+        return num_failed
+
+
     def process_images(self):
         if isinstance(self.data, list):
             args = [d for d in self.data]
@@ -332,9 +560,13 @@ def stat_and_filter_data(self, threshold):
             print(f"Video items: {video_count} ({video_count/total_count*100:.2f}%)")
 
 
-def main(file_path, image_root, operation, video_root, threshold=None):
+def main(file_path, image_root, operation, video_root, threshold=None, report=None, output_manifest=None, num_proc=None, tokenizer=None, version="qwen_1_5", mm_use_im_start_end=False):
     processor = DataProcessor(file_path, image_root, video_root)
-    if operation == "check":
+    if operation == "validate":
+        if report is None:
+            raise ValueError("Report path must be provided for validate operation")
+        processor.validate_data(report, output_manifest=output_manifest, num_proc=num_proc, tokenizer_path=tokenizer, version=version, mm_use_im_start_end=mm_use_im_start_end)
+    elif operation == "check":
         processor.process_images()
     elif operation == "count":
         total_items = processor.count_items()
@@ -360,5 +592,11 @@ def main(file_path, image_root, operation, video_root, threshold=None):
     parser.add_argument("--video_root", type=str, default="/mnt/bn/vl-research/data/llava_video")
     parser.add_argument("--operation", type=str, default="filter")
     parser.add_argument("--threshold", type=int, default=None, help="Threshold for stat_and_filter operation")
+    parser.add_argument("--report", type=str, default=None, help="Per-sample jsonl report of the validate operation")
+    parser.add_argument("--output_manifest", type=str, default=None, help="Manifest of the samples that pass the validate operation")
+    parser.add_argument("--num_proc", type=int, default=None, help="Number of processes of the validate operation")
+    parser.add_argument("--tokenizer", type=str, default=None, help="Tokenizer to compute exact token lengths with in the validate operation")
+    parser.add_argument("--version", type=str, default="qwen_1_5", help="Conversation template of the token lengths")
+    parser.add_argument("--mm_use_im_start_end", action="store_true", help="Same as --mm_use_im_start_end of train.py, for the token lengths")
     args = parser.parse_args()
-    main(args.file_path, args.image_root, args.operation, args.video_root, args.threshold)
+    main(args.file_path, args.image_root, args.operation, args.video_root, args.threshold, args.report, args.output_manifest, args.num_proc, args.tokenizer, args.version, args.mm_use_im_start_end)
@@ -16,6 +16,8 @@
 RECORDS_PER_FILE = 50000
 MAX_WORKERS = min(32, os.cpu_count() * 4)
 INTERNAL_BATCH_SIZE = 1000 
+# rows per parquet row group, the unit ParquetSupervisedDataset reads for random access
+ROW_GROUP_SIZE = 64
 
 def process_single_entry(entry_dict, image_base_path):
     """
@@ -37,6 +39,7 @@ def process_single_entry(entry_dict, image_base_path):
             return {
                 "idx": str(idx), 
                 "image": image_bytes, 
+                "has_image": True,
                 "conversations": json.dumps(conversations), 
                 "source": source
             }
@@ -87,6 +90,8 @@ def process_data_with_full_streaming(json_path, image_base_path, output_dir, max
     parquet_schema = pa.schema([
         ('idx', pa.string()),
         ('image', pa.binary()),
+        # read by ParquetSamples to group the samples by modality without reading the images
+        ('has_image', pa.bool_()),
         ('conversations', pa.string()),
         ('source', pa.string())
     ])
@@ -119,7 +124,7 @@ def process_data_with_full_streaming(json_path, image_base_path, output_dir, max
             if len(batch_records) >= internal_batch_size:
                 df_batch = pd.DataFrame(batch_records)
                 table_batch = pa.Table.from_pandas(df_batch, schema=parquet_schema, preserve_index=False)
-                writer.write_table(table_batch)
+                writer.write_table(table_batch, row_group_size=ROW_GROUP_SIZE)
                 records_in_current_file += len(batch_records)
                 batch_records = []
 
@@ -127,7 +132,7 @@ def process_data_with_full_streaming(json_path, image_base_path, output_dir, max
                 if batch_records:
                     df_batch = pd.DataFrame(batch_records)
                     table_batch = pa.Table.from_pandas(df_batch, schema=parquet_schema, preserve_index=False)
-                    writer.write_table(table_batch)
+                    writer.write_table(table_batch, row_group_size=ROW_GROUP_SIZE)
                     records_in_current_file += len(batch_records)
                     batch_records = []
 
@@ -140,7 +145,7 @@ def process_data_with_full_streaming(json_path, image_base_path, output_dir, max
     if writer and batch_records:
         df_batch = pd.DataFrame(batch_records)
         table_batch = pa.Table.from_pandas(df_batch, schema=parquet_schema, preserve_index=False)
-        writer.write_table(table_batch)
+        writer.write_table(table_batch, row_group_size=ROW_GROUP_SIZE)
         records_in_current_file += len(batch_records)
         print(f"Successfully wrote {records_in_current_file} records to: {output_filename}")
         writer.close()
@@ -0,0 +1,95 @@
+import copy
+
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from llava.train.train import preprocess_qwen
+
+CORPUS = [
+    "You are a helpful assistant.",
+    "What is shown in the image? Describe it in detail.",
+    "The image shows a cat sleeping on a wooden table next to a cup of coffee.",
+    "How many people are there?\nAnswer with a single number.",
+    "There are 3 people,  two of them are   standing.\n\nThe third one sits.",
+    "user\nassistant\nsystem\n",
+]
+
+CONVERSATIONS = [
+    [{"from": "human", "value": "<image>\nWhat is shown in the image?"}, {"from": "gpt", "value": "A cat sleeping on a table."}],
+    [{"from": "human", "value": "What is shown here? <image>"}, {"from": "gpt", "value": "A cup of coffee."}, {"from": "human", "value": "And next to it?"}, {"from": "gpt", "value": "A cat.\n\nIt is asleep."}],
+    [{"from": "human", "value": "<image>\n<image>\nCompare the two images."}, {"from": "gpt", "value": "  The first one shows 3 people,\nthe second one shows none.  "}],
+    # a conversation that starts with the assistant drops its first turn
+    [{"from": "gpt", "value": "Hello."}, {"from": "human", "value": "How many people are there?\nAnswer with a single number."}, {"from": "gpt", "value": "3"}],
+    [{"from": "human", "value": ""}, {"from": "gpt", "value": "\n"}],
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    """A small byte-level BPE tokenizer with the special tokens of Qwen2, trained on CORPUS."""
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    bpe.train_from_iterator(CORPUS, trainers.BpeTrainer(vocab_size=400, initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False))
+    bpe.add_special_tokens(["<|endoftext|>", "<|im_start|>", "<|im_end|>"])
+    return PreTrainedTokenizerFast(tokenizer_object=bpe, eos_token="<|im_end|>", pad_token="<|endoftext|>")
+
+
+def reference_preprocess_qwen(sources, tokenizer, has_image=False, system_message="You are a helpful assistant."):
+    # preprocess_qwen before the templates were compiled, one apply_chat_template call per turn
+    roles = {"human": "user", "gpt": "assistant"}
+    tokenizer = copy.deepcopy(tokenizer)
+    tokenizer.add_tokens(["<|im_start|>", "<|im_end|>"], special_tokens=True)
+    im_start, im_end = tokenizer.convert_tokens_to_ids(["<|im_start|>", "<|im_end|>"])
+    if has_image:
+        tokenizer.add_tokens(["<image>"], special_tokens=True)
+    image_token_index = tokenizer.convert_tokens_to_ids("<image>")
+    unmask_tokens_idx = [198, im_start, im_end]
+    tokenizer.chat_template = "{% for message in messages %}{{'<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n'}}{% endfor %}{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
+
+    input_ids, targets = [], []
+    for source in sources:
+        if roles[source[0]["from"]] != roles["human"]:
+            source = source[1:]
+        input_id = tokenizer.apply_chat_template([{"role": "system", "content": system_message}])
+        target = [IGNORE_INDEX] * len(input_id)
+        for conv in source:
+            role = roles.get(conv["from"], conv["from"])
+            encode_id = tokenizer.apply_chat_template([{"role": role, "content": conv["value"]}])
+            input_id += encode_id
+            target += [IGNORE_INDEX] * len(encode_id) if role in ["user", "system"] else encode_id
+        for idx, encode_id in enumerate(input_id):
+            if encode_id in unmask_tokens_idx:
+                target[idx] = encode_id
+            if encode_id == image_token_index:
+                input_id[idx] = IMAGE_TOKEN_INDEX
+        input_ids.append(input_id)
+        targets.append(target)
+    return dict(input_ids=torch.tensor(input_ids, dtype=torch.long), labels=torch.tensor(targets, dtype=torch.long))
+
+
+@pytest.mark.parametrize("has_image", [True, False])
+@pytest.mark.parametrize("conversation", CONVERSATIONS)
+def test_compiled_qwen_template_matches_apply_chat_template(tokenizer, conversation, has_image):
+    actual = preprocess_qwen([copy.deepcopy(conversation)], tokenizer, has_image=has_image)
+    expected = reference_preprocess_qwen([copy.deepcopy(conversation)], tokenizer, has_image=has_image)
+    assert torch.equal(actual["input_ids"], expected["input_ids"])
+    assert torch.equal(actual["labels"], expected["labels"])
+
+
+def test_compiled_qwen_template_system_message(tokenizer):
+    conversation = CONVERSATIONS[1]
+    actual = preprocess_qwen([copy.deepcopy(conversation)], tokenizer, has_image=True, system_message="Answer briefly.")
+    expected = reference_preprocess_qwen([copy.deepcopy(conversation)], tokenizer, has_image=True, system_message="Answer briefly.")
+    assert torch.equal(actual["input_ids"], expected["input_ids"])
+    assert torch.equal(actual["labels"], expected["labels"])
+
+
+def test_compiled_qwen_template_leaves_tokenizer_unchanged(tokenizer):
+    vocab_size = len(tokenizer)
+    preprocess_qwen([copy.deepcopy(CONVERSATIONS[0])], tokenizer, has_image=True)
+    assert len(tokenizer) == vocab_size
+    assert "<image>" not in tokenizer.get_vocab()
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import torch
+
+from llava.train.llava_trainer import LengthGroupedSampler
+
+
+def make_lengths(num_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 2048, num_samples)
+    # text-only samples have negative lengths
+    lengths[rng.random(num_samples) < 0.3] *= -1
+    return lengths.tolist()
+
+
+def make_sampler(lengths, seed=42, **kwargs):
+    return LengthGroupedSampler(batch_size=4, world_size=2, lengths=lengths, seed=seed, **kwargs)
+
+
+def make_sampler_epoch(lengths, epoch, grouping):
+    sampler = make_sampler(lengths, **grouping)
+    sampler.set_epoch(epoch)
+    return list(sampler)
+
+
+@pytest.mark.parametrize("grouping", [{}, {"group_by_modality": True}, {"group_by_modality_auto": True}])
+def test_resume_gives_the_same_order(grouping):
+    lengths = make_lengths(1000)
+    sampler = make_sampler(lengths, **grouping)
+    orders = []
+    for epoch in range(4):
+        sampler.set_epoch(epoch)
+        orders.append(list(sampler))
+    assert len(set(orders[0])) == len(orders[0])
+    assert orders[0] != orders[1]
+
+    for epoch in range(3):
+        for start_index in [0, 1, 8, 317, len(orders[epoch]) - 1, len(orders[epoch])]:
+            resumed = make_sampler(lengths, **grouping)
+            resumed.load_state_dict({"seed": 42, "epoch": epoch, "start_index": start_index})
+            # the trainer sets the epoch once more before iterating
+            resumed.set_epoch(epoch)
+            assert list(resumed) == orders[epoch][start_index:]
+            # the next epoch starts at its beginning again
+            resumed.set_epoch(epoch + 1)
+            assert list(resumed) == orders[epoch + 1]
+
+
+def test_resume_without_set_epoch():
+    lengths = make_lengths(500)
+    order = make_sampler_epoch(lengths, 2, {})
+    resumed = make_sampler(lengths)
+    resumed.load_state_dict({"seed": 42, "epoch": 2, "start_index": 100})
+    assert list(resumed) == order[100:]
+    # iterating again without set_epoch moves on to the next epoch
+    assert list(resumed) == make_sampler_epoch(lengths, 3, {})
+
+
+def test_order_does_not_depend_on_the_global_rng():
+    lengths = make_lengths(500)
+    torch.manual_seed(0)
+    order = make_sampler_epoch(lengths, 1, {})
+    torch.manual_seed(1)
+    assert make_sampler_epoch(lengths, 1, {}) == order
+    # the sampler does not consume the global generator either
+    torch.manual_seed(2)
+    make_sampler_epoch(lengths, 1, {})
+    after_sampler = torch.rand(1)
+    torch.manual_seed(2)
+    assert torch.equal(torch.rand(1), after_sampler)
+
+
+def test_state_of_another_seed_is_rejected():
+    sampler = make_sampler(make_lengths(100))
+    with pytest.raises(ValueError):
+        sampler.load_state_dict({"seed": 7, "epoch": 0, "start_index": 10})
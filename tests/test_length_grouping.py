@@ -0,0 +1,183 @@
+import numpy as np
+import pytest
+import torch
+from transformers.trainer_pt_utils import get_length_grouped_indices as reference_get_length_grouped_indices_hf
+
+from llava.train.llava_trainer import (
+    get_length_grouped_indices,
+    get_length_grouped_indices_auto_single,
+    get_length_grouped_indices_hf,
+    get_modality_length_grouped_indices,
+    get_modality_length_grouped_indices_auto,
+    get_variable_length_grouped_indices,
+    split_megabatches_to_even_chunks,
+    split_to_even_chunks,
+)
+
+# the grouping functions before they were vectorized
+
+
+def reference_split_to_even_chunks(indices, lengths, num_chunks):
+    if len(indices) % num_chunks != 0:
+        return [indices[i::num_chunks] for i in range(num_chunks)]
+
+    num_indices_per_chunk = len(indices) // num_chunks
+
+    chunks = [[] for _ in range(num_chunks)]
+    chunks_lengths = [0 for _ in range(num_chunks)]
+    for index in indices:
+        shortest_chunk = chunks_lengths.index(min(chunks_lengths))
+        chunks[shortest_chunk].append(index)
+        chunks_lengths[shortest_chunk] += lengths[index]
+        if len(chunks[shortest_chunk]) == num_indices_per_chunk:
+            chunks_lengths[shortest_chunk] = float("inf")
+
+    return chunks
+
+
+def reference_get_variable_length_grouped_indices(lengths, batch_size, world_size, megabatch_mult=8, generator=None):
+    indices = torch.randperm(len(lengths), generator=generator)
+    sorted_indices = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    megabatch_size = world_size * batch_size * megabatch_mult
+    megabatches = [sorted_indices[i : i + megabatch_size] for i in range(0, len(lengths), megabatch_size)]
+    megabatches = [sorted(megabatch, key=lambda i: indices[i], reverse=True) for megabatch in megabatches]
+    shuffled_indices = [i for megabatch in megabatches for i in megabatch]
+    world_batch_size = world_size * batch_size
+    batches = [shuffled_indices[i : i + world_batch_size] for i in range(0, len(lengths), world_batch_size)]
+    batch_indices = torch.randperm(len(batches), generator=generator)
+    batches = [batches[i] for i in batch_indices]
+
+    return [i for batch in batches for i in batch]
+
+
+def reference_get_length_grouped_indices(lengths, batch_size, world_size, generator=None):
+    indices = torch.randperm(len(lengths), generator=generator)
+    megabatch_size = world_size * batch_size
+    megabatches = [indices[i : i + megabatch_size].tolist() for i in range(0, len(lengths), megabatch_size)]
+    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
+    megabatches = [reference_split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
+
+    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+
+
+def reference_get_modality_length_grouped_indices(lengths, batch_size, world_size, generator=None):
+    if all(l > 0 for l in lengths) or all(l < 0 for l in lengths):
+        return reference_get_length_grouped_indices(lengths, batch_size, world_size, generator=generator)
+    mm_indices, mm_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
+    lang_indices, lang_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+
+    mm_shuffle = [mm_indices[i] for i in reference_get_length_grouped_indices(mm_lengths, batch_size, world_size, generator=None)]
+    lang_shuffle = [lang_indices[i] for i in reference_get_length_grouped_indices(lang_lengths, batch_size, world_size, generator=None)]
+    megabatch_size = world_size * batch_size
+    mm_megabatches = [mm_shuffle[i : i + megabatch_size] for i in range(0, len(mm_shuffle), megabatch_size)]
+    lang_megabatches = [lang_shuffle[i : i + megabatch_size] for i in range(0, len(lang_shuffle), megabatch_size)]
+
+    additional_batch = mm_megabatches[-1] + lang_megabatches[-1]
+    megabatches = mm_megabatches[:-1] + lang_megabatches[:-1]
+    megabatch_indices = torch.randperm(len(megabatches), generator=generator)
+    megabatches = [megabatches[i] for i in megabatch_indices]
+
+    if len(additional_batch) > 0:
+        megabatches.append(sorted(additional_batch))
+
+    return [i for megabatch in megabatches for i in megabatch]
+
+
+def reference_get_length_grouped_indices_auto_single(lengths, batch_size, world_size, generator=None):
+    indices = reference_get_length_grouped_indices_hf(lengths, batch_size * world_size, generator=generator)
+
+    megabatch_size = world_size * batch_size
+    megabatches = [indices[i : i + megabatch_size] for i in range(0, len(lengths), megabatch_size)]
+    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
+    megabatches = [reference_split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
+
+    batch_indices = torch.randperm(len(megabatches), generator=generator)
+    megabatches = [megabatches[i] for i in batch_indices]
+
+    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+
+
+def reference_get_modality_length_grouped_indices_auto(lengths, batch_size, world_size, generator=None):
+    if all(l > 0 for l in lengths) or all(l < 0 for l in lengths):
+        return reference_get_length_grouped_indices_auto_single(lengths, batch_size, world_size, generator=generator)
+    mm_indices, mm_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
+    lang_indices, lang_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+
+    mm_shuffle = [mm_indices[i] for i in reference_get_length_grouped_indices_auto_single(mm_lengths, batch_size, world_size, generator=None)]
+    lang_shuffle = [lang_indices[i] for i in reference_get_length_grouped_indices_auto_single(lang_lengths, batch_size, world_size, generator=None)]
+    megabatch_size = world_size * batch_size
+    mm_megabatches = [mm_shuffle[i : i + megabatch_size] for i in range(0, len(mm_shuffle), megabatch_size)]
+    lang_megabatches = [lang_shuffle[i : i + megabatch_size] for i in range(0, len(lang_shuffle), megabatch_size)]
+
+    megabatches = mm_megabatches[:-1] + lang_megabatches[:-1]
+    megabatch_indices = torch.randperm(len(megabatches), generator=generator)
+    megabatches = [megabatches[i] for i in megabatch_indices]
+
+    return [i for megabatch in megabatches for i in megabatch]
+
+
+def make_lengths(num_samples, text_ratio, max_length, seed):
+    # a small max_length gives many ties, the order of tied samples has to match as well
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, max_length + 1, num_samples)
+    lengths[rng.random(num_samples) < text_ratio] *= -1
+    return lengths.tolist()
+
+
+CASES = [
+    # num_samples, batch_size, world_size, max_length
+    (1, 1, 1, 100),
+    (7, 4, 2, 100),
+    (100, 4, 1, 3),
+    (1000, 4, 8, 2048),
+    (1003, 3, 2, 10),
+    (5000, 16, 4, 4096),
+]
+
+
+def assert_same_output(fn, reference_fn, lengths, batch_size, world_size, seed):
+    torch.manual_seed(seed)
+    actual = fn(lengths, batch_size, world_size)
+    torch.manual_seed(seed)
+    expected = reference_fn(lengths, batch_size, world_size)
+    assert [int(i) for i in actual] == [int(i) for i in expected]
+
+
+@pytest.mark.parametrize("num_samples, batch_size, world_size, max_length", CASES)
+@pytest.mark.parametrize("seed", [0, 1])
+def test_length_grouped_indices_match_reference(num_samples, batch_size, world_size, max_length, seed):
+    lengths = make_lengths(num_samples, 0.0, max_length, seed)
+    assert_same_output(get_length_grouped_indices, reference_get_length_grouped_indices, lengths, batch_size, world_size, seed)
+    assert_same_output(get_length_grouped_indices_auto_single, reference_get_length_grouped_indices_auto_single, lengths, batch_size, world_size, seed)
+    assert_same_output(get_variable_length_grouped_indices, reference_get_variable_length_grouped_indices, lengths, batch_size, world_size, seed)
+
+
+@pytest.mark.parametrize("num_samples, batch_size, world_size, max_length", [case for case in CASES if case[0] > 1])
+@pytest.mark.parametrize("text_ratio", [0.0, 0.3, 1.0])
+def test_modality_length_grouped_indices_match_reference(num_samples, batch_size, world_size, max_length, text_ratio):
+    lengths = make_lengths(num_samples, text_ratio, max_length, seed=2)
+    if text_ratio not in (0.0, 1.0) and (all(l > 0 for l in lengths) or all(l < 0 for l in lengths)):
+        pytest.skip("the sampled lengths have a single modality")
+    assert_same_output(get_modality_length_grouped_indices, reference_get_modality_length_grouped_indices, lengths, batch_size, world_size, seed=3)
+    assert_same_output(get_modality_length_grouped_indices_auto, reference_get_modality_length_grouped_indices_auto, lengths, batch_size, world_size, seed=3)
+
+
+@pytest.mark.parametrize("num_samples, batch_size, mega_batch_mult", [(1, 1, None), (100, 4, None), (1000, 8, None), (1000, 8, 3), (4099, 32, None)])
+def test_length_grouped_indices_hf_matches_transformers(num_samples, batch_size, mega_batch_mult):
+    lengths = make_lengths(num_samples, 0.0, 50, seed=4)
+    torch.manual_seed(5)
+    actual = get_length_grouped_indices_hf(lengths, batch_size, mega_batch_mult=mega_batch_mult)
+    torch.manual_seed(5)
+    expected = reference_get_length_grouped_indices_hf(lengths, batch_size, mega_batch_mult=mega_batch_mult)
+    assert [int(i) for i in actual] == [int(i) for i in expected]
+
+
+@pytest.mark.parametrize("megabatch_size, num_chunks", [(8, 2), (12, 4), (10, 4), (32, 8), (5, 1)])
+def test_split_to_even_chunks_match_reference(megabatch_size, num_chunks):
+    rng = np.random.default_rng(6)
+    lengths = rng.integers(1, 20, 20 * megabatch_size).tolist()
+    megabatches = rng.permutation(len(lengths)).reshape(-1, megabatch_size)
+    expected = [reference_split_to_even_chunks(megabatch.tolist(), lengths, num_chunks) for megabatch in megabatches]
+    assert [split_to_even_chunks(megabatch.tolist(), lengths, num_chunks) for megabatch in megabatches] == expected
+    chunked = split_megabatches_to_even_chunks(megabatches, lengths, num_chunks)
+    assert chunked.tolist() == [[i for chunk in chunks for i in chunk] for chunks in expected]
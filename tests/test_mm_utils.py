@@ -0,0 +1,66 @@
+import ast
+import random
+import re
+
+from llava.mm_utils import _select_best_resolution, parse_grid_pinpoints, select_best_resolution
+
+
+def reference_select_best_resolution(original_size, possible_resolutions):
+    # select_best_resolution before it was vectorized
+    original_width, original_height = original_size
+    best_fit = None
+    max_effective_resolution = 0
+    min_wasted_resolution = float("inf")
+
+    for width, height in possible_resolutions:
+        scale = min(width / original_width, height / original_height)
+        downscaled_width, downscaled_height = int(original_width * scale), int(original_height * scale)
+        effective_resolution = min(downscaled_width * downscaled_height, original_width * original_height)
+        wasted_resolution = (width * height) - effective_resolution
+
+        if effective_resolution > max_effective_resolution or (effective_resolution == max_effective_resolution and wasted_resolution < min_wasted_resolution):
+            max_effective_resolution = effective_resolution
+            min_wasted_resolution = wasted_resolution
+            best_fit = (width, height)
+
+    return best_fit
+
+
+def reference_parse_grid_pinpoints(grid_pinpoints, patch_size):
+    # the parsing every anyres helper repeated before parse_grid_pinpoints
+    if isinstance(grid_pinpoints, str) and "x" in grid_pinpoints:
+        matches = re.findall(r"\((\d+)x(\d+)\)", grid_pinpoints)
+        range_start = tuple(map(int, matches[0]))
+        range_end = tuple(map(int, matches[-1]))
+        grid_pinpoints = [(i, j) for i in range(range_start[0], range_end[0] + 1) for j in range(range_start[1], range_end[1] + 1)]
+        grid_pinpoints = [[dim * patch_size for dim in pair] for pair in grid_pinpoints]
+    if type(grid_pinpoints) is list:
+        return grid_pinpoints
+    return ast.literal_eval(grid_pinpoints)
+
+
+def test_select_best_resolution_matches_reference():
+    rng = random.Random(0)
+    for grid_pinpoints, patch_size in [("(1x1),...,(6x6)", 384), ("(1x1),...,(3x3)", 336), ("[(336, 672), (672, 336), (672, 672), (1008, 336), (336, 1008)]", None)]:
+        possible_resolutions = parse_grid_pinpoints(grid_pinpoints, patch_size)
+        sizes = [(rng.randint(1, 4000), rng.randint(1, 4000)) for _ in range(2000)]
+        # exact multiples and aspect ratios of the candidates, where ties between them are likely
+        sizes += [(width * k // 4, height * k // 4) for width, height in possible_resolutions for k in range(1, 9)]
+        sizes += [(1, 1), (1, 4000), (4000, 1)]
+        for size in sizes:
+            assert select_best_resolution(size, possible_resolutions) == reference_select_best_resolution(size, possible_resolutions), size
+
+
+def test_select_best_resolution_accepts_lists():
+    possible_resolutions = [[336, 672], [672, 336], [672, 672]]
+    assert select_best_resolution([500, 300], possible_resolutions) == reference_select_best_resolution((500, 300), possible_resolutions)
+    # lists and tuples share the memoized result
+    hits = _select_best_resolution.cache_info().hits
+    assert select_best_resolution((500, 300), tuple(tuple(resolution) for resolution in possible_resolutions)) == (672, 336)
+    assert _select_best_resolution.cache_info().hits == hits + 1
+
+
+def test_parse_grid_pinpoints_matches_reference():
+    for grid_pinpoints, patch_size in [("(1x1),...,(6x6)", 384), ("(1x1),...,(2x2)", 336), ("(2x3),...,(4x5)", 224), ("[(336, 672), (672, 336)]", None), ([[336, 672], [672, 336]], None)]:
+        expected = reference_parse_grid_pinpoints(grid_pinpoints, patch_size)
+        assert parse_grid_pinpoints(grid_pinpoints, patch_size) == tuple(tuple(pair) for pair in expected)
@@ -0,0 +1,71 @@
+import torch
+import torch.nn.functional as F
+
+from llava.train.packing_flash_attn_monkey_patch import get_unpad_data_packed
+
+
+def reference_get_unpad_data(attention_mask):
+    # `_get_unpad_data` of the transformers flash-attention models
+    seqlens_in_batch = attention_mask.sum(dim=-1, dtype=torch.int32)
+    indices = torch.nonzero(attention_mask.flatten(), as_tuple=False).flatten()
+    max_seqlen_in_batch = seqlens_in_batch.max().item()
+    cu_seqlens = F.pad(torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.int32), (1, 0))
+    return indices, cu_seqlens, max_seqlen_in_batch
+
+
+def assert_unpad_equal(actual, expected):
+    assert torch.equal(actual[0], expected[0])
+    assert torch.equal(actual[1], expected[1])
+    assert actual[1].dtype == expected[1].dtype == torch.int32
+    assert actual[2] == expected[2]
+
+
+def test_binary_mask_matches_reference():
+    generator = torch.Generator().manual_seed(0)
+    for batch_size, seq_len in [(1, 1), (1, 17), (4, 32), (8, 100)]:
+        lengths = torch.randint(1, seq_len + 1, (batch_size,), generator=generator)
+        for left_padding in (False, True):
+            positions = torch.arange(seq_len)[None, :]
+            attention_mask = positions >= seq_len - lengths[:, None] if left_padding else positions < lengths[:, None]
+            for dtype in (torch.bool, torch.int32, torch.long):
+                mask = attention_mask.to(dtype)
+                assert_unpad_equal(get_unpad_data_packed(mask), reference_get_unpad_data(mask.long()))
+
+
+def test_full_mask_matches_reference():
+    attention_mask = torch.ones(3, 9, dtype=torch.long)
+    assert_unpad_equal(get_unpad_data_packed(attention_mask), reference_get_unpad_data(attention_mask))
+
+
+def test_packed_segments_become_sequences():
+    attention_mask = torch.tensor(
+        [
+            [1, 1, 1, 2, 2, 3, 0, 0],
+            [1, 1, 1, 1, 1, 1, 1, 0],
+            [1, 2, 2, 2, 2, 2, 2, 2],
+        ]
+    )
+    indices, cu_seqlens, max_seqlen = get_unpad_data_packed(attention_mask)
+    assert torch.equal(indices, torch.nonzero(attention_mask.flatten()).flatten())
+    assert cu_seqlens.tolist() == [0, 3, 5, 6, 13, 14, 21]
+    assert max_seqlen == 7
+
+
+def test_packed_rows_match_unpacked_samples():
+    # every segment of a packed row is unpadded like a row of its own
+    generator = torch.Generator().manual_seed(1)
+    lengths = torch.randint(1, 20, (12,), generator=generator).tolist()
+    rows, segment_lengths, row = [], [], []
+    for length in lengths:
+        if len(row) + length > 40:
+            rows.append(row)
+            row = []
+        segment_id = (max(row) if row else 0) + 1
+        row += [segment_id] * length
+        segment_lengths.append(length)
+    rows.append(row)
+    attention_mask = torch.tensor([row + [0] * (40 - len(row)) for row in rows])
+
+    _, cu_seqlens, max_seqlen = get_unpad_data_packed(attention_mask)
+    assert torch.diff(cu_seqlens).tolist() == segment_lengths
+    assert max_seqlen == max(segment_lengths)
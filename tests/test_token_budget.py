@@ -0,0 +1,75 @@
+import collections
+
+import numpy as np
+import pytest
+import torch
+
+from llava.train.llava_trainer import TokenBudgetBatchSampler, get_token_budget_batches, pack_token_budget_batches
+
+
+def make_lengths(num_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    # mostly short samples and a long tail, some of them above the budget
+    return np.minimum(rng.lognormal(6, 1, num_samples).astype(np.int64) + 1, 20000)
+
+
+def padded_tokens(batch, lengths):
+    return len(batch) * int(np.max(lengths[batch]))
+
+
+@pytest.mark.parametrize("max_tokens", [1, 500, 4096, 16384, 10**9])
+def test_pack_token_budget_batches_respects_budget(max_tokens):
+    lengths = make_lengths(2000)
+    indices = np.argsort(-lengths, kind="stable")
+    batches = pack_token_budget_batches(indices, lengths, max_tokens)
+
+    assert np.array_equal(np.concatenate(batches), indices)
+    for batch_idx, batch in enumerate(batches):
+        # only a sample longer than the budget may exceed it, in a batch of its own
+        assert padded_tokens(batch, lengths) <= max_tokens or len(batch) == 1
+        # the batches are as large as the budget allows
+        if batch_idx < len(batches) - 1:
+            assert (len(batch) + 1) * lengths[batch[0]] > max_tokens
+
+
+def test_pack_token_budget_batches_empty():
+    assert pack_token_budget_batches(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 100) == []
+
+
+@pytest.mark.parametrize("world_size", [1, 2, 8])
+@pytest.mark.parametrize("max_tokens", [2048, 16384])
+def test_token_budget_batches_respect_budget(world_size, max_tokens):
+    lengths = make_lengths(3001, seed=1)
+    steps = get_token_budget_batches(lengths, max_tokens, world_size, megabatch_size=256 * world_size, generator=torch.Generator().manual_seed(0))
+
+    assert all(len(step) == world_size for step in steps)
+    batches = [batch for step in steps for batch in step]
+    for batch in batches:
+        assert len(batch) > 0
+        assert padded_tokens(batch, lengths) <= max_tokens or len(batch) == 1
+
+    # every sample is drawn, only the padding batches of the last step repeat samples
+    counts = collections.Counter(i for batch in batches for i in batch)
+    assert set(counts) == set(range(len(lengths)))
+    num_repeated = sum(count - 1 for count in counts.values())
+    assert num_repeated <= max(len(batch) for batch in batches) * (world_size - 1)
+
+
+def test_token_budget_batch_sampler_ranks_and_resume():
+    lengths = make_lengths(1500, seed=2)
+    world_size = 4
+    samplers = [TokenBudgetBatchSampler(lengths, 8192, world_size, rank, seed=3) for rank in range(world_size)]
+    for sampler in samplers:
+        sampler.set_epoch(1)
+    rank_batches = [list(sampler) for sampler in samplers]
+
+    # every rank runs the same number of steps and the ranks share the samples of the epoch
+    assert len({len(batches) for batches in rank_batches}) == 1
+    assert {i for batches in rank_batches for batch in batches for i in batch} == set(range(len(lengths)))
+    for batches in rank_batches:
+        assert all(padded_tokens(batch, lengths) <= 8192 or len(batch) == 1 for batch in batches)
+
+    resumed = TokenBudgetBatchSampler(lengths, 8192, world_size, 2, seed=3)
+    resumed.load_state_dict({"seed": 3, "epoch": 1, "start_index": 5})
+    resumed.set_epoch(1)
+    assert list(resumed) == rank_batches[2][5:]